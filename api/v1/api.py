@@ -20,6 +20,12 @@ from api.v1.api_bus_filters import (
 from api.v1.api_subscriptions import SubscriptionsView, SubscriptionView
 from api.v1.api_templates import TemplatesView, TemplateView, TemplatesBusFiltersView
 from api.v1.api_messages import MessagesView
+from api.v1.api_metrics import MetricsView
+from api.v1.api_dead_letters import (
+    DeadLettersView,
+    DeadLetterView,
+    DeadLettersReplayView
+)
 
 
 class ApiHandler(threading.Thread):
@@ -67,6 +73,11 @@ class ApiHandler(threading.Thread):
 
         api.add_resource(Documentation, '/spec')
         api.add_resource(MessagesView, '/messages')
+        api.add_resource(DeadLettersView, '/dead_letters')
+        api.add_resource(DeadLettersReplayView, '/dead_letters/replay')
+        api.add_resource(
+            DeadLetterView, '/dead_letters/<string:dead_letter_id>')
+        api.add_resource(MetricsView, '/metrics')
         app.run(host=st.API_SERVER, port=st.API_PORT)
 
 
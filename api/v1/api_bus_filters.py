@@ -4,17 +4,18 @@ APi bus filters handler
 from flask_restful import Resource, request, reqparse
 from itertools import groupby
 
+from bussiness import registry
 from bussiness.bus_filters import BusFiltersHandler, BusFilterSchema
 from bussiness.users import UsersHandler, UserSchema
 from bussiness.subscriptions import SubscriptionsHandler
 from bussiness.templates import TemplatesHandler, TemplateSchema
 
-filters = BusFiltersHandler()
-subscriptions = SubscriptionsHandler()
+filters = registry.get(BusFiltersHandler)
+subscriptions = registry.get(SubscriptionsHandler)
 bus_filter_schema = BusFilterSchema()
 user_schema = UserSchema()
-users = UsersHandler()
-templates = TemplatesHandler()
+users = registry.get(UsersHandler)
+templates = registry.get(TemplatesHandler)
 template_schema = TemplateSchema()
 
 
@@ -264,10 +265,7 @@ class BusFilterUserView(Resource):
         """
         bus_filter = filters.get(bus_filter_id)
         if bus_filter:
-            sub_list = subscriptions.get()
-            sub = [
-                x for x in sub_list if (
-                    x.get('user_id') == user_id and x.get('filter_id') == bus_filter_id)]
+            sub = subscriptions.get_by_user_filter(user_id, bus_filter_id)
             if sub:
                 subscriptions.delete(sub[0].get('id'))
                 response = {'deleted': True}
@@ -0,0 +1,91 @@
+"""
+API dead letters handler
+"""
+
+from flask_restful import Resource, request
+
+import settings as st
+from utils import pagination
+
+from bussiness import registry
+from bussiness.dead_letters import DeadLettersHandler, ReplaySchema
+
+dead_letters = registry.get(DeadLettersHandler)
+replay_schema = ReplaySchema()
+
+
+class DeadLettersView(Resource):
+    """
+    Dead letters endpoints /dead_letters/
+    """
+
+    @staticmethod
+    def get():
+        """
+        Get dead letters from the db. Accepts the params limit,
+        start_after and fields (separated by commas) to paginate
+        """
+        try:
+            limit, start_after, fields = pagination.page_params(
+                request.args, st.API_MAX_PAGE_SIZE)
+        except ValueError as error:
+            return {'message': str(error)}, 400
+
+        return pagination.list_response(
+            dead_letters.get_page(limit, start_after, fields), limit)
+
+
+class DeadLetterView(Resource):
+    """
+    Dead letter endpoints /dead_letters/id
+    """
+
+    @staticmethod
+    def get(dead_letter_id):
+        """
+        Get specific dead letter
+        """
+        response = dead_letters.get(dead_letter_id)
+
+        if response:
+            return response
+
+        return {'message': 'Dead letter not found'}, 404
+
+    @staticmethod
+    def delete(dead_letter_id):
+        """
+        Delete dead letter passing his id
+        """
+        if dead_letters.get(dead_letter_id):
+            dead_letters.delete(dead_letter_id)
+            return {'deleted': True}
+
+        return {'message': 'Dead letter not found'}, 404
+
+
+class DeadLettersReplayView(Resource):
+    """
+    Dead letters replay endpoint /dead_letters/replay
+    """
+
+    @staticmethod
+    def post():
+        """
+        Marks dead letters to be sent again. The body has the list of
+        ids to replay, or all set to true to replay every dead letter
+        """
+        json_data = request.get_json(force=True, silent=True)
+        if not isinstance(json_data, dict):
+            return {'message': 'No input data provided'}, 400
+        if json_data.get('all') is True and 'ids' not in json_data:
+            return {'replayed': dead_letters.replay()}, 202
+        if not isinstance(json_data.get('ids'), list):
+            return {'message': 'ids must be a list of dead letter ids'}, 400
+
+        result, errors = replay_schema.load(json_data)
+        if errors:
+            return errors, 422
+
+        replayed = dead_letters.replay(result['ids'])
+        return {'replayed': replayed}, 202
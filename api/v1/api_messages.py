@@ -4,9 +4,13 @@ API messages handler
 
 from flask_restful import Resource, request
 
+import settings as st
+from utils import pagination
+
+from bussiness import registry
 from bussiness.messages import MessagesHandler
 
-messages = MessagesHandler()
+messages = registry.get(MessagesHandler)
 
 class MessagesView(Resource):
     """
@@ -16,7 +20,14 @@ class MessagesView(Resource):
     @staticmethod
     def get():
         """
-        Get templates from the db
+        Get messages from the db. Accepts the params limit, start_after
+        and fields (separated by commas) to paginate
         """
-        response = messages.get()
-        return response
\ No newline at end of file
+        try:
+            limit, start_after, fields = pagination.page_params(
+                request.args, st.API_MAX_PAGE_SIZE)
+        except ValueError as error:
+            return {'message': str(error)}, 400
+
+        return pagination.list_response(
+            messages.get_page(limit, start_after, fields), limit)
\ No newline at end of file
@@ -0,0 +1,20 @@
+"""
+API metrics handler
+"""
+
+from flask_restful import Resource
+
+from utils import metrics
+
+
+class MetricsView(Resource):
+    """
+    Metrics endpoints /metrics/
+    """
+
+    @staticmethod
+    def get():
+        """
+        Get the metrics of the running service
+        """
+        return metrics.collect()
@@ -3,16 +3,19 @@ APi subscriptions handler
 """
 from flask_restful import Resource, request
 
+import settings as st
+
+from bussiness import registry
 from bussiness.users import UsersHandler
 from bussiness.bus_filters import BusFiltersHandler
 from bussiness.subscriptions import SubscriptionsHandler, SubscriptionSchema
 
-from utils import json_parser
+from utils import pagination
 
 
-users = UsersHandler()
-filters = BusFiltersHandler()
-subscriptions = SubscriptionsHandler()
+users = registry.get(UsersHandler)
+filters = registry.get(BusFiltersHandler)
+subscriptions = registry.get(SubscriptionsHandler)
 subscription_schema = SubscriptionSchema()
 
 
@@ -24,11 +27,18 @@ class SubscriptionsView(Resource):
     @staticmethod
     def get():
         """
-        Get subscriptions from the db
+        Get subscriptions from the db. Accepts the params limit,
+        start_after and fields (separated by commas) to paginate
         """
-        response = json_parser.to_json_list(
-            subscriptions.get_with_relationships())
-        return response
+        try:
+            limit, start_after, fields = pagination.page_params(
+                request.args, st.API_MAX_PAGE_SIZE)
+        except ValueError as error:
+            return {'message': str(error)}, 400
+
+        return pagination.list_response(
+            subscriptions.get_with_relationships(limit, start_after, fields),
+            limit)
 
     def post(self):
         """
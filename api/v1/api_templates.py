@@ -4,15 +4,16 @@ API notification templates handler
 
 from flask_restful import Resource, request
 
+from bussiness import registry
 from bussiness.users import UsersHandler
 from bussiness.bus_filters import BusFiltersHandler, BusFilterSchema
 from bussiness.subscriptions import SubscriptionsHandler
 from bussiness.templates import TemplatesHandler, TemplateSchema
 
-users = UsersHandler()
-filters = BusFiltersHandler()
-subscriptions = SubscriptionsHandler()
-templates = TemplatesHandler()
+users = registry.get(UsersHandler)
+filters = registry.get(BusFiltersHandler)
+subscriptions = registry.get(SubscriptionsHandler)
+templates = registry.get(TemplatesHandler)
 templates_schema = TemplateSchema()
 bus_filter_schema = BusFilterSchema()
 
@@ -3,14 +3,18 @@ API users handler
 """
 from flask_restful import Resource, request
 
+import settings as st
+from utils import pagination
+
+from bussiness import registry
 from bussiness.users import UsersHandler, UserSchema
 from bussiness.subscriptions import SubscriptionsHandler
 from bussiness.bus_filters import BusFiltersHandler, BusFilterSchema
 
 
-users = UsersHandler()
-subscriptions = SubscriptionsHandler()
-filters = BusFiltersHandler()
+users = registry.get(UsersHandler)
+subscriptions = registry.get(SubscriptionsHandler)
+filters = registry.get(BusFiltersHandler)
 user_schema = UserSchema()
 bus_filter_schema = BusFilterSchema()
 
@@ -23,10 +27,17 @@ class UsersView(Resource):
     @staticmethod
     def get():
         """
-        Get users from the db
+        Get users from the db. Accepts the params limit, start_after
+        and fields (separated by commas) to paginate
         """
-        response = users.get()
-        return response
+        try:
+            limit, start_after, fields = pagination.page_params(
+                request.args, st.API_MAX_PAGE_SIZE)
+        except ValueError as error:
+            return {'message': str(error)}, 400
+
+        return pagination.list_response(
+            users.get_page(limit, start_after, fields), limit)
 
     def post(self):
         """
@@ -198,10 +209,7 @@ class UserFilterView(Resource):
         """
         user = users.get(user_id)
         if user:
-            sub_list = subscriptions.get()
-            sub = [
-                x for x in sub_list if (
-                    x.get('user_id') == user_id and x.get('filter_id') == bus_filter_id)]
+            sub = subscriptions.get_by_user_filter(user_id, bus_filter_id)
             if sub:
                 subscriptions.delete(sub[0].get('id'))
                 response = {'deleted': True}
@@ -0,0 +1,160 @@
+"""
+Bindings of the bus queue
+"""
+from threading import Lock
+
+
+class BusBindings():
+    """
+    Reference counted set of the (exchange, key) bindings of the bus queue.
+    Every subscription counts once for the binding of his bus filter.
+    Changes return the bindings that have to be added or removed from
+    the consumer: a binding is added when his first subscription
+    appears and removed when the last one is gone
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.filters = {}
+        self.subscriptions = {}
+        self.filter_subscriptions = {}
+        self.counts = {}
+
+    def apply(self, table_name, change):
+        """
+        Applies a changefeed entry of bus filters or subscriptions
+        :return: Tuple with the lists of bindings to add and to remove.
+        Each binding is a tuple (exchange, key)
+        """
+        old_val = change.get('old_val')
+        new_val = change.get('new_val')
+        deltas = {}
+        with self.lock:
+            if table_name == 'bus_filters':
+                if old_val and not new_val:
+                    self.remove_filter(old_val['id'], deltas)
+                elif new_val:
+                    self.set_filter(new_val, deltas)
+            elif table_name == 'subscriptions':
+                if old_val:
+                    self.remove_subscription(old_val['id'], deltas)
+                if new_val:
+                    self.set_subscription(new_val, deltas)
+        return ([binding for binding, delta in deltas.items() if delta > 0],
+                [binding for binding, delta in deltas.items() if delta < 0])
+
+    def set_filter(self, bus_filter, deltas):
+        """
+        Adds or replaces a bus filter. If the exchange or the key
+        change his subscriptions are moved to the new binding
+        """
+        binding = self.binding(bus_filter)
+        old_filter = self.filters.get(bus_filter['id'])
+        self.filters[bus_filter['id']] = bus_filter
+        old_binding = old_filter and self.binding(old_filter)
+        if old_binding == binding:
+            return
+        count = len(self.filter_subscriptions.get(bus_filter['id'], ()))
+        if old_binding:
+            self.count(old_binding, -count, deltas)
+        self.count(binding, count, deltas)
+
+    def remove_filter(self, filter_id, deltas):
+        """
+        Removes a bus filter and the count of his subscriptions
+        """
+        bus_filter = self.filters.pop(filter_id, None)
+        if bus_filter:
+            count = len(self.filter_subscriptions.get(filter_id, ()))
+            self.count(self.binding(bus_filter), -count, deltas)
+
+    def set_subscription(self, subscription, deltas):
+        """
+        Adds a subscription to the count of his bus filter binding
+        """
+        if subscription['id'] in self.subscriptions:
+            self.remove_subscription(subscription['id'], deltas)
+        filter_id = subscription.get('filter_id')
+        self.subscriptions[subscription['id']] = filter_id
+        self.filter_subscriptions.setdefault(
+            filter_id, set()).add(subscription['id'])
+        if filter_id in self.filters:
+            self.count(self.binding(self.filters[filter_id]), 1, deltas)
+
+    def remove_subscription(self, subscription_id, deltas):
+        """
+        Removes a subscription from the count of his bus filter binding
+        """
+        filter_id = self.subscriptions.pop(subscription_id, None)
+        subscriptions = self.filter_subscriptions.get(filter_id)
+        if subscriptions is None or subscription_id not in subscriptions:
+            return
+        subscriptions.discard(subscription_id)
+        if not subscriptions:
+            del self.filter_subscriptions[filter_id]
+        if filter_id in self.filters:
+            self.count(self.binding(self.filters[filter_id]), -1, deltas)
+
+    @staticmethod
+    def binding(bus_filter):
+        """
+        Returns the binding of a bus filter. A filter without key binds
+        with an empty key, as the consumer does
+        """
+        return (bus_filter.get('exchange'), bus_filter.get('key') or '')
+
+    def count(self, binding, amount, deltas):
+        """
+        Changes the count of a binding and records if it is
+        added (1) or removed (-1) in deltas
+        """
+        if not amount:
+            return
+        before = self.counts.get(binding, 0)
+        after = before + amount
+        if after > 0:
+            self.counts[binding] = after
+        else:
+            self.counts.pop(binding, None)
+        if not before and after > 0:
+            deltas[binding] = deltas.get(binding, 0) + 1
+        elif before and after <= 0:
+            deltas[binding] = deltas.get(binding, 0) - 1
+
+    def bus_filter(self, binding):
+        """
+        Returns a bus filter of a binding, to declare his exchange,
+        or None if no bus filter has the binding
+        """
+        with self.lock:
+            for bus_filter in self.filters.values():
+                if self.binding(bus_filter) == binding:
+                    return bus_filter
+            return None
+
+    def current(self):
+        """
+        Returns the set of bindings with subscriptions
+        """
+        with self.lock:
+            return set(self.counts)
+
+    def bus_filters(self):
+        """
+        Returns a bus filter of every binding with subscriptions
+        """
+        with self.lock:
+            bus_filters = {}
+            for bus_filter in self.filters.values():
+                binding = self.binding(bus_filter)
+                if binding in self.counts:
+                    bus_filters.setdefault(binding, bus_filter)
+            return list(bus_filters.values())
+
+    def stats(self):
+        """
+        Returns the number of subscriptions of each binding
+        """
+        with self.lock:
+            return {'{}:{}'.format(exchange, key): count
+                    for (exchange, key), count in self.counts.items()}
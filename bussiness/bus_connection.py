@@ -1,21 +1,21 @@
 """
 Bus connection handler
 """
-import queue
-from jinja2 import Template, Undefined
-from raccoon import Consumer
-
 import settings as st
-import datetime
-import rethinkdb as r
 
+from connectors.outbox import Outbox
+from connectors.rabbitmq import RabbitMQConsumer
 from connectors.smtp import SMTPHandler
+from utils import dates, metrics
 
-from bussiness.users import UsersHandler
-from bussiness.bus_filters import BusFiltersHandler
-from bussiness.subscriptions import SubscriptionsHandler
+from bussiness import registry
 from bussiness.templates import TemplatesHandler
+from bussiness.dead_letters import DeadLettersHandler
 from bussiness.messages import MessagesHandler
+from bussiness.dispatcher import Stage, Pipeline, Tracker
+from bussiness.digest import DigestBuffer
+from bussiness.rate_limiter import RateLimiter
+from bussiness.sender import Sender
 
 
 class BusConnectionHandler():
@@ -23,38 +23,76 @@ class BusConnectionHandler():
     Bus connection class
     """
 
-    def __init__(self, subscriptions):
+    def __init__(self, subscriptions, routing, template_cache):
         self.subscriptions = subscriptions
-        self.users = []
-        self.filters_handler = BusFiltersHandler()
-        self.subscriptions_handler = SubscriptionsHandler()
-        self.users_handler = UsersHandler()
-        self.templates_handler = TemplatesHandler()
-        self.messages_handler = MessagesHandler()
+        self.bus_thread = None
+        self.routing = routing
+        self.template_cache = template_cache
+        self.templates_handler = registry.get(TemplatesHandler)
+        self.messages_handler = registry.get(MessagesHandler)
+        self.dead_letters = registry.get(DeadLettersHandler)
         self.smtp = SMTPHandler(
             st.SMTP_EMAIL,
             st.SMTP_PASS,
             st.SMTP_HOST,
             st.SMTP_PORT,
             st.SMTP_FROM_NAME,
-            st.SMTP_TTLS)
+            st.SMTP_TTLS,
+            st.SMTP_POOL_SIZE,
+            st.SMTP_IDLE_TIMEOUT,
+            st.SMTP_MAX_MESSAGES,
+            st.SMTP_MAX_RECIPIENTS,
+            st.SMTP_MESSAGE_CACHE)
+        metrics.register('smtp_pool', self.smtp.pool.stats)
+        metrics.register('smtp', self.smtp.stats)
+        self.limiter = RateLimiter(
+            st.RATE_LIMIT_GLOBAL,
+            st.RATE_LIMIT_GLOBAL_BURST,
+            st.RATE_LIMIT_DOMAIN,
+            st.RATE_LIMIT_DOMAIN_BURST)
+        metrics.register('rate_limiter', self.limiter.stats)
+        self.outbox = Outbox(st.OUTBOX_PATH, st.OUTBOX_CLAIM_TIMEOUT)
+        metrics.register('outbox', self.outbox.stats)
+        # Writes to the outbox file are serialized, one thread is enough
+        self.store_stage = Stage(
+            'outbox', self.store, 1, st.DISPATCH_QUEUE_SIZE, self.on_error)
+        self.archive_stage = Stage(
+            'archive', self.archive, st.DISPATCH_ARCHIVE_WORKERS,
+            st.DISPATCH_QUEUE_SIZE)
+        self.pipeline = Pipeline([
+            Stage('render', self.render, st.DISPATCH_RENDER_WORKERS,
+                  st.DISPATCH_QUEUE_SIZE, self.on_error),
+            self.store_stage,
+            self.archive_stage])
+        self.pipeline.start()
+        metrics.register('pipeline', self.pipeline.stats)
+        self.sender = Sender(
+            self.outbox, self.deliver, st.DISPATCH_SEND_WORKERS,
+            st.OUTBOX_RETRY_WAIT, st.OUTBOX_MAX_RETRY_WAIT,
+            st.OUTBOX_MAX_ATTEMPTS, self.dead_letters.insert)
+        metrics.register('sender', self.sender.stats)
+        self.sender.start()
+        self.digests = DigestBuffer(
+            self.flush_digest, st.DIGEST_MAX_PENDING, store=self.outbox)
+        metrics.register('digests', self.digests.stats)
 
     def start(self):
         """
-        Starts the thread
+        Starts the thread. It consumes from the queue even without
+        subscriptions, because other processes may have bound it
         """
-        if self.subscriptions:
-            error = queue.Queue()
-            self.bus_thread = Consumer(
-                self.on_message,
-                st.RABBITMQ_SERVER,
-                st.RABBITMQ_USER,
-                st.RABBITMQ_PASSWORD,
-                self.subscriptions,
-                st.RABBITMQ_QUEUE,
-                error)
-
-            self.bus_thread.start()
+        self.bus_thread = RabbitMQConsumer(
+            self.on_message,
+            st.RABBITMQ_SERVER,
+            st.RABBITMQ_USER,
+            st.RABBITMQ_PASSWORD,
+            self.subscriptions,
+            st.RABBITMQ_QUEUE,
+            st.RABBITMQ_PREFETCH,
+            st.RABBITMQ_ACK_INTERVAL,
+            st.RABBITMQ_MAX_ATTEMPTS)
+        metrics.register('bus', self.bus_thread.stats)
+        self.bus_thread.start()
 
     def stop(self):
         """
@@ -62,43 +100,236 @@ class BusConnectionHandler():
         """
         self.bus_thread.stop()
         self.bus_thread.join()
+        self.bus_thread = None
 
-    def on_message(self, message):
+    def is_consuming(self):
+        """
+        True if the consumer is running
+        """
+        return self.bus_thread is not None
+
+    def on_message(self, message, tag):
         """"
-        When a message is received
-        """
-        user_emails = []
-        if st.SEND_EMAILS:
-            exchange = message.get('metadata').get('exchange')
-            routing_key = message.get('metadata').get('routing_key', '')
-            bus_filter = self.filters_handler.get_by_exchange_key(
-                exchange, routing_key)
-            if bus_filter:
-                for sub in self.subscriptions_handler.get_by_filter(
-                        bus_filter):
-                    user = self.users_handler.get(sub['user_id'])
-                    template = self.templates_handler.get(sub['template_id'])
-                    if template:
-                        subject, text = self.create_email(template, message)
-                        user_filter = template.get('user_filter')
-                        if user_filter:
-                            user_name = message.get(user_filter)
-                            user_searched = self.users_handler.get(
-                                user_name)
-                            if user_searched:
-                                st.logger.info(
-                                    'Notification to: %r', user_searched['email'])
-                                user_emails.append(user_searched['email'])
-
-                        else:
-                            st.logger.info(
-                                'Notification to: %r', user['email'])
-                            user_emails.append(user['email'])
-                    else:
-                        subject, text = self.get_default_template(template, message)
-                now = r.now().to_iso8601()
-                self.smtp.send(user_emails, subject, text)
-                self.archive_message(bus_filter.get('exchange'), now, user_emails, subject)
+        When a message is received it is passed to the dispatch pipeline.
+        Blocks while the pipeline is full so the bus stops delivering.
+        The message is acknowledged when all his emails are written
+        to the outbox, or delivered again if any of them fails
+        :tag: Tag to complete the message in the consumer
+        """
+        consumer = self.bus_thread
+        if not st.SEND_EMAILS:
+            consumer.complete(tag)
+            return
+        self.pipeline.submit({
+            'message': message,
+            'tracker': Tracker(
+                lambda success: consumer.complete(tag, success))})
+
+    def on_error(self, item, error):
+        """
+        Fails the message of an item of the pipeline
+        """
+        tracker = item.get('tracker')
+        if tracker:
+            tracker.fail()
+
+    def render(self, item):
+        """
+        Resolves the bus filters matching the message and
+        renders an email for each of them
+        :item: Message received from the bus and his tracker
+        :return: List of deliveries to send
+        """
+        message = item['message']
+        exchange = message.get('metadata').get('exchange')
+        routing_key = message.get('metadata').get('routing_key', '')
+        deliveries = []
+        for bus_filter, resolved in self.routing.resolve(
+                exchange, routing_key):
+            for delivery in self.render_filter(bus_filter, resolved, message):
+                delivery['tracker'] = item['tracker']
+                deliveries.append(delivery)
+        item['tracker'].add(len(deliveries))
+        item['tracker'].done()
+        return deliveries
+
+    def render_filter(self, bus_filter, resolved, message):
+        """
+        Resolves the recipients of a bus filter and renders the emails.
+        Each template is rendered once and the recipients of the same
+        email share a delivery
+        :bus_filter: Bus filter matching the message
+        :resolved: Subscriptions of the bus filter with user and template
+        :message: Message received from the bus
+        :return: List of deliveries to send
+        """
+        rendered = {}
+        recipients = {}
+        for sub, user, template in resolved:
+            email = self.recipient(user, template, message)
+            if not email:
+                continue
+            window = sub.get('digest_window', bus_filter.get('digest_window'))
+            if window:
+                self.digests.add(
+                    (bus_filter['id'], email),
+                    email,
+                    bus_filter,
+                    sub.get('digest_template_id',
+                            bus_filter.get('digest_template_id')),
+                    window,
+                    sub.get('digest_max', bus_filter.get('digest_max')),
+                    message)
+                continue
+            template_id = template.get('id') if template else None
+            if template_id not in rendered:
+                if template:
+                    rendered[template_id] = self.create_email(
+                        template, message)
+                else:
+                    rendered[template_id] = self.get_default_template(message)
+            st.logger.info('Notification to: %r', email)
+            recipients.setdefault(rendered[template_id], []).append(email)
+        return [{
+            'exchange': bus_filter.get('exchange'),
+            'users': user_emails,
+            'subject': subject,
+            'text': text}
+            for (subject, text), user_emails in recipients.items()]
+
+    def recipient(self, user, template, message):
+        """
+        Returns the email to notify. If the template has user filter
+        the user is searched with the message param named as the filter
+        """
+        user_filter = template.get('user_filter') if template else None
+        if user_filter:
+            user = self.routing.get_user(message.get(user_filter))
+        if user:
+            return user.get('email')
+        return None
+
+    def flush_digest(self, digest):
+        """
+        Renders a digest and writes it to the outbox, deleting his
+        messages buffered in the same transaction. It is written here
+        instead of by the store stage so they are never lost meanwhile
+        :digest: Digest flushed from the buffer
+        """
+        template = self.routing.get_template(digest.template_id)
+        if not template:
+            template = {
+                'id': 'digest',
+                'subject': st.DEFAULT_DIGEST_SUBJECT,
+                'text': st.DEFAULT_DIGEST_TEXT}
+        subject, text = self.create_email(template, {
+            'messages': digest.messages,
+            'count': len(digest.messages),
+            'exchange': digest.bus_filter.get('exchange'),
+            'key': digest.bus_filter.get('key')})
+        st.logger.info(
+            'Digest of %d messages to: %r',
+            len(digest.messages), digest.recipient)
+        self.outbox.extend([{
+            'exchange': digest.bus_filter.get('exchange'),
+            'users': [digest.recipient],
+            'subject': subject,
+            'text': text}], buffered=digest.buffered)
+
+    def store(self, delivery):
+        """
+        Writes the delivery to the outbox, where the senders take it. It
+        is split in emails of up to max_recipients so the senders send
+        them in parallel, and the recipients of an email that fails
+        are the only ones that get it again. Waits while the outbox is
+        full, so the pipeline fills and the bus stops delivering
+        :delivery: Delivery rendered
+        """
+        tracker = delivery.get('tracker')
+        email = {key: value for key, value in delivery.items()
+                 if key not in ('tracker', 'users')}
+        users = delivery['users']
+        size = self.smtp.max_recipients
+        self.outbox.wait_room(st.OUTBOX_MAX_DEPTH)
+        self.outbox.extend([
+            dict(email, users=users[start:start + size])
+            for start in range(0, len(users), size)])
+        if tracker:
+            tracker.done()
+
+    def replay(self, dead_letter):
+        """
+        Puts a dead letter back in the outbox and deletes it
+        :dead_letter: Dead letter marked to be sent again
+        """
+        self.outbox.append({
+            'exchange': dead_letter.get('exchange'),
+            'users': dead_letter['users'],
+            'subject': dead_letter['subject'],
+            'text': dead_letter['text']})
+        self.dead_letters.delete(dead_letter['id'])
+
+    def deliver(self, delivery):
+        """
+        Sends the email of a delivery of the outbox and passes it to be
+        archived. Waits for the rate limiter when the outbound quota
+        is exhausted, which only slows down the senders
+        :delivery: Delivery of the outbox
+        """
+        self.limiter.acquire(delivery['users'])
+        delivery['date'] = dates.utc_now()
+        refused = self.smtp.send(
+            delivery['users'], delivery['subject'], delivery['text'])
+        if refused:
+            self.refused(delivery, refused)
+            delivery['users'] = [user for user in delivery['users']
+                                 if user not in refused]
+        if delivery['users']:
+            self.archive_stage.put(delivery)
+
+    def refused(self, delivery, refused):
+        """
+        Handles the recipients refused by the smtp server. The ones
+        refused temporarily (4xx) are put back in the outbox to be sent
+        after the retry wait, until max_attempts, and the rest are
+        written as a dead letter
+        :delivery: Delivery sent
+        :refused: Dict with the reply of each recipient refused
+        """
+        attempts = delivery.get('refusals', 0) + 1
+        retry = []
+        dead = []
+        for user, (code, _) in refused.items():
+            if 400 <= code < 500 and attempts < st.OUTBOX_MAX_ATTEMPTS:
+                retry.append(user)
+            else:
+                dead.append(user)
+        email = {key: value for key, value in delivery.items()
+                 if key not in ('users', 'date')}
+        if retry:
+            delay = min(st.OUTBOX_RETRY_WAIT * 2 ** (attempts - 1),
+                        st.OUTBOX_MAX_RETRY_WAIT)
+            self.outbox.append(
+                dict(email, users=retry, refusals=attempts), delay / 1000)
+        if dead:
+            self.dead_letters.insert(
+                dict(email, users=dead), attempts, '; '.join(
+                    '{}: {} {!r}'.format(user, *refused[user])
+                    for user in dead))
+        st.logger.error(
+            'Recipients refused, %d retried and %d dead: %r',
+            len(retry), len(dead), refused)
+
+    def archive(self, delivery):
+        """
+        Archives the delivery sent
+        :delivery: Delivery sent
+        """
+        self.archive_message(
+            delivery['exchange'],
+            delivery['date'],
+            delivery['users'],
+            delivery['subject'])
 
     def create_email(self, template, message):
         """
@@ -106,13 +337,9 @@ class BusConnectionHandler():
         :return: two params, subject and email text
         """
         subject = ''
-        if template.get('subject'):
-            subject_t = Template(
-                template.get('subject'),
-                undefined=SilentUndefined)
+        subject_t, text_t = self.template_cache.get(template)
+        if subject_t:
             subject = subject_t.render(message)
-
-        text_t = Template(template.get('text'), undefined=SilentUndefined)
         text = text_t.render(message)
 
         return subject, text
@@ -122,18 +349,11 @@ class BusConnectionHandler():
         Create email from default template
         :return: two params, subject and email text
         """
-        subject = ''
-        template = self.templates_handler.get_default_template()
-        if template.get('subject'):
-            subject_t = Template(
-                template.get('subject'),
-                undefined=SilentUndefined)
-            subject = subject_t.render(message)
-
-        text_t = Template(template.get('text'), undefined=SilentUndefined)
-        text = text_t.render(message)
-
-        return subject, text
+        template = self.routing.get_default_template()
+        if not template:
+            template = self.templates_handler.get(
+                self.templates_handler.get_default_template())
+        return self.create_email(template, message)
 
     def set_subscriptions(self, subscriptions):
         """
@@ -141,6 +361,15 @@ class BusConnectionHandler():
         """
         self.subscriptions = subscriptions
 
+    def bind(self, bus_filter):
+        """
+        Bind the queue to the exchange and key of a bus
+        filter in the running consumer
+        """
+        self.bus_thread.bind_queue(
+            bus_filter.get('exchange'), bus_filter.get('key'),
+            bus_filter.get('exchange_type'), bus_filter.get('durable'))
+
     def unbind(self, exchange, key):
         """
         Unbind the queue from exchange and key
@@ -154,20 +383,3 @@ class BusConnectionHandler():
         message = {'exchange': exchange, 'date': date, 'users': user_emails, 'description': description}
         self.messages_handler.insert(message)
 
-
-class SilentUndefined(Undefined):
-    """
-    Sorry about that. This class is created becasuse Jinja2 templates
-    raises error on undefined variables. This is a little hack to replace
-    undefined values with empty string
-    """
-
-    def _fail_with_undefined_error(self, *args, **kwargs):
-        return ''
-
-    __add__ = __radd__ = __mul__ = __rmul__ = __div__ = __rdiv__ = \
-        __truediv__ = __rtruediv__ = __floordiv__ = __rfloordiv__ = \
-        __mod__ = __rmod__ = __pos__ = __neg__ = __call__ = \
-        __getitem__ = __lt__ = __le__ = __gt__ = __ge__ = __int__ = \
-        __float__ = __complex__ = __pow__ = __rpow__ = \
-        _fail_with_undefined_error
@@ -19,6 +19,9 @@ class BusFilterSchema(Schema):
     description = fields.Str()
     category = fields.Str()
     template_id = fields.Str()
+    digest_window = fields.Int()
+    digest_max = fields.Int()
+    digest_template_id = fields.Str()
 
 
 class BusFiltersHandler():
@@ -29,7 +32,6 @@ class BusFiltersHandler():
 
     def __init__(self):
         self.db_handler = DBHandler("bus_filters")
-        self.db_handler.create_table()
 
     def get(self, key=None):
         """
@@ -55,6 +57,7 @@ class BusFiltersHandler():
         if isinstance(bus_filter, list):
             keys = []
             for bfilter in bus_filter:
+                bfilter = self.normalize(bfilter)
                 bus_filter_exits = self.get_by_exchange_key(
                     bfilter.get('exchange'), bfilter.get('key'))
                 if bus_filter_exits:
@@ -63,6 +66,7 @@ class BusFiltersHandler():
                     keys = keys + self.db_handler.insert_data(bfilter)
             return keys
 
+        bus_filter = self.normalize(bus_filter)
         bus_filter_to_insert = self.get_by_exchange_key(
             bus_filter.get('exchange'), bus_filter.get('key'))
         if bus_filter_to_insert:
@@ -75,6 +79,8 @@ class BusFiltersHandler():
         :bus_filter: Bus filter with data edited
         :bus_filter_id: Id of the bus filter to search
         """
+        if 'key' in bus_filter:
+            bus_filter = self.normalize(bus_filter)
         self.db_handler.edit_data(bus_filter, bus_filter_id)
 
     def delete(self, bus_filter_id):
@@ -90,18 +96,27 @@ class BusFiltersHandler():
         :exchange: Exchange param to search
         :key: Key param to search
         """
-        bus_filters = self.db_handler.filter_data(
-            {'exchange': exchange, 'key': key})
+        bus_filters = self.db_handler.get_all(
+            'exchange_key', [exchange, key or ''])
         if bus_filters:
             return bus_filters[0]
         return None
 
+    @staticmethod
+    def normalize(bus_filter):
+        """
+        Returns the bus filter with an empty key if it is missing or
+        null. Documents with a null field are left out of the compound
+        indexes, so they couldn't be found by exchange and key
+        """
+        return dict(bus_filter, key=bus_filter.get('key') or '')
+
     def delete_template(self, template_id):
         """
         Delete bus filter template and replace in the database
         """
-        bus_filters = self.db_handler.filter_data({'template_id': template_id})
+        bus_filters = self.db_handler.get_all('template_id', template_id)
         if bus_filters:
             for bus_filter in bus_filters:
                 del bus_filter['template_id']
-                self.db_handler.replace_data(bus_filter, bus_filter['id'])
+            self.db_handler.replace_many(bus_filters)
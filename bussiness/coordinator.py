@@ -0,0 +1,139 @@
+"""
+Coordinator election
+"""
+import os
+import socket
+import time
+import uuid
+from threading import Thread, Event, Lock
+
+import settings as st
+
+from bussiness.db_handler import DBHandler
+
+
+class Coordinator(Thread):
+    """
+    Elects a single coordinator between the processes sharing the
+    database with a lease stored in the leases table. The coordinator
+    renews the lease before it expires, and if it dies another process
+    takes it when it expires. A process that can't renew the lease stops
+    being the coordinator before the lease expires, so there are never
+    two coordinators at once. Listeners are called from the thread
+    of the coordinator when the process is elected or demoted
+    """
+
+    def __init__(self, name, duration):
+        """
+        :name: Name of the lease
+        :duration: Seconds the lease lasts. It is renewed every third
+        """
+        super(Coordinator, self).__init__(daemon=True)
+        self.name = name
+        self.duration = duration
+        self.owner = '{}-{}-{}'.format(
+            socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.leases = DBHandler('leases')
+        self.elected_listeners = []
+        self.demoted_listeners = []
+        self.stopped = Event()
+        self.lock = Lock()
+        self.expires = 0
+        self.leader = False
+        self.elections = 0
+        self.failed = 0
+
+    def on_elected(self, listener):
+        """
+        Registers a listener called when the process becomes coordinator
+        """
+        self.elected_listeners.append(listener)
+
+    def on_demoted(self, listener):
+        """
+        Registers a listener called when the process stops being coordinator
+        """
+        self.demoted_listeners.append(listener)
+
+    def is_leader(self):
+        """
+        True if the process holds the lease
+        """
+        with self.lock:
+            return self.leader and time.monotonic() < self.expires
+
+    def run(self):
+        """
+        Thread running. Takes or renews the lease until stopped
+        """
+        while not self.stopped.is_set():
+            started = time.monotonic()
+            try:
+                acquired = self.leases.acquire_lease(
+                    self.name, self.owner, self.duration)
+            except BaseException as error:
+                st.logger.error('Error renewing the %s lease: %r',
+                                self.name, error)
+                with self.lock:
+                    self.failed += 1
+                acquired = None
+            if acquired:
+                with self.lock:
+                    # Counted from before the request, the lease can't
+                    # expire in the database before it does here
+                    self.expires = started + self.duration
+            # If the database can't be reached the process keeps
+            # being the coordinator until his lease expires
+            self.update(self.is_leader() if acquired is None else acquired)
+            self.stopped.wait(self.duration / 3)
+        self.release()
+
+    def update(self, leader):
+        """
+        Calls the listeners when the process is elected or demoted
+        """
+        with self.lock:
+            changed = leader != self.leader
+            self.leader = leader
+            if changed and leader:
+                self.elections += 1
+        if not changed:
+            return
+        st.logger.info('%s %s coordinator of %s', self.owner,
+                       'is now' if leader else 'is no longer', self.name)
+        for listener in (self.elected_listeners if leader
+                         else self.demoted_listeners):
+            try:
+                listener()
+            except BaseException as error:
+                st.logger.error('Error in coordinator listener: %r', error)
+
+    def release(self):
+        """
+        Frees the lease so another process takes it without waiting
+        """
+        if not self.is_leader():
+            return
+        self.update(False)
+        try:
+            self.leases.release_lease(self.name, self.owner)
+        except BaseException as error:
+            st.logger.error('Error releasing the %s lease: %r',
+                            self.name, error)
+
+    def stop(self):
+        """
+        Stops the thread, which releases the lease
+        """
+        self.stopped.set()
+
+    def stats(self):
+        """
+        Returns the election state
+        """
+        with self.lock:
+            return {
+                'owner': self.owner,
+                'leader': self.leader and time.monotonic() < self.expires,
+                'elections': self.elections,
+                'failed': self.failed}
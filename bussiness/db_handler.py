@@ -1,11 +1,45 @@
 """
 Users handler
 """
+from threading import Lock
+
 import settings as st
+from utils import metrics
 from connectors.rethink import RethinkHandler
-from connectors.rethink_realtime import BDRealtime
+from connectors.sqlite import SQLiteHandler
+from connectors.memory import MemoryHandler
+
+_lock = Lock()
+_storage = None
+
 
-recreate_database = st.REFRESH_DATABASE
+def storage():
+    """
+    Returns the storage of the process for the backend configured:
+    rethink, sqlite or memory. Every storage has the methods
+    of RethinkHandler and a changes method with his changefeeds
+    """
+    global _storage
+    with _lock:
+        if _storage is None:
+            if st.DB_BACKEND == 'rethink':
+                _storage = RethinkHandler(
+                    st.DB_SERVER, st.DB_PORT, st.DB_NAME,
+                    st.DB_USER, st.DB_PASSWORD,
+                    query_timeout=st.DB_QUERY_TIMEOUT,
+                    min_size=st.DB_POOL_MIN,
+                    max_size=st.DB_POOL_MAX,
+                    wait_time=st.DB_RETRY_WAIT,
+                    n_retries=st.DB_RETRIES)
+            elif st.DB_BACKEND == 'sqlite':
+                _storage = SQLiteHandler(st.DB_PATH)
+            elif st.DB_BACKEND == 'memory':
+                _storage = MemoryHandler()
+            else:
+                raise ValueError(
+                    'Unknown database backend {}'.format(st.DB_BACKEND))
+            metrics.register('db', _storage.stats)
+        return _storage
 
 
 class DBHandler():
@@ -15,25 +49,9 @@ class DBHandler():
     """
 
     def __init__(self, table_name):
-        self.database = RethinkHandler(
-            st.DB_SERVER, st.DB_PORT, st.DB_NAME, st.DB_USER, st.DB_PASSWORD)
-        self.db_realtime = BDRealtime(st.DB_SERVER, st.DB_PORT, st.DB_NAME)
+        self.database = storage()
         self.table_name = table_name
 
-    def create_table(self, primary_key='id'):
-        """
-        Creates the table in database
-        regenerates if it already exists
-        :primary_key: Name of the primary key to create
-        """
-        global recreate_database
-        if recreate_database:
-            self.database.reset_database()
-            st.logger.info('Reseting the database...')
-            recreate_database = False
-        else:
-            self.database.create_table(self.table_name, primary_key)
-
     def get_data(self, key=None):
         """
         Get data from the database
@@ -47,6 +65,17 @@ class DBHandler():
             return data_list
         return data
 
+    def get_page(self, limit=None, start_after=None, fields=None):
+        """
+        Returns an iterator over the documents ordered by primary key.
+        Documents are read from the database while iterating
+        :limit: Maximum number of documents, all if not provided
+        :start_after: Primary key of the last document of the previous page
+        :fields: List of fields to return of every document
+        """
+        return self.database.get_page(
+            self.table_name, limit, start_after, fields)
+
     def get_data_streaming(self):
         """
         Get data from the database in realtime.
@@ -54,7 +83,7 @@ class DBHandler():
         This method blocks the current thread
         use this method in a separated thread
         """
-        return self.db_realtime.get_data(self.table_name)
+        return self.database.changes(self.table_name)
 
     def insert_data(self, data):
         """
@@ -98,6 +127,67 @@ class DBHandler():
         """
         self.database.delete_data(self.table_name, key_value)
 
+    def update_by_index(self, data, index, *values):
+        """
+        Modifies every document with a secondary index value
+        in a single query instead of one write per document
+        :data: Fields to modify
+        :index: Name of the secondary index
+        :values: Values to search
+        """
+        return self.database.update_by_index(
+            self.table_name, data, index, values)
+
+    def index_changes(self, index, value):
+        """
+        Returns an iterator over the changes of the documents
+        with a secondary index value
+        """
+        return self.database.index_changes(self.table_name, index, value)
+
+    def delete_by_index(self, index, *values):
+        """
+        Deletes every document with a secondary index value
+        in a single query instead of one write per document
+        :index: Name of the secondary index
+        :values: Values to search
+        """
+        return self.database.delete_by_index(self.table_name, index, values)
+
+    def replace_many(self, documents):
+        """
+        Replaces a list of documents in a single query
+        :documents: Documents with his primary key
+        """
+        return self.database.replace_many(self.table_name, documents)
+
+    def acquire_lease(self, name, owner, duration):
+        """
+        Takes or renews a lease of the table
+        :name: Id of the lease
+        :owner: Id of the process that wants the lease
+        :duration: Seconds the lease lasts
+        :return: True if the owner holds the lease
+        """
+        return self.database.acquire_lease(
+            self.table_name, name, owner, duration)
+
+    def release_lease(self, name, owner):
+        """
+        Frees a lease of the table if the owner holds it
+        """
+        return self.database.release_lease(self.table_name, name, owner)
+
+    def delete_between(self, index, lower, upper):
+        """
+        Delete data with the index value in a range
+        :index: Secondary index to use
+        :lower: Lower bound included, None for no lower bound
+        :upper: Upper bound excluded
+        """
+        return self.database.delete_between(
+            self.table_name, index, lower, upper)
+
     def filter_data(self, filter_params):
         """
         Filters data from the database
@@ -109,14 +199,33 @@ class DBHandler():
             data_list.append(entry)
         return data_list
 
-    def join_tables(self, table1, table2, table3, key1, key2):
+    def get_all(self, index, *values):
+        """
+        Gets data using a secondary index instead of scanning the table
+        :index: Name of the secondary index
+        :values: Values to search. For compound indexes each
+        value is a list with a value for each field
+        """
+        data = self.database.get_all(self.table_name, index, values)
+        data_list = []
+        for entry in data:
+            data_list.append(entry)
+        return data_list
+
+    def join_tables(self, table1, table2, table3, key1, key2,
+                    limit=None, start_after=None, fields=None):
         """
-        Joins two tables
+        Joins two tables. Returns an iterator over the joined documents
         :table1: Table with the foreign keys
         :table2: Lelft table to join
         :table3: Right table to join
         :key1: Foering key from the left table
         :key2: Foering key for the right table
+        :limit: Maximum number of documents, all if not provided
+        :start_after: Primary key in table1 of the last document of the
+        previous page
+        :fields: List of fields to return of every document
         """
 
-        return self.database.join_tables(table1, table2, table3, key1, key2)
+        return self.database.join_tables(
+            table1, table2, table3, key1, key2, limit, start_after, fields)
@@ -0,0 +1,100 @@
+"""
+Dead letters handler
+"""
+from marshmallow import Schema, fields
+
+from bussiness.db_handler import DBHandler
+from utils import dates
+
+DEAD = 'dead'
+REPLAYING = 'replaying'
+
+
+class ReplaySchema(Schema):
+    """
+    Replay schema to validate the dead letters to replay
+    """
+    ids = fields.List(fields.Str())
+    all = fields.Boolean()
+
+
+class DeadLettersHandler():
+    """
+    Dead letters handler class. Dead letters are the emails that could
+    not be sent after every retry. They are kept in the database to
+    inspect them and to replay them when the problem is solved
+    """
+
+    def __init__(self):
+        self.db_handler = DBHandler("dead_letters")
+
+    def get(self, key=None):
+        """
+        Get all dead letters from the database
+        :key: Dead letter id to search for if provided
+        """
+        return self.db_handler.get_data(key)
+
+    def get_page(self, limit=None, start_after=None, fields=None):
+        """
+        Get the dead letters ordered by id. Returns an iterator
+        that reads them from the database while iterating
+        :limit: Maximum number of dead letters, all if not provided
+        :start_after: Id of the last dead letter of the previous page
+        :fields: List of fields to return of every dead letter
+        """
+        return self.db_handler.get_page(limit, start_after, fields)
+
+    def insert(self, delivery, attempts, error):
+        """
+        Insert the delivery that could not be sent as a dead letter
+        :delivery: Delivery rendered
+        :attempts: Number of times it was tried
+        :error: Last error
+        """
+        dead_letter = {
+            key: value for key, value in delivery.items() if key != 'date'}
+        dead_letter.update({
+            'state': DEAD,
+            'attempts': attempts,
+            'error': error,
+            'date': dates.utc_now()})
+        return self.db_handler.insert_data(dead_letter)
+
+    def delete(self, dead_letter_id):
+        """
+        Delete dead letter by his id
+        :dead_letter_id: Dead letter id to search for
+        """
+        return self.db_handler.delete_data(dead_letter_id)
+
+    def replay(self, dead_letter_ids=None):
+        """
+        Marks dead letters to be sent again. The coordinator of the
+        processes sending emails puts them back in his outbox
+        :dead_letter_ids: Ids to replay. If not provided every
+        dead letter is replayed. Both are marked in a single query
+        :return: Number of dead letters marked
+        """
+        if dead_letter_ids is not None and not dead_letter_ids:
+            return 0
+        if dead_letter_ids is None:
+            result = self.db_handler.update_by_index(
+                {'state': REPLAYING}, 'state', DEAD)
+        else:
+            result = self.db_handler.update_by_index(
+                {'state': REPLAYING}, 'id', *dead_letter_ids)
+        return result.get('replaced', 0)
+
+    def get_replaying(self):
+        """
+        Returns the dead letters marked to be sent again
+        """
+        return self.db_handler.get_all('state', REPLAYING)
+
+    def replaying_changes(self):
+        """
+        Returns an iterator over the changes of the dead letters
+        marked to be sent again. The rest are never read
+        """
+        return self.db_handler.index_changes('state', REPLAYING)
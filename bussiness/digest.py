@@ -0,0 +1,202 @@
+"""
+Digest buffer. Coalesces the messages sent to a recipient over a window
+"""
+import time
+from threading import Thread, Lock
+
+import errors
+
+
+class Digest():
+    """
+    Messages accumulated for a recipient
+    """
+
+    def __init__(self, key, recipient, bus_filter, template_id, max_items,
+                 deadline):
+        self.key = key
+        self.recipient = recipient
+        self.bus_filter = bus_filter
+        self.template_id = template_id
+        self.max_items = max_items
+        self.deadline = deadline
+        self.messages = []
+        # Ids of the messages in the store
+        self.buffered = []
+
+
+class DigestBuffer():
+    """
+    Buffer of digests. Digests are grouped in time buckets by their
+    deadline, so the flusher only looks at the buckets that are due.
+    A digest is flushed when its window ends or when it reaches his
+    maximum number of messages. If the buffer holds more messages than
+    allowed the oldest bucket is flushed early to keep memory bounded.
+
+    With a store every message is written to it before add returns, and
+    on_flush deletes the messages of the digest when it is stored, so
+    the messages acknowledged are not lost if the process stops before
+    the window ends. The digests buffered are loaded again by the
+    flusher thread when it starts, keeping their deadlines. A digest
+    that fails to flush stays in the store until the next start
+    """
+
+    def __init__(self, on_flush, max_pending, resolution=1, store=None):
+        """
+        :on_flush: Callable that receives every digest flushed
+        :max_pending: Maximum number of messages in the buffer
+        :resolution: Seconds covered by each time bucket
+        :store: Outbox where the messages are buffered
+        """
+        self.on_flush = on_flush
+        self.max_pending = max_pending
+        self.resolution = resolution
+        self.store = store
+        self.lock = Lock()
+        self.digests = {}
+        self.buckets = {}
+        self.pending = 0
+        self.flushed = 0
+        self.restored = 0
+        Thread(target=self.run, name='digest', daemon=True).start()
+
+    def restore(self):
+        """
+        Loads the messages buffered in the store
+        :return: List of digests to flush
+        """
+        ready = []
+        for message_id, key, fields, message in self.store.buffered():
+            # Keys are tuples, stored as json lists
+            key = tuple(key) if isinstance(key, list) else key
+            # Deadlines are stored as wall clock time
+            deadline = time.monotonic() + fields['deadline'] - time.time()
+            ready.extend(self.append(
+                key, fields['recipient'], fields['bus_filter'],
+                fields['template_id'], fields['max_items'], deadline,
+                message, message_id))
+            with self.lock:
+                self.restored += 1
+        return ready
+
+    def add(self, key, recipient, bus_filter, template_id, window,
+            max_items, message):
+        """
+        Adds a message to the digest of the key
+        :key: Key identifying the digest
+        :recipient: Email the digest is sent to
+        :bus_filter: Bus filter the message comes from
+        :template_id: Digest template id, None for default one
+        :window: Seconds to accumulate messages
+        :max_items: Messages after which the digest is sent
+        :message: Message received from the bus
+        """
+        message_id = None
+        if self.store:
+            # The deadline stored is the one of a new digest, the
+            # first message stored of a digest decides it
+            message_id = self.store.buffer(key, {
+                'recipient': recipient,
+                'bus_filter': bus_filter,
+                'template_id': template_id,
+                'max_items': max_items,
+                'deadline': time.time() + window}, message)
+        self.flush(self.append(
+            key, recipient, bus_filter, template_id, max_items,
+            time.monotonic() + window, message, message_id))
+
+    def append(self, key, recipient, bus_filter, template_id, max_items,
+               deadline, message, message_id):
+        """
+        Adds a message to the digest of the key, creating it
+        with the deadline if it doesn't exist
+        :message_id: Id of the message in the store
+        :return: List of digests to flush
+        """
+        ready = []
+        with self.lock:
+            digest = self.digests.get(key)
+            if not digest:
+                digest = Digest(
+                    key, recipient, bus_filter, template_id, max_items,
+                    deadline)
+                self.digests[key] = digest
+                self.buckets.setdefault(
+                    self.slot(deadline), set()).add(key)
+            digest.messages.append(message)
+            if message_id is not None:
+                digest.buffered.append(message_id)
+            self.pending += 1
+            if max_items and len(digest.messages) >= max_items:
+                ready.append(self.pop(key))
+            elif self.pending > self.max_pending:
+                ready = self.pop_bucket(min(self.buckets))
+        return ready
+
+    def run(self):
+        """
+        Flusher thread. Loads the digests of the store and
+        flushes the buckets that are due
+        """
+        if self.store:
+            self.flush(self.restore())
+        while True:
+            time.sleep(self.resolution)
+            now = self.slot(time.monotonic())
+            ready = []
+            with self.lock:
+                for slot in [s for s in self.buckets if s <= now]:
+                    ready = ready + self.pop_bucket(slot)
+            self.flush(ready)
+
+    def flush(self, digests):
+        """
+        Calls on_flush for every digest. A digest that fails is logged
+        and dropped, so it doesn't stop the flusher thread nor fails
+        the message that triggered the flush
+        """
+        for digest in digests:
+            try:
+                self.on_flush(digest)
+            except BaseException as error:
+                errors.process_exception(error, body=digest.recipient)
+        with self.lock:
+            self.flushed += len(digests)
+
+    def pop(self, key):
+        """
+        Removes a digest from the buffer. Must be called with the lock held
+        """
+        digest = self.digests.pop(key)
+        slot = self.slot(digest.deadline)
+        bucket = self.buckets[slot]
+        bucket.discard(key)
+        if not bucket:
+            del self.buckets[slot]
+        self.pending -= len(digest.messages)
+        return digest
+
+    def pop_bucket(self, slot):
+        """
+        Removes every digest of a bucket. Must be called with the lock held
+        """
+        return [self.pop(key) for key in list(self.buckets[slot])]
+
+    def slot(self, deadline):
+        """
+        Time bucket of a deadline
+        """
+        return int(deadline // self.resolution)
+
+    def stats(self):
+        """
+        Returns buffer counters
+        """
+        with self.lock:
+            return {
+                'digests': len(self.digests),
+                'buckets': len(self.buckets),
+                'pending': self.pending,
+                'max_pending': self.max_pending,
+                'flushed': self.flushed,
+                'restored': self.restored}
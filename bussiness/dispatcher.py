@@ -0,0 +1,170 @@
+"""
+Dispatch pipeline
+"""
+import queue
+from threading import Thread, Lock
+
+import settings as st
+
+
+class Stage():
+    """
+    Stage of the dispatch pipeline. Items are put in a bounded queue
+    and processed by a pool of worker threads. The result of the handler,
+    if any, is passed to the next stage. If the result is a list each
+    of its items is passed. When the queue is full put blocks,
+    so a slow stage pushes back on the stages before it.
+    """
+
+    def __init__(self, name, handler, workers, queue_size, on_error=None):
+        """
+        :name: Name of the stage
+        :handler: Callable that processes an item and returns the item
+        or list of items for the next stage or None
+        :workers: Number of worker threads
+        :queue_size: Maximum number of items waiting in the stage
+        :on_error: Callable called with the item and the error
+        when the handler fails
+        """
+        self.name = name
+        self.handler = handler
+        self.on_error = on_error
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.next_stage = None
+        self.threads = []
+        self.lock = Lock()
+        self.processed = 0
+        self.failed = 0
+
+    def start(self):
+        """
+        Starts the worker threads
+        """
+        for i in range(self.workers):
+            thread = Thread(
+                target=self.work,
+                name='{}-{}'.format(self.name, i),
+                daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def put(self, item):
+        """
+        Puts an item in the stage queue. Blocks while the queue is full
+        """
+        self.queue.put(item)
+
+    def work(self):
+        """
+        Worker thread loop
+        """
+        while True:
+            item = self.queue.get()
+            try:
+                result = self.handler(item)
+                if result is not None and self.next_stage:
+                    if isinstance(result, list):
+                        for next_item in result:
+                            self.next_stage.put(next_item)
+                    else:
+                        self.next_stage.put(result)
+                with self.lock:
+                    self.processed += 1
+            except BaseException as error:
+                with self.lock:
+                    self.failed += 1
+                st.logger.error(
+                    'Error in %s stage: %r', self.name, error)
+                if self.on_error:
+                    self.on_error(item, error)
+            finally:
+                self.queue.task_done()
+
+    def stats(self):
+        """
+        Returns stage counters
+        """
+        with self.lock:
+            return {
+                'depth': self.queue.qsize(),
+                'max_size': self.queue.maxsize,
+                'workers': self.workers,
+                'processed': self.processed,
+                'failed': self.failed}
+
+
+class Tracker():
+    """
+    Counts the items generated from a message that are still in the
+    pipeline. The message counts as an item until the first stage ends
+    with it. When the last item ends on_done is called with True,
+    or with False if any of them failed
+    """
+
+    def __init__(self, on_done):
+        """
+        :on_done: Callable called once with the result of the message
+        """
+        self.on_done = on_done
+        self.lock = Lock()
+        self.pending = 1
+        self.failed = False
+
+    def add(self, count):
+        """
+        Counts new items generated from the message
+        """
+        with self.lock:
+            self.pending += count
+
+    def done(self, success=True):
+        """
+        Ends an item
+        :success: False if the item failed
+        """
+        with self.lock:
+            self.pending -= 1
+            self.failed = self.failed or not success
+            finished = self.pending == 0
+        if finished:
+            self.on_done(not self.failed)
+
+    def fail(self):
+        """
+        Ends an item that failed
+        """
+        self.done(False)
+
+
+class Pipeline():
+    """
+    Chain of stages. Items submitted go through every stage in order
+    """
+
+    def __init__(self, stages):
+        """
+        :stages: Stages in the order items go through them
+        """
+        self.stages = stages
+        for stage, next_stage in zip(stages, stages[1:]):
+            stage.next_stage = next_stage
+
+    def start(self):
+        """
+        Starts every stage
+        """
+        for stage in self.stages:
+            stage.start()
+
+    def submit(self, item):
+        """
+        Puts an item in the first stage. Blocks while it is full
+        """
+        self.stages[0].put(item)
+
+    def stats(self):
+        """
+        Returns the counters of every stage
+        """
+        return {stage.name: stage.stats() for stage in self.stages}
@@ -1,13 +1,11 @@
-import re
-from marshmallow import Schema, fields
-
-import settings as st
 import datetime
-import dateutil.parser
+from threading import Thread, Event
 
-import rethinkdb as r
+import settings as st
 
+from bussiness import registry
 from bussiness.db_handler import DBHandler
+from utils import dates
 
 
 class MessagesHandler():
@@ -18,7 +16,6 @@ class MessagesHandler():
 
     def __init__(self):
         self.db_handler = DBHandler("messages")
-        self.db_handler.create_table()
 
     def get(self, key=None):
         """
@@ -26,21 +23,22 @@ class MessagesHandler():
         :template_id: Template id to search for if provided
         """
         return self.db_handler.get_data(key)
-    
+
+    def get_page(self, limit=None, start_after=None, fields=None):
+        """
+        Get the messages ordered by id. Returns an iterator
+        that reads them from the database while iterating
+        :limit: Maximum number of messages, all if not provided
+        :start_after: Id of the last message of the previous page
+        :fields: List of fields to return of every message
+        """
+        return self.db_handler.get_page(limit, start_after, fields)
+
     def insert(self, msgs):
         """
         Insert message to the database
         :message: message to insert
         """
-        messages = self.get()
-        for message in messages:
-            today = datetime.datetime.today()
-            week_before = today - datetime.timedelta(days=7)
-            date =  datetime.datetime.timestamp(week_before)
-            message_date = datetime.datetime.timestamp(dateutil.parser.parse(message['date']))
-            if (date > message_date):
-                self.delete(message['id'])
-
         return self.db_handler.insert_data(msgs)
 
     def delete(self, message_id):
@@ -48,4 +46,48 @@ class MessagesHandler():
         Delete message by his id
         :message_id: Message id to search for
         """
-        self.db_handler.delete_data(message_id)
\ No newline at end of file
+        self.db_handler.delete_data(message_id)
+
+    def delete_older_than(self, date):
+        """
+        Delete every message archived before the date
+        :date: Datetime with timezone
+        """
+        return self.db_handler.delete_between(
+            'date', None, dates.to_utc(date))
+
+
+class MessagesRetention(Thread):
+    """
+    Background job that periodically deletes
+    the messages older than the retention window
+    """
+
+    def __init__(self, retention_days, interval):
+        """
+        :retention_days: Days a message is kept in the archive
+        :interval: Seconds between executions
+        """
+        super(MessagesRetention, self).__init__(daemon=True)
+        self.retention = datetime.timedelta(days=retention_days)
+        self.interval = interval
+        self.stopped = Event()
+        self.messages = registry.get(MessagesHandler)
+
+    def run(self):
+        """
+        Thread running. Deletes expired messages until stopped
+        """
+        while not self.stopped.is_set():
+            try:
+                now = datetime.datetime.now(datetime.timezone.utc)
+                self.messages.delete_older_than(now - self.retention)
+            except BaseException as error:
+                st.logger.error('Error deleting old messages: %r', error)
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        """
+        Stops the job
+        """
+        self.stopped.set()
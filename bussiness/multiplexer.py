@@ -0,0 +1,338 @@
+"""
+Changefeed multiplexer
+"""
+import queue
+import time
+from threading import Thread, Lock
+
+import settings as st
+
+
+class ChangeMultiplexer():
+    """
+    Single changefeed over several tables. A reader thread puts the
+    changes in a bounded queue and a dispatcher thread calls the listeners
+    of each table in the order the changes were received, so every cache
+    is built from the same ordered source. With include_initial the
+    documents stored are sent first as changes marked as initial.
+
+    When the changefeed fails it is reopened with backoff. Changefeeds
+    can't be resumed from where they stopped, so the documents are read
+    again and compared with the ones the listeners hold: only the
+    documents added, edited or deleted during the gap are sent to the
+    listeners as changes, instead of reloading everything. The tables
+    have no time of the last change, so every reconnection reads them
+    once, streamed by the cursor. Only the ids of the documents read are
+    kept meanwhile, the documents are never copied.
+
+    Changes are dispatched in batches: the changes received during the
+    coalesce window are merged by document, so a burst of changes of the
+    same document reaches the listeners as a single change, and the
+    batch listeners are called once after each batch.
+    """
+
+    def __init__(self, database, table_names, documents,
+                 include_initial=True, queue_size=1000, retry_wait=100,
+                 max_retry_wait=30000, coalesce_window=0):
+        """
+        :database: Storage with a changefeed method
+        :table_names: Tables to listen to
+        :documents: Callable that returns a dict by id with the documents
+        of a table held by the listeners, to compare the ones read again.
+        It is only called from the dispatcher thread, the one updating it
+        :include_initial: Sends the documents stored before the changes
+        :queue_size: Maximum number of changes waiting for the listeners
+        :retry_wait: Milliseconds to wait before reopening the changefeed.
+        It doubles on every failure up to max_retry_wait
+        :coalesce_window: Milliseconds to wait for more changes
+        before dispatching a batch. With 0 changes are not merged
+        """
+        self.database = database
+        self.table_names = list(table_names)
+        self.include_initial = include_initial
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.retry_wait = retry_wait
+        self.max_retry_wait = max_retry_wait
+        self.coalesce_window = coalesce_window
+        self.listeners = {}
+        self.batch_listeners = []
+        self.ready_listeners = []
+        self.batch = {}
+        self.pending = set(self.table_names)
+        self.resyncing = set()
+        self.seen = {}
+        self.documents = documents
+        self.lock = Lock()
+        self.received = 0
+        self.failed = 0
+        self.reconnections = 0
+        self.resync_started = None
+        self.resync_seconds = None
+        self.resync_changes = 0
+        self.lag = 0
+        self.max_lag = 0
+        self.batches = 0
+        self.coalesced = 0
+
+    def listen(self, table_name, listener):
+        """
+        Registers a listener of the changes of a table. Listeners are
+        called in the order they are registered with the change, that has
+        the old_val, the new_val and initial, True if the document was
+        stored before the changefeed started
+        """
+        self.listeners.setdefault(table_name, []).append(listener)
+
+    def on_batch(self, listener):
+        """
+        Registers a function called without params after the
+        listeners of every batch of changes have been called
+        """
+        self.batch_listeners.append(listener)
+
+    def on_ready(self, listener):
+        """
+        Registers a function called without params when
+        the initial documents of every table have been sent
+        """
+        self.ready_listeners.append(listener)
+
+    def start(self):
+        """
+        Starts the reader and dispatcher threads
+        """
+        Thread(target=self.read, name='changefeed-reader', daemon=True).start()
+        Thread(
+            target=self.dispatch, name='changefeed-dispatcher',
+            daemon=True).start()
+
+    def read(self):
+        """
+        Reader thread. Puts the changes of the changefeed in the queue with
+        the time they were received. Reopens the changefeed when it fails
+        """
+        include_initial = self.include_initial
+        wait = self.retry_wait
+        while True:
+            cursor = None
+            try:
+                cursor = self.database.changefeed(
+                    self.table_names, include_initial)
+                for change in cursor:
+                    wait = self.retry_wait
+                    self.queue.put((time.monotonic(), change))
+            except BaseException as error:
+                st.logger.error(
+                    'Changefeed lost, reconnecting in %dms: %r', wait, error)
+            finally:
+                if cursor is not None:
+                    try:
+                        cursor.close()
+                    except BaseException:
+                        pass
+
+            time.sleep(wait / 1000)
+            wait = min(wait * 2, self.max_retry_wait)
+            with self.lock:
+                self.reconnections += 1
+            # The documents read again are compared with the known ones
+            include_initial = True
+            self.queue.put((time.monotonic(), {'state': 'resync'}))
+
+    def next_batch(self):
+        """
+        Waits for a change and returns it with the ones received
+        during the coalesce window, up to the size of the queue
+        """
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.coalesce_window / 1000
+        while len(batch) < self.queue.maxsize:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def dispatch(self):
+        """
+        Dispatcher thread. Calls the listeners of every batch of changes
+        """
+        while True:
+            for received, change in self.next_batch():
+                with self.lock:
+                    self.received += 1
+                    self.lag = time.monotonic() - received
+                    self.max_lag = max(self.max_lag, self.lag)
+                self.process(change)
+            self.flush()
+
+    def process(self, change):
+        """
+        Adds a change to the batch or handles a state change
+        """
+        table_name = change.get('table')
+        state = change.get('state')
+        if state:
+            # Listeners get every change received before a state
+            self.flush()
+            if state == 'resync':
+                self.start_resync()
+            elif state == 'ready':
+                self.table_ready(table_name)
+        elif table_name in self.resyncing and 'old_val' not in change:
+            # Documents read again don't have old_val
+            self.resync(table_name, change['new_val'])
+        else:
+            if table_name in self.resyncing:
+                self.seen[table_name].update(
+                    val['id'] for val in (
+                        change.get('old_val'), change.get('new_val'))
+                    if val)
+            change.setdefault('old_val', None)
+            change['initial'] = table_name in self.pending
+            self.notify(table_name, change)
+
+    def notify(self, table_name, change):
+        """
+        Adds the change to the batch, merged with the
+        previous change of the same document
+        """
+        document = change.get('new_val') or change.get('old_val')
+        key = (table_name, document['id'])
+        previous = self.batch.get(key)
+        if previous:
+            with self.lock:
+                self.coalesced += 1
+            change = {
+                'old_val': previous['old_val'],
+                'new_val': change.get('new_val'),
+                'initial': previous['initial'] and change['initial']}
+        self.batch[key] = change
+        if not self.coalesce_window:
+            self.flush()
+
+    def flush(self):
+        """
+        Calls the listeners of the changes of the batch and then the batch
+        listeners. Documents that end as they were are skipped
+        """
+        if not self.batch:
+            return
+        batch = self.batch
+        self.batch = {}
+        for (table_name, key), change in batch.items():
+            if change['old_val'] == change['new_val']:
+                continue
+            for listener in self.listeners.get(table_name, []):
+                try:
+                    listener(change)
+                except BaseException as error:
+                    with self.lock:
+                        self.failed += 1
+                    st.logger.error(
+                        'Error processing %s change: %r', table_name, error)
+
+        with self.lock:
+            self.batches += 1
+        for listener in self.batch_listeners:
+            try:
+                listener()
+            except BaseException as error:
+                st.logger.error('Error processing changes: %r', error)
+
+    def start_resync(self):
+        """
+        Starts comparing the documents of the reopened changefeed
+        with the ones of the listeners. Tables still loading are compared
+        too, with the documents loaded before the changefeed was lost
+        """
+        self.seen = {table_name: set() for table_name in self.table_names}
+        with self.lock:
+            self.resyncing = set(self.table_names)
+            self.resync_started = time.monotonic()
+            self.resync_changes = 0
+
+    def resync(self, table_name, document):
+        """
+        Sends a change if the document read again is new or different
+        from the one of the listeners, or the one of the batch if the
+        listeners haven't received it yet
+        """
+        self.seen[table_name].add(document['id'])
+        old_val = self.known(table_name, document['id'])
+        if old_val != document:
+            with self.lock:
+                self.resync_changes += 1
+            self.notify(table_name, {
+                'old_val': old_val, 'new_val': document,
+                'initial': table_name in self.pending})
+
+    def table_ready(self, table_name):
+        """
+        Marks the initial documents of a table as sent. If the table was
+        being resynced, sends the deletion of the documents not read again
+        """
+        if table_name in self.resyncing:
+            with self.lock:
+                self.resyncing.discard(table_name)
+            seen = self.seen.pop(table_name)
+            known = self.documents(table_name)
+            for key in [key for key in known if key not in seen]:
+                old_val = self.known(table_name, key)
+                if old_val:
+                    with self.lock:
+                        self.resync_changes += 1
+                    self.notify(table_name, {
+                        'old_val': old_val, 'new_val': None,
+                        'initial': table_name in self.pending})
+            if not self.resyncing:
+                with self.lock:
+                    self.resync_seconds = (
+                        time.monotonic() - self.resync_started)
+                st.logger.info(
+                    'Changefeed resynced in %.2fs with %d changes',
+                    self.resync_seconds, self.resync_changes)
+
+        with self.lock:
+            if table_name not in self.pending:
+                return
+            self.pending.discard(table_name)
+            ready = not self.pending
+        if ready:
+            for listener in self.ready_listeners:
+                try:
+                    listener()
+                except BaseException as error:
+                    st.logger.error('Error starting realtime: %r', error)
+
+    def known(self, table_name, key):
+        """
+        Returns the last version received of a document
+        """
+        previous = self.batch.get((table_name, key))
+        if previous:
+            return previous['new_val']
+        return self.documents(table_name).get(key)
+
+    def stats(self):
+        """
+        Returns multiplexer counters
+        """
+        with self.lock:
+            return {
+                'tables': self.table_names,
+                'pending_initial': sorted(self.pending),
+                'depth': self.queue.qsize(),
+                'received': self.received,
+                'failed': self.failed,
+                'reconnections': self.reconnections,
+                'resyncing': sorted(self.resyncing),
+                'last_resync_seconds': self.resync_seconds,
+                'last_resync_changes': self.resync_changes,
+                'lag_seconds': self.lag,
+                'max_lag_seconds': self.max_lag,
+                'batches': self.batches,
+                'coalesced': self.coalesced}
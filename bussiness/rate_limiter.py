@@ -0,0 +1,157 @@
+"""
+Outbound email rate limiter
+"""
+import time
+from threading import Lock
+
+
+class TokenBucket():
+    """
+    Token bucket. Tokens are refilled continuously at rate per second
+    up to the capacity of the bucket. A request larger than the capacity
+    waits for a full bucket and leaves it in debt, with negative tokens,
+    so the next requests wait until the debt is paid off
+    """
+
+    def __init__(self, rate, capacity):
+        """
+        :rate: Tokens refilled per second
+        :capacity: Maximum number of tokens, the allowed burst
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        """
+        Adds the tokens refilled since the last update
+        """
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, tokens):
+        """
+        Seconds to wait until the tokens are available. Requests larger
+        than the capacity only wait for a full bucket
+        """
+        missing = min(tokens, self.capacity) - self.tokens
+        if missing <= 0:
+            return 0
+        return missing / self.rate
+
+    def take(self, tokens):
+        """
+        Takes the tokens from the bucket, that can be left in debt
+        """
+        self.tokens -= tokens
+
+    def is_full(self):
+        """
+        True if the bucket has all his tokens
+        """
+        return self.tokens >= self.capacity
+
+
+class RateLimiter():
+    """
+    Rate limiter with a global token bucket and a token bucket per
+    recipient domain. Every recipient of an email takes a token from
+    the global bucket and from the bucket of his domain. acquire blocks
+    until there are tokens, so senders slow down instead of failing.
+    """
+
+    def __init__(self, global_rate, global_burst, domain_rate, domain_burst,
+                 max_domains=1000):
+        """
+        :global_rate: Recipients per minute for all the domains, 0 disables it
+        :global_burst: Recipients that can be sent at once
+        :domain_rate: Recipients per minute for each domain, 0 disables it
+        :domain_burst: Recipients of a domain that can be sent at once
+        :max_domains: Domain buckets kept before dropping the full ones
+        """
+        self.lock = Lock()
+        self.global_bucket = None
+        if global_rate:
+            self.global_bucket = TokenBucket(global_rate / 60, global_burst)
+        self.domain_rate = domain_rate / 60
+        self.domain_burst = domain_burst
+        self.max_domains = max_domains
+        self.domains = {}
+        self.waits = 0
+        self.waited = 0
+
+    def acquire(self, recipients):
+        """
+        Blocks until every recipient can be sent
+        :recipients: List of emails
+        """
+        needed = self.tokens_needed(recipients)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                wait = 0
+                for bucket, tokens in needed:
+                    bucket.refill(now)
+                    wait = max(wait, bucket.wait_time(tokens))
+                if not wait:
+                    for bucket, tokens in needed:
+                        bucket.take(tokens)
+                    return
+                self.waits += 1
+                self.waited += wait
+            time.sleep(wait)
+
+    def tokens_needed(self, recipients):
+        """
+        Returns a list of tuples (bucket, tokens) for the recipients
+        """
+        needed = []
+        if self.global_bucket:
+            needed.append((self.global_bucket, len(recipients)))
+        if self.domain_rate:
+            domains = {}
+            for recipient in recipients:
+                domain = recipient.rsplit('@', 1)[-1].lower()
+                domains[domain] = domains.get(domain, 0) + 1
+            with self.lock:
+                for domain, tokens in domains.items():
+                    needed.append((self.domain_bucket(domain), tokens))
+        return needed
+
+    def domain_bucket(self, domain):
+        """
+        Returns the bucket of a domain. Must be called with the lock held
+        """
+        bucket = self.domains.get(domain)
+        if not bucket:
+            if len(self.domains) >= self.max_domains:
+                now = time.monotonic()
+                for name, old in list(self.domains.items()):
+                    old.refill(now)
+                    if old.is_full():
+                        del self.domains[name]
+            bucket = TokenBucket(self.domain_rate, self.domain_burst)
+            self.domains[domain] = bucket
+        return bucket
+
+    def stats(self):
+        """
+        Returns limiter state
+        """
+        with self.lock:
+            now = time.monotonic()
+            domains = {}
+            for domain, bucket in self.domains.items():
+                bucket.refill(now)
+                domains[domain] = bucket.tokens
+            global_tokens = None
+            if self.global_bucket:
+                self.global_bucket.refill(now)
+                global_tokens = self.global_bucket.tokens
+            return {
+                'global_tokens': global_tokens,
+                'domain_tokens': domains,
+                'waits': self.waits,
+                'waited_seconds': self.waited}
@@ -1,151 +1,301 @@
 """
 Realtime module
 """
-from threading import Thread
+import time
+from threading import Thread, Lock
 
-from exceptions.db_exceptions import ConnectionLost
+import settings as st
+from utils import metrics
 
 from bussiness.bus_connection import BusConnectionHandler
 
+from bussiness import registry
+from bussiness.db_handler import storage, DBHandler
+from bussiness.multiplexer import ChangeMultiplexer
+from bussiness.bindings import BusBindings
 from bussiness.bus_filters import BusFiltersHandler
+from bussiness.dead_letters import DeadLettersHandler, REPLAYING
 from bussiness.subscriptions import SubscriptionsHandler
 from bussiness.templates import TemplatesHandler
+from bussiness.users import UsersHandler
+from bussiness.routing import RoutingIndex
+from bussiness.template_cache import TemplateCache
 
 
 class Realtime():
     """
-    Realtime class
+    Realtime class. Listens to the changes of the tables in a single
+    changefeed that also loads the routing index when it starts.
+    The bus queue is bound to the bus filters with subscriptions and
+    only the bindings added or removed are applied to the consumer.
+
+    When several processes consume the same queue only the one elected
+    by the coordinator binds and unbinds it, and records the bindings
+    in the database. When it is elected it unbinds the bindings recorded
+    that are no longer needed and binds the queue to every binding, in
+    case the previous one didn't apply the last changes. The coordinator
+    is also the only one that cascades the changes of bus filters and
+    templates and puts back in his outbox the dead letters marked to
+    be replayed. Dead letters have their own changefeed of the ones
+    marked, so the rest are never loaded
     """
 
-    def __init__(self):
-        self.filters = BusFiltersHandler()
-        self.subscriptions = SubscriptionsHandler()
-        self.templates = TemplatesHandler()
-        Thread(target=self.realtime_subscriptions).start()
-        Thread(target=self.realtime_filters).start()
-        Thread(target=self.realtime_templates).start()
+    tables = ['users', 'templates', 'bus_filters', 'subscriptions']
 
-    def realtime_subscriptions(self):
+    def __init__(self, coordinator=None):
         """
-        Realtime subscriptions.
-        If a subscription is removed, the bus connection stops
-        If a subscription is updated, recreates the thread
+        :coordinator: Coordinator of the processes sharing the queue.
+        Without it the process binds the queue on his own
         """
-        self.start_connection()
+        self.filters = registry.get(BusFiltersHandler)
+        self.subscriptions = registry.get(SubscriptionsHandler)
+        self.templates = registry.get(TemplatesHandler)
+        self.users = registry.get(UsersHandler)
+        self.dead_letters = registry.get(DeadLettersHandler)
+        self.queue_bindings = DBHandler('queue_bindings')
+        self.routing = RoutingIndex()
+        self.template_cache = TemplateCache(st.TEMPLATE_CACHE_SIZE)
+        metrics.register('template_cache', self.template_cache.stats)
+        self.bindings = BusBindings()
+        self.binding_deltas = {}
+        metrics.register('bindings', self.bindings.stats)
+        self.bus_thread = None
+        self.bus_lock = Lock()
+        self.coordinator = coordinator
+        if coordinator:
+            coordinator.on_elected(self.reconcile_bindings)
+            coordinator.on_elected(self.replay_dead_letters)
+            metrics.register('coordinator', coordinator.stats)
 
-        cursor = self.subscriptions.get_realtime()
+        self.changes = ChangeMultiplexer(
+            storage(), self.tables, self.routing.documents,
+            include_initial=True,
+            queue_size=st.REALTIME_QUEUE_SIZE,
+            retry_wait=st.REALTIME_RETRY_WAIT,
+            max_retry_wait=st.REALTIME_MAX_RETRY_WAIT,
+            coalesce_window=st.REALTIME_COALESCE_WINDOW)
+        metrics.register('changefeed', self.changes.stats)
+        for table_name in self.tables:
+            self.changes.listen(table_name, self.routing_listener(table_name))
+        for table_name in ['bus_filters', 'subscriptions']:
+            self.changes.listen(
+                table_name, self.bindings_listener(table_name))
+        self.changes.listen('bus_filters', self.realtime_filters)
+        self.changes.listen('templates', self.realtime_templates)
+        self.changes.on_batch(self.apply_bindings)
+        self.changes.on_ready(self.start_connection)
+        self.changes.start()
+        Thread(target=self.listen_replays, name='replays',
+               daemon=True).start()
 
-        try:
-            for subscription in cursor:
-                if subscription['old_val'] and not subscription['new_val']:
-                    # When a subscription is deleted
-                    self.on_subscription_delete(subscription['old_val'])
-                if subscription['new_val'] and not subscription['old_val']:
-                    # When a subscription is added
-                    self.start_connection()
-        except BaseException:
-            raise ConnectionLost()
-
-    def realtime_filters(self):
+    def routing_listener(self, table_name):
         """
-        Realtime bus filters. Listening for a template
-        change in the database.
+        Returns a listener that applies the changes
+        of the table to the routing index
         """
-        cursor = self.filters.get_realtime()
-        try:
-            for bus_filter in cursor:
-                if bus_filter['old_val'] and not bus_filter['new_val']:
-                    # When a bus filter is deleted
-                    self.on_bus_filter_delete(bus_filter['old_val'])
-                if bus_filter['old_val'] and bus_filter['new_val']:
-                    # Bus filter edited
-                    old_bus = bus_filter['old_val']
-                    new_bus = bus_filter['new_val']
-                    if old_bus.get('exchange') != new_bus.get(
-                            'exchange') or old_bus.get('key') != new_bus.get('key'):
-                        self.start_connection()
-                    
-                    if old_bus.get('template_id') != new_bus.get(
-                            'template_id'):
-                        self.subscriptions.edit_subscriptions_template(new_bus)
-        except BaseException:
-            raise ConnectionLost()
-
-    def realtime_templates(self):
+        return lambda change: self.routing.apply(table_name, change)
+
+    def bindings_listener(self, table_name):
         """
-        Realtime templates. Listening for a template
-        change in the database.
+        Returns a listener that applies the changes of the table
+        to the bindings and keeps the bindings changed
         """
-        cursor = self.templates.get_realtime()
-        try:
-            for template in cursor:
-                if template['old_val'] and not template['new_val']:
-                    self.on_template_deleted(template['old_val'])
+        return lambda change: self.add_binding_deltas(
+            *self.bindings.apply(table_name, change))
 
-        except BaseException:
-            raise ConnectionLost()
+    def add_binding_deltas(self, added, removed):
+        """
+        Adds the bindings changed to the ones of the current batch
+        :added: List of (exchange, key) to bind
+        :removed: List of (exchange, key) to unbind
+        """
+        for binding in added:
+            self.binding_deltas[binding] = self.binding_deltas.get(
+                binding, 0) + 1
+        for binding in removed:
+            self.binding_deltas[binding] = self.binding_deltas.get(
+                binding, 0) - 1
 
-    def start_connection(self):
+    def apply_bindings(self):
         """
-        Creates a new connection thread listening
-        to the subscriptions stored in the database
+        Applies the bindings changed by a batch of changes. Bindings
+        added and removed in the same batch are left as they were
         """
-        bus_filters = []
-        subscriptions_list = self.subscriptions.get()
-        if subscriptions_list:
-            for sub in subscriptions_list:
-                bus_filters.append(self.bus_filter_from_subscription(sub))
-            if bus_filters:
-                self.create_connection(bus_filters)
+        deltas = self.binding_deltas
+        self.binding_deltas = {}
+        self.update_bindings(
+            [binding for binding, delta in deltas.items() if delta > 0],
+            [binding for binding, delta in deltas.items() if delta < 0])
 
-    def bus_filter_from_subscription(self, subscription):
+    def is_coordinator(self):
         """
-        Returns bus filters with the same bus filter id
-        than the subscription bus filter
-        :subscription: Subscription that is going to look for bus filters
+        True if the process binds the bus queue
         """
-        return self.filters.get(subscription.get('filter_id'))
+        return self.coordinator is None or self.coordinator.is_leader()
 
-    def on_subscription_delete(self, subscription):
+    def update_bindings(self, added, removed):
         """
-        If a subscription is deleted, it search if is the
-        last subscription with this bus filters. If so, it
-        stops listen to this bus filter from the bus
+        Binds and unbinds the bus queue without restarting the consumer
+        :added: List of (exchange, key) to bind
+        :removed: List of (exchange, key) to unbind
         """
-        subscriptions = []
-        if isinstance(subscription, list):
-            for sub in subscription:
-                subscriptions = subscriptions + \
-                    self.same_bus_filter_subscription(sub)
-        else:
-            subscriptions = self.same_bus_filter_subscription(subscription)
+        with self.bus_lock:
+            if self.bus_thread is None or not self.is_coordinator():
+                # Until the changefeed is ready the bindings are only counted
+                return
+            # Recorded before they are applied, so the bindings
+            # removed are unbound by the next coordinator if this
+            # one stops before unbinding them
+            self.record_bindings(self.bindings.current() | set(removed))
+            for binding in added:
+                bus_filter = self.bindings.bus_filter(binding)
+                if bus_filter:
+                    self.bus_thread.bind(bus_filter)
+            for exchange, key in removed:
+                self.bus_thread.unbind(exchange, key)
 
-        if subscriptions:
-            if len(subscriptions) == 1:
-                # If only one subscription left, unbind bus filter
-                bus_filter = self.bus_filter_from_subscription(subscription)
-                self.connection_stop(bus_filter)
+    def reconcile_bindings(self):
+        """
+        Makes the bindings of the bus queue the bindings with
+        subscriptions: unbinds the ones recorded that are no longer
+        needed and binds every binding. Called when the connection
+        starts and when the process is elected coordinator
+        """
+        with self.bus_lock:
+            if self.bus_thread is None:
+                return
+            current = self.bindings.current()
+            recorded = self.recorded_bindings()
+            self.record_bindings(current | recorded)
+            for exchange, key in recorded - current:
+                self.bus_thread.unbind(exchange, key)
+            for bus_filter in self.bindings.bus_filters():
+                self.bus_thread.bind(bus_filter)
+            self.record_bindings(current)
 
-    def same_bus_filter_subscription(self, subscription):
+    def recorded_bindings(self):
         """
-        Returns all subscriptions with the same
-        bus filter than the provided subscription
-        :subscription: Subscription that is going to look for bus filters
+        Returns the set of bindings of the bus queue recorded
         """
         try:
-            return self.subscriptions.get_by_filter_id(
-                subscription.get('filter_id'))
-        except BaseException:
-            pass
+            document = self.queue_bindings.get_data(st.RABBITMQ_QUEUE)
+        except BaseException as error:
+            st.logger.error('Error reading the queue bindings: %r', error)
+            return set()
+        if not document:
+            return set()
+        return {tuple(binding) for binding in document.get('bindings', [])}
+
+    def record_bindings(self, bindings):
+        """
+        Records the bindings of the bus queue, so the next
+        coordinator knows the ones to unbind
+        :bindings: Set of (exchange, key)
+        """
+        try:
+            self.queue_bindings.replace_data({
+                'id': st.RABBITMQ_QUEUE,
+                'bindings': [list(binding) for binding in bindings]},
+                st.RABBITMQ_QUEUE)
+        except BaseException as error:
+            st.logger.error('Error recording the queue bindings: %r', error)
+
+    def realtime_filters(self, bus_filter):
+        """
+        Realtime bus filters. Listening for a template
+        change in the database. Bindings are updated by his own listener.
+        Only the coordinator cascades the changes, once for every process
+        """
+        if bus_filter['initial'] or not self.is_coordinator():
+            return
+        if bus_filter['old_val'] and not bus_filter['new_val']:
+            # When a bus filter is deleted
+            self.on_bus_filter_delete(bus_filter['old_val'])
+        if bus_filter['old_val'] and bus_filter['new_val']:
+            # Bus filter edited
+            old_bus = bus_filter['old_val']
+            new_bus = bus_filter['new_val']
+            if old_bus.get('template_id') != new_bus.get(
+                    'template_id'):
+                self.subscriptions.edit_subscriptions_template(new_bus)
+
+    def realtime_templates(self, template):
+        """
+        Realtime templates. Listening for a template
+        change in the database. Every process invalidates his cache
+        and only the coordinator cascades the deletions
+        """
+        if template['initial']:
+            return
+        if template['old_val']:
+            # Template edited or deleted
+            self.template_cache.invalidate(template['old_val']['id'])
+        if (template['old_val'] and not template['new_val'] and
+                self.is_coordinator()):
+            self.on_template_deleted(template['old_val'])
+
+    def listen_replays(self):
+        """
+        Thread listening to the changefeed of the dead letters marked to
+        be sent again. When it fails it is opened again with backoff and
+        the dead letters marked meanwhile are replayed
+        """
+        wait = st.REALTIME_RETRY_WAIT
+        reopened = False
+        while True:
+            changes = None
+            try:
+                changes = self.dead_letters.replaying_changes()
+                if reopened:
+                    self.replay_dead_letters()
+                wait = st.REALTIME_RETRY_WAIT
+                for change in changes:
+                    self.realtime_dead_letters(change)
+            except BaseException as error:
+                st.logger.error(
+                    'Dead letters changefeed lost: %r', error)
+            finally:
+                if changes is not None:
+                    try:
+                        changes.close()
+                    except BaseException:
+                        pass
+            reopened = True
+            time.sleep(wait / 1000)
+            wait = min(wait * 2, st.REALTIME_MAX_RETRY_WAIT)
+
+    def realtime_dead_letters(self, dead_letter):
+        """
+        Realtime dead letters. Replays the dead letters marked
+        to be sent again. The ones marked before the changefeed
+        started are replayed when the connection starts
+        """
+        new_val = dead_letter.get('new_val')
+        if not new_val or new_val.get('state') != REPLAYING:
+            return
+        with self.bus_lock:
+            if self.bus_thread is None or not self.is_coordinator():
+                return
+            self.bus_thread.replay(new_val)
+
+    def replay_dead_letters(self):
+        """
+        Replays every dead letter marked to be sent again. Called when
+        the connection starts and when the process is elected coordinator
+        """
+        with self.bus_lock:
+            if self.bus_thread is None or not self.is_coordinator():
+                return
+            for dead_letter in self.dead_letters.get_replaying():
+                self.bus_thread.replay(dead_letter)
 
     def on_bus_filter_delete(self, bus_filter):
         """
         If a bus filter is delete, delete it from
-        the subscriptions asociated to and stops
-        listening from the bus
+        the subscriptions asociated to. The bindings
+        stop listening from the bus
         """
         self.subscriptions.delete_bus_filter(bus_filter)
-        self.connection_stop(bus_filter)
 
     def on_template_deleted(self, template):
         """
@@ -154,33 +304,20 @@ class Realtime():
         default template id.
         """
         template_id = template.get('id')
-        subscriptions = self.subscriptions.subscriptions_template(
-            template_id)
-        for subscription in subscriptions:
-            subscription['template_id'] = self.templates.get_default_template(
-            )
-            self.subscriptions.edit(
-                subscription, subscription['id'])
+        self.subscriptions.replace_template(
+            template_id, self.templates.get_default_template())
         self.filters.delete_template(template_id)
 
-    def create_connection(self, subscriptions):
-        """
-        Creates a thread with a new rabbitmq connection
-        :subscriptions: Subscriptions to add to bus thread
-        """
-        if not hasattr(self, 'bus_thread'):
-            self.bus_thread = BusConnectionHandler(subscriptions)
-        else:
-            self.bus_thread.set_subscriptions(subscriptions)
-        self.bus_thread.start()
-
-    def connection_stop(self, bus_filter=None):
+    def start_connection(self):
         """
-        Search for a thread with the bus_filter to pause and delete it
+        Starts the bus connection. If the process is the coordinator
+        the queue is bound to the bus filters with subscriptions.
+        Called once when the changefeed is ready
         """
-        if hasattr(self, 'bus_thread'):
-            self.bus_thread.stop()
-            if bus_filter:
-                self.bus_thread.unbind(
-                    bus_filter.get('exchange'),
-                    bus_filter.get('key'))
+        with self.bus_lock:
+            self.bus_thread = BusConnectionHandler(
+                [], self.routing, self.template_cache)
+            self.bus_thread.start()
+        if self.is_coordinator():
+            self.reconcile_bindings()
+        self.replay_dead_letters()
@@ -0,0 +1,30 @@
+"""
+Handlers registry. Business handlers are created the first time
+they are requested and shared by every module of the process, so
+each table is prepared and each connection is opened only once
+"""
+from threading import RLock
+
+_lock = RLock()
+_handlers = {}
+
+
+def get(handler_class):
+    """
+    Returns the shared instance of the handler class
+    :handler_class: Handler class to instantiate without params
+    """
+    with _lock:
+        handler = _handlers.get(handler_class)
+        if handler is None:
+            handler = handler_class()
+            _handlers[handler_class] = handler
+        return handler
+
+
+def stats():
+    """
+    Returns the name of the handlers created
+    """
+    with _lock:
+        return {'handlers': sorted(cls.__name__ for cls in _handlers)}
@@ -0,0 +1,201 @@
+"""
+Routing index
+"""
+from threading import RLock
+
+from bussiness.topic_trie import TopicTrie
+
+
+class RoutingIndex():
+    """
+    Process-local index of bus filters, subscriptions, users and templates.
+    Messages received from the bus are resolved against it so the bus
+    connection does not need to query the database for every message.
+    It is loaded and kept up to date from the changefeed of the tables.
+    Bus filters of topic exchanges are stored in a trie per exchange
+    so their patterns match the routing keys received.
+    """
+
+    def __init__(self):
+        self.lock = RLock()
+        self.filters = {}
+        self.filter_keys = {}
+        self.topics = {}
+        self.subscriptions = {}
+        self.filter_subscriptions = {}
+        self.users = {}
+        self.templates = {}
+        self.default_template_id = None
+
+    def apply(self, table_name, change):
+        """
+        Applies a changefeed entry to the index
+        :table_name: Name of the table the change comes from
+        :change: Change with his old_val and new_val
+        """
+        old_val = change.get('old_val')
+        new_val = change.get('new_val')
+        with self.lock:
+            if table_name == 'bus_filters':
+                if old_val:
+                    self.remove_filter(old_val)
+                if new_val:
+                    self.set_filter(new_val)
+            elif table_name == 'subscriptions':
+                if old_val:
+                    self.remove_subscription(old_val)
+                if new_val:
+                    self.set_subscription(new_val)
+            elif table_name == 'users':
+                if old_val:
+                    self.users.pop(old_val['id'], None)
+                if new_val:
+                    self.users[new_val['id']] = new_val
+            elif table_name == 'templates':
+                if old_val:
+                    self.remove_template(old_val)
+                if new_val:
+                    self.set_template(new_val)
+
+    def set_filter(self, bus_filter):
+        """
+        Adds or replaces a bus filter
+        """
+        self.filters[bus_filter['id']] = bus_filter
+        if self.is_topic(bus_filter):
+            exchange = bus_filter.get('exchange')
+            if exchange not in self.topics:
+                self.topics[exchange] = TopicTrie()
+            self.topics[exchange].insert(
+                bus_filter.get('key') or '', bus_filter['id'])
+        else:
+            self.filter_keys[self.filter_key(bus_filter)] = bus_filter['id']
+
+    def remove_filter(self, bus_filter):
+        """
+        Removes a bus filter. Its subscriptions are kept because the
+        subscriptions changefeed removes them on its own
+        """
+        self.filters.pop(bus_filter['id'], None)
+        if self.is_topic(bus_filter):
+            exchange = bus_filter.get('exchange')
+            trie = self.topics.get(exchange)
+            if trie is not None:
+                trie.remove(bus_filter.get('key') or '', bus_filter['id'])
+                if not len(trie):
+                    del self.topics[exchange]
+            return
+        key = self.filter_key(bus_filter)
+        if self.filter_keys.get(key) == bus_filter['id']:
+            del self.filter_keys[key]
+
+    def set_subscription(self, subscription):
+        """
+        Adds or replaces a subscription
+        """
+        self.subscriptions[subscription['id']] = subscription
+        self.filter_subscriptions.setdefault(
+            subscription.get('filter_id'), set()).add(subscription['id'])
+
+    def remove_subscription(self, subscription):
+        """
+        Removes a subscription
+        """
+        self.subscriptions.pop(subscription['id'], None)
+        filter_id = subscription.get('filter_id')
+        subscription_ids = self.filter_subscriptions.get(filter_id)
+        if subscription_ids is not None:
+            subscription_ids.discard(subscription['id'])
+            if not subscription_ids:
+                del self.filter_subscriptions[filter_id]
+
+    def set_template(self, template):
+        """
+        Adds or replaces a template
+        """
+        self.templates[template['id']] = template
+        if template.get('name') == 'default':
+            self.default_template_id = template['id']
+
+    def remove_template(self, template):
+        """
+        Removes a template
+        """
+        self.templates.pop(template['id'], None)
+        if self.default_template_id == template['id']:
+            self.default_template_id = None
+
+    def resolve(self, exchange, key):
+        """
+        Returns a list of tuples (bus_filter, resolved) with every bus filter
+        matching the exchange and key. resolved is a list of tuples
+        (subscription, user, template) of the subscriptions of the filter
+        :exchange: Exchange of the message received
+        :key: Routing key of the message received
+        """
+        with self.lock:
+            filter_ids = set()
+            filter_id = self.filter_keys.get((exchange, key or ''))
+            if filter_id:
+                filter_ids.add(filter_id)
+            trie = self.topics.get(exchange)
+            if trie is not None:
+                filter_ids.update(trie.match(key or ''))
+
+            matches = []
+            for filter_id in filter_ids:
+                resolved = []
+                for sub_id in self.filter_subscriptions.get(filter_id, ()):
+                    sub = self.subscriptions[sub_id]
+                    resolved.append((
+                        sub,
+                        self.users.get(sub.get('user_id')),
+                        self.templates.get(sub.get('template_id'))))
+                matches.append((self.filters[filter_id], resolved))
+            return matches
+
+    def documents(self, table_name):
+        """
+        Returns the documents of a table by id. The dict is the one of
+        the index, only to be read by the thread applying the changes
+        """
+        return {
+            'bus_filters': self.filters,
+            'subscriptions': self.subscriptions,
+            'users': self.users,
+            'templates': self.templates}[table_name]
+
+    def get_user(self, user_id):
+        """
+        Returns user by his id
+        """
+        with self.lock:
+            return self.users.get(user_id)
+
+    def get_template(self, template_id):
+        """
+        Returns template by his id
+        """
+        with self.lock:
+            return self.templates.get(template_id)
+
+    def get_default_template(self):
+        """
+        Returns the default template if it is stored
+        """
+        with self.lock:
+            return self.templates.get(self.default_template_id)
+
+    @staticmethod
+    def is_topic(bus_filter):
+        """
+        True if the bus filter is bound to a topic exchange
+        """
+        return bus_filter.get('exchange_type') == 'topic'
+
+    @staticmethod
+    def filter_key(bus_filter):
+        """
+        Index key of a bus filter
+        """
+        return bus_filter.get('exchange'), bus_filter.get('key') or ''
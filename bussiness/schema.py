@@ -0,0 +1,104 @@
+"""
+Database schema bootstrap
+"""
+import settings as st
+
+from bussiness.db_handler import storage
+from utils import dates
+
+# Increase it every time TABLES, DEFAULTS or DATES change
+SCHEMA_VERSION = 6
+SCHEMA_TABLE = 'schema'
+
+# Table name: (primary key, {index name: fields of compound indexes})
+TABLES = {
+    'bus_filters': ('id', {
+        'exchange_key': ['exchange', 'key'],
+        'template_id': None}),
+    'subscriptions': ('id', {
+        'filter_id': None,
+        'user_id': None,
+        'template_id': None}),
+    'users': ('id', {
+        'email': None,
+        'name': None}),
+    'templates': ('id', {
+        'name': None}),
+    'messages': ('id', {
+        'date': None}),
+    'leases': ('id', {}),
+    'queue_bindings': ('id', {}),
+    'dead_letters': ('id', {
+        'state': None,
+        'date': None}),
+}
+
+# Table name, field and value set where the field is missing or null,
+# so the documents are included in the compound indexes
+DEFAULTS = [
+    ('bus_filters', 'key', ''),
+]
+
+# Table name and field of the dates rewritten in the stored format of
+# utils.dates, so the older ones sort right against the date indexes
+DATES = [
+    ('messages', 'date'),
+    ('dead_letters', 'date'),
+]
+
+
+def bootstrap(reset=False):
+    """
+    Creates the database, tables and secondary indexes, waits until
+    the indexes are ready, sets the DEFAULTS and normalizes the DATES
+    of the documents. The version of the schema is stored in the
+    database, so when it is up to date nothing is created
+    :reset: Drops the database before creating it
+    """
+    database = storage()
+
+    if reset:
+        st.logger.info('Reseting the database...')
+        database.reset_database()
+    elif current_version(database) == SCHEMA_VERSION:
+        return
+
+    st.logger.info('Creating database schema version %d', SCHEMA_VERSION)
+    database.create_database()
+    database.create_table(SCHEMA_TABLE)
+    for table_name, (primary_key, indexes) in TABLES.items():
+        database.create_table(table_name, primary_key)
+        for index_name, fields in indexes.items():
+            database.create_index(table_name, index_name, fields)
+    for table_name in TABLES:
+        database.wait_indexes(table_name)
+    for table_name, field, value in DEFAULTS:
+        database.fill_missing(table_name, field, value)
+    for table_name, field in DATES:
+        normalize_dates(database, table_name, field)
+    database.replace_data(
+        SCHEMA_TABLE, {'id': 'version', 'version': SCHEMA_VERSION}, 'version')
+
+
+def normalize_dates(database, table_name, field):
+    """
+    Rewrites the dates of the field that are not in the stored format
+    """
+    changed = {}
+    for document in database.get_page(table_name, fields=['id', field]):
+        date = dates.normalize(document.get(field))
+        if date != document.get(field):
+            changed[document['id']] = date
+    for key, date in changed.items():
+        database.edit_data(table_name, key, {field: date})
+
+
+def current_version(database):
+    """
+    Returns the schema version stored in the database
+    or None if the schema was never created
+    """
+    if not database.table_exists(SCHEMA_TABLE):
+        return None
+    version = database.get_data(SCHEMA_TABLE, 'version')
+    return version and version.get('version')
@@ -0,0 +1,150 @@
+"""
+Outbox sender
+"""
+import queue
+import random
+from threading import Thread, Lock
+
+import settings as st
+
+from bussiness.timer_wheel import TimerWheel
+
+
+class Sender():
+    """
+    Pool of threads that drain the outbox. Each thread claims an email,
+    sends it and deletes it from the outbox.
+
+    If it fails the retry is scheduled in a timer wheel, waiting twice
+    as long after every failure with a random jitter so the emails that
+    failed together are not retried at once. When the retry is due the
+    email is given to the next free sender. After max_attempts the
+    email is passed to on_dead and deleted from the outbox
+    """
+
+    def __init__(self, outbox, send, workers, retry_wait, max_retry_wait,
+                 max_attempts, on_dead, poll_interval=1):
+        """
+        :outbox: Outbox to drain
+        :send: Callable that sends a delivery and raises if it fails
+        :workers: Number of sender threads
+        :retry_wait: Milliseconds to wait before the first retry
+        :max_retry_wait: Maximum milliseconds between retries
+        :max_attempts: Number of attempts before giving up
+        :on_dead: Callable called with the delivery, the number
+        of attempts and the last error when giving up
+        :poll_interval: Seconds between checks for emails
+        appended by other processes
+        """
+        self.outbox = outbox
+        self.send = send
+        self.workers = workers
+        self.retry_wait = retry_wait
+        self.max_retry_wait = max_retry_wait
+        self.max_attempts = max_attempts
+        self.on_dead = on_dead
+        self.poll_interval = poll_interval
+        self.due = queue.Queue()
+        self.wheel = TimerWheel(self.on_due)
+        self.threads = []
+        self.lock = Lock()
+        self.retries_due = 0
+
+    def start(self):
+        """
+        Starts the sender threads and the timer wheel
+        """
+        self.wheel.start()
+        for i in range(self.workers):
+            thread = Thread(
+                target=self.work, name='sender-{}'.format(i), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def on_due(self, email_ids):
+        """
+        Gives the emails whose retry is due to the senders
+        """
+        for email_id in email_ids:
+            self.due.put(email_id)
+        self.outbox.wake(len(email_ids))
+
+    def work(self):
+        """
+        Sender thread loop. Retries due go before new emails
+        """
+        while True:
+            wakeups = self.outbox.wakeups
+            try:
+                claimed = self.next_due() or self.outbox.claim()
+            except BaseException as error:
+                st.logger.error('Error reading the outbox: %r', error)
+                claimed = []
+            if not claimed:
+                self.outbox.wait(wakeups, self.poll_interval)
+                continue
+            for email_id, delivery, attempts in claimed:
+                try:
+                    self.process(email_id, delivery, attempts)
+                except BaseException as error:
+                    # The claim expires and the email is sent again
+                    st.logger.error('Error updating the outbox: %r', error)
+
+    def next_due(self):
+        """
+        Returns a list with the next email whose retry is due, as claim
+        does, or an empty list if there is none
+        """
+        while True:
+            try:
+                email_id = self.due.get_nowait()
+            except queue.Empty:
+                return []
+            email = self.outbox.get(email_id)
+            if email:
+                with self.lock:
+                    self.retries_due += 1
+                return [(email_id,) + email]
+
+    def process(self, email_id, delivery, attempts):
+        """
+        Sends an email of the outbox
+        :attempts: Number of times it failed before
+        """
+        try:
+            self.send(delivery)
+        except BaseException as error:
+            self.failed(email_id, delivery, attempts + 1, error)
+            return
+        self.outbox.done(email_id)
+
+    def failed(self, email_id, delivery, attempts, error):
+        """
+        Schedules the retry of an email or gives up on it
+        :attempts: Number of times it failed
+        """
+        if attempts >= self.max_attempts:
+            st.logger.error(
+                'Giving up on email %s after %d attempts: %r',
+                email_id, attempts, error)
+            self.on_dead(delivery, attempts, repr(error))
+            self.outbox.discard(email_id)
+            return
+        delay = min(
+            self.retry_wait * 2 ** (attempts - 1), self.max_retry_wait)
+        # Half of the delay is random
+        delay = (delay / 2 + random.uniform(0, delay / 2)) / 1000
+        st.logger.error(
+            'Error sending email %s, retrying in %.1fs: %r',
+            email_id, delay, error)
+        self.outbox.retry(email_id, repr(error), delay)
+        self.wheel.schedule(delay, email_id)
+
+    def stats(self):
+        """
+        Returns the number of retries scheduled and due
+        """
+        with self.lock:
+            return {
+                'retries_scheduled': len(self.wheel),
+                'retries_due': self.retries_due}
@@ -4,6 +4,7 @@ Users handler
 """
 from marshmallow import Schema, fields
 
+from bussiness import registry
 from bussiness.db_handler import DBHandler
 from bussiness.users import UsersHandler
 from bussiness.bus_filters import BusFiltersHandler
@@ -18,6 +19,9 @@ class SubscriptionSchema(Schema):
     user_id = fields.Str(required=True)
     filter_id = fields.Str(required=True)
     template_id = fields.Str()
+    digest_window = fields.Int()
+    digest_max = fields.Int()
+    digest_template_id = fields.Str()
 
 
 class SubscriptionsHandler():
@@ -28,10 +32,9 @@ class SubscriptionsHandler():
 
     def __init__(self):
         self.db_handler = DBHandler('subscriptions')
-        self.db_handler.create_table('id')
-        self.users = UsersHandler()
-        self.filters = BusFiltersHandler()
-        self.templates = TemplatesHandler()
+        self.users = registry.get(UsersHandler)
+        self.filters = registry.get(BusFiltersHandler)
+        self.templates = registry.get(TemplatesHandler)
 
     def get(self, sub_id=None):
         """
@@ -41,20 +44,24 @@ class SubscriptionsHandler():
         """
         return self.db_handler.get_data(sub_id)
 
-    def get_with_relationships(self):
+    def get_with_relationships(self, limit=None, start_after=None,
+                               fields=None):
         """
-        Get subscriptions joining users and bus_filtes tables
+        Get subscriptions joining users and bus_filtes tables.
+        Returns an iterator that reads them while iterating
+        :limit: Maximum number of subscriptions, all if not provided
+        :start_after: Id of the last subscription of the previous page
+        :fields: List of fields to return of every subscription
         """
-        sub_list = []
-        subscriptions = self.db_handler.join_tables(
+        return self.db_handler.join_tables(
             "subscriptions",
             "users",
             "bus_filters",
             "user_id",
-            "filter_id")
-        for sub in subscriptions:
-            sub_list.append(sub)
-        return sub_list
+            "filter_id",
+            limit,
+            start_after,
+            fields)
 
     def get_realtime(self):
         """
@@ -107,42 +114,55 @@ class SubscriptionsHandler():
         Get subscription by his id
         :subsc_id: ID of the subscription to search
         """
-        return self.db_handler.filter_data({'id': subsc_id})
+        subscription = self.db_handler.get_data(subsc_id)
+        if subscription:
+            return [subscription]
+        return []
 
     def get_by_template(self, template):
         """
         Get subscription searching by his template
         :template: Template to search for
         """
-        return self.db_handler.filter_data({'template_id': template['id']})
+        return self.db_handler.get_all('template_id', template['id'])
 
     def get_by_template_id(self, template_id):
         """
         Get subscription searching by his template id
         :template_id: Template id to search for
         """
-        return self.db_handler.filter_data({'template_id': template_id})
+        return self.db_handler.get_all('template_id', template_id)
 
     def get_by_filter(self, bus_filter):
         """
         Get subscription by his id
         :bus_filter: Bus filter to search for
         """
-        return self.db_handler.filter_data({'filter_id': bus_filter['id']})
+        return self.db_handler.get_all('filter_id', bus_filter['id'])
 
     def get_by_filter_id(self, bus_filter_id):
         """
         Get subscription by his id
         :bus_filter: Bus filter to search for
         """
-        return self.db_handler.filter_data({'filter_id': bus_filter_id})
+        return self.db_handler.get_all('filter_id', bus_filter_id)
 
     def get_by_user(self, user):
         """
         Get subscription by his id
         :user: User to seach for
         """
-        return self.db_handler.filter_data({'user_id': user['id']})
+        return self.db_handler.get_all('user_id', user['id'])
+
+    def get_by_user_filter(self, user_id, bus_filter_id):
+        """
+        Get subscriptions of an user to a bus filter
+        :user_id: Id of the user
+        :bus_filter_id: Id of the bus filter
+        """
+        return [
+            sub for sub in self.db_handler.get_all('user_id', user_id)
+            if sub.get('filter_id') == bus_filter_id]
 
     def insert(self, subscriptions):
         """
@@ -192,33 +212,38 @@ class SubscriptionsHandler():
         Delete subscriptions associated with the user
         :user_id: user id to search for
         """
-        subscriptions = self.get()
-        for sub in subscriptions:
-            if sub['user_id'] == user_id:
-                self.delete(sub['id'])
+        self.db_handler.delete_by_index('user_id', user_id)
 
     def delete_bus_filter(self, bus_filter):
         """
         Delete subscriptions associated with the bus filter
         :bus_filter_id: filter id to search for
         """
-        subscriptions = self.db_handler.filter_data(
-            {'filter_id': bus_filter['id']})
-        for sub in subscriptions:
-            self.delete(sub['id'])
+        self.db_handler.delete_by_index('filter_id', bus_filter['id'])
 
     def edit_subscriptions_template(self, bus_filter):
-        subscriptions = self.db_handler.filter_data({'filter_id': bus_filter.get('id')})
-        for subs in subscriptions:
-            subs['template_id'] = bus_filter.get('template_id')
-            print(subs)
-            self.edit(subs, subs['id'])
+        """
+        Sets the template of the bus filter to his subscriptions
+        :bus_filter: Bus filter with the new template
+        """
+        self.db_handler.update_by_index(
+            {'template_id': bus_filter.get('template_id')},
+            'filter_id', bus_filter.get('id'))
+
+    def replace_template(self, template_id, new_template_id):
+        """
+        Replaces a template in every subscription using it
+        :template_id: Template to replace
+        :new_template_id: Template to use instead
+        """
+        self.db_handler.update_by_index(
+            {'template_id': new_template_id}, 'template_id', template_id)
 
     def subscriptions_template(self, template_id):
         """
         Return subscriptions with specific template id
         """
-        return self.db_handler.filter_data({'template_id': template_id})
+        return self.db_handler.get_all('template_id', template_id)
 
     def delete(self, subscription_id):
         """
@@ -0,0 +1,120 @@
+"""
+Compiled templates cache
+"""
+import hashlib
+from collections import OrderedDict
+from threading import Lock
+
+from jinja2 import Template, Undefined
+
+
+class TemplateCache():
+    """
+    LRU cache of compiled jinja2 templates. Entries are keyed by
+    template id and revision, the revision being a digest of the subject
+    and the text, so an edited template never renders a stale version
+    even before the changefeed invalidates it.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        self.revisions = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, template):
+        """
+        Returns the compiled subject and text of the template.
+        Subject is None if the template has no subject
+        :template: Template stored in the database
+        """
+        key = (template.get('id'), self.revision(template))
+        with self.lock:
+            compiled = self.entries.get(key)
+            if compiled:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return compiled
+            self.misses += 1
+
+        compiled = self.compile(template)
+
+        with self.lock:
+            old_key = self.revisions.get(key[0])
+            if old_key and old_key != key:
+                self.entries.pop(old_key, None)
+            self.entries[key] = compiled
+            self.revisions[key[0]] = key
+            while len(self.entries) > self.max_size:
+                evicted, _ = self.entries.popitem(last=False)
+                if self.revisions.get(evicted[0]) == evicted:
+                    del self.revisions[evicted[0]]
+                self.evictions += 1
+        return compiled
+
+    def invalidate(self, template_id):
+        """
+        Removes the compiled template from the cache
+        :template_id: Id of the template edited or deleted
+        """
+        with self.lock:
+            key = self.revisions.pop(template_id, None)
+            if key:
+                self.entries.pop(key, None)
+
+    def stats(self):
+        """
+        Returns cache counters
+        """
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
+
+    @staticmethod
+    def revision(template):
+        """
+        Returns the revision of the template
+        """
+        digest = hashlib.sha1()
+        digest.update((template.get('subject') or '').encode('utf-8'))
+        digest.update(b'\0')
+        digest.update((template.get('text') or '').encode('utf-8'))
+        return digest.hexdigest()
+
+    @staticmethod
+    def compile(template):
+        """
+        Compiles subject and text of the template
+        """
+        subject = None
+        if template.get('subject'):
+            subject = Template(
+                template.get('subject'),
+                undefined=SilentUndefined)
+        text = Template(template.get('text'), undefined=SilentUndefined)
+        return subject, text
+
+
+class SilentUndefined(Undefined):
+    """
+    Sorry about that. This class is created becasuse Jinja2 templates
+    raises error on undefined variables. This is a little hack to replace
+    undefined values with empty string
+    """
+
+    def _fail_with_undefined_error(self, *args, **kwargs):
+        return ''
+
+    __add__ = __radd__ = __mul__ = __rmul__ = __div__ = __rdiv__ = \
+        __truediv__ = __rtruediv__ = __floordiv__ = __rfloordiv__ = \
+        __mod__ = __rmod__ = __pos__ = __neg__ = __call__ = \
+        __getitem__ = __lt__ = __le__ = __gt__ = __ge__ = __int__ = \
+        __float__ = __complex__ = __pow__ = __rpow__ = \
+        _fail_with_undefined_error
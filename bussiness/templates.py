@@ -8,7 +8,6 @@ from marshmallow import Schema, fields
 import settings as st
 
 from bussiness.db_handler import DBHandler
-from bussiness.bus_filters import BusFiltersHandler
 
 
 class TemplateSchema(Schema):
@@ -32,9 +31,7 @@ class TemplatesHandler():
 
     def __init__(self):
         self.db_handler = DBHandler("templates")
-        self.db_handler.create_table()
         self.default_template_id = ''
-        self.filters = BusFiltersHandler()
 
     def get(self, template_id=None):
         """
@@ -79,15 +76,16 @@ class TemplatesHandler():
         Get template by his name
         :name: Name of the template to search
         """
-        return self.db_handler.filter_data({'name': name})
+        return self.db_handler.get_all('name', name)
 
     def search(self, template):
         """
         Search template with template provided. Return his id
         :template: Template without id to search.
         """
-        templates = self.db_handler.filter_data(
-            {'name': template.name, 'text': template.text})
+        templates = [
+            entry for entry in self.db_handler.get_all('name', template.name)
+            if entry.get('text') == template.text]
         if templates:
             return templates[0]['id'], False
         return None, True
@@ -0,0 +1,91 @@
+"""
+Timer wheel
+"""
+import math
+import time
+from threading import Thread, Lock, Event
+
+
+class TimerWheel():
+    """
+    Hashed timer wheel. Time is divided in ticks and each tick has a slot
+    of the wheel, the timers of a tick are kept in his slot and the wheel
+    turns once every number of slots. Scheduling a timer and expiring it
+    costs the same whatever the number of timers, so hundreds of
+    thousands of timers are kept with a single thread that wakes up
+    once per tick. Timers are rounded up to the next tick
+    """
+
+    def __init__(self, on_expire, tick=100, slots=512):
+        """
+        :on_expire: Callable called with the list of items expired
+        :tick: Milliseconds of a tick
+        :slots: Number of slots of the wheel
+        """
+        self.on_expire = on_expire
+        self.tick = tick / 1000
+        self.slots = [[] for _ in range(slots)]
+        self.lock = Lock()
+        self.stopped = Event()
+        self.started = time.monotonic()
+        self.current = 0
+        self.size = 0
+        self.expired = 0
+
+    def schedule(self, delay, item):
+        """
+        Schedules an item to expire after a delay
+        :delay: Seconds to wait
+        """
+        with self.lock:
+            due = max(self.current + 1, self.tick_at(time.monotonic() + delay))
+            self.slots[due % len(self.slots)].append((due, item))
+            self.size += 1
+
+    def tick_at(self, moment):
+        """
+        Returns the tick of a monotonic moment, rounded up. The ticks
+        are rounded to microseconds first, so the float error of the
+        monotonic clock does not push an exact tick to the next one
+        """
+        return math.ceil(round((moment - self.started) / self.tick, 6))
+
+    def start(self):
+        """
+        Starts the thread that turns the wheel
+        """
+        Thread(target=self.run, name='timer-wheel', daemon=True).start()
+
+    def run(self):
+        """
+        Thread running. Expires the timers of every tick passed
+        """
+        while not self.stopped.wait(self.tick):
+            now = int((time.monotonic() - self.started) // self.tick)
+            expired = []
+            with self.lock:
+                while self.current < now:
+                    self.current += 1
+                    slot = self.slots[self.current % len(self.slots)]
+                    if not slot:
+                        continue
+                    pending = []
+                    for due, item in slot:
+                        if due <= self.current:
+                            expired.append(item)
+                        else:
+                            pending.append((due, item))
+                    slot[:] = pending
+                self.size -= len(expired)
+                self.expired += len(expired)
+            if expired:
+                self.on_expire(expired)
+
+    def stop(self):
+        """
+        Stops the wheel. The timers pending never expire
+        """
+        self.stopped.set()
+
+    def __len__(self):
+        return self.size
@@ -0,0 +1,93 @@
+"""
+Topic trie to match routing keys against AMQP topic patterns
+"""
+
+
+class TrieNode():
+    """
+    Node of the trie. Each child is a word of the pattern
+    """
+
+    def __init__(self):
+        self.children = {}
+        self.values = set()
+
+
+class TopicTrie():
+    """
+    Trie of AMQP topic patterns. Patterns and keys are words separated
+    by dots, "*" matches exactly one word and "#" matches zero or more.
+    Matching walks the trie word by word, so its cost depends on the
+    length of the key instead of on the number of patterns stored.
+    """
+
+    def __init__(self):
+        self.root = TrieNode()
+        self.size = 0
+
+    def insert(self, pattern, value):
+        """
+        Adds a value for the pattern
+        :pattern: Topic pattern like orders.*.failed
+        :value: Value returned when a key matches the pattern
+        """
+        node = self.root
+        for word in pattern.split('.'):
+            node = node.children.setdefault(word, TrieNode())
+        if value not in node.values:
+            node.values.add(value)
+            self.size += 1
+
+    def remove(self, pattern, value):
+        """
+        Removes a value of the pattern and prunes the empty nodes
+        :pattern: Topic pattern the value was inserted with
+        :value: Value to remove
+        """
+        path = [self.root]
+        words = pattern.split('.')
+        for word in words:
+            node = path[-1].children.get(word)
+            if node is None:
+                return
+            path.append(node)
+        if value not in path[-1].values:
+            return
+        path[-1].values.discard(value)
+        self.size -= 1
+        for depth in range(len(words), 0, -1):
+            node = path[depth]
+            if node.values or node.children:
+                break
+            del path[depth - 1].children[words[depth - 1]]
+
+    def match(self, key):
+        """
+        Returns the set of values whose pattern matches the key
+        :key: Routing key of a message
+        """
+        found = set()
+        self.match_node(self.root, key.split('.'), 0, found)
+        return found
+
+    def match_node(self, node, words, index, found):
+        """
+        Adds to found the values of the patterns under the node
+        matching the words of the key from the index
+        """
+        hash_node = node.children.get('#')
+        if hash_node:
+            # "#" consumes from zero words up to the rest of the key
+            for next_index in range(index, len(words) + 1):
+                self.match_node(hash_node, words, next_index, found)
+        if index == len(words):
+            found.update(node.values)
+            return
+        for word in (words[index], '*'):
+            child = node.children.get(word)
+            if child:
+                self.match_node(child, words, index + 1, found)
+
+    def __len__(self):
+        return self.size
+
@@ -24,7 +24,6 @@ class UsersHandler():
 
     def __init__(self):
         self.db_handler = DBHandler("users")
-        self.db_handler.create_table()
 
     def get(self, user_id=None):
         """
@@ -33,6 +32,16 @@ class UsersHandler():
         """
         return self.db_handler.get_data(user_id)
 
+    def get_page(self, limit=None, start_after=None, fields=None):
+        """
+        Get the users ordered by id. Returns an iterator
+        that reads them from the database while iterating
+        :limit: Maximum number of users, all if not provided
+        :start_after: Id of the last user of the previous page
+        :fields: List of fields to return of every user
+        """
+        return self.db_handler.get_page(limit, start_after, fields)
+
     def get_realtime(self):
         """
         Get all users from the database in realtime.
@@ -68,7 +77,7 @@ class UsersHandler():
         Get user by his email
         :email: Email to search for
         """
-        users = self.db_handler.filter_data({'email': email})
+        users = self.db_handler.get_all('email', email)
         if users:
             return users[0]
         return None
@@ -78,7 +87,7 @@ class UsersHandler():
         Get user by his email
         :email: Email to search for
         """
-        users = self.db_handler.filter_data({'name': name})
+        users = self.db_handler.get_all('name', name)
         if users:
             return users[0]
         return None
@@ -98,8 +107,9 @@ class UsersHandler():
         else:
             email = user.get('email')
             name = user.get('name')
-            users = self.db_handler.filter_data(
-                {'email': email, 'name': name})
+            users = [
+                entry for entry in self.db_handler.get_all('email', email)
+                if entry.get('name') == name]
             if users:
                 return users[0]['id']
             return None
@@ -0,0 +1,87 @@
+"""
+In-process change feed
+"""
+import queue
+from threading import Lock
+
+
+class Subscription():
+    """
+    Iterator over the changes received by a subscriber
+    """
+
+    def __init__(self, feed, table_names):
+        self.feed = feed
+        self.table_names = table_names
+        self.changes = queue.Queue()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.changes.get()
+
+    def close(self):
+        """
+        Stops receiving changes
+        """
+        self.feed.unsubscribe(self)
+
+
+class ChangeFeed():
+    """
+    Publish/subscribe of the changes of the tables. Emulates the rethink
+    changefeeds for the storages embedded in the process, so subscribers
+    only receive the changes made by the same process
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.subscribers = {}
+
+    def subscribe(self, table_names):
+        """
+        Returns an iterator over the changes of the tables made from now on.
+        Like a rethink changefeed every change is an object with the
+        old_val and new_val of the document, and the table it comes from.
+        Iterating blocks the thread until the next change
+        :table_names: Name of a table or list of names
+        """
+        if isinstance(table_names, str):
+            table_names = [table_names]
+        subscription = Subscription(self, table_names)
+        with self.lock:
+            for table_name in table_names:
+                self.subscribers.setdefault(
+                    table_name, []).append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """
+        Removes a subscriber
+        """
+        with self.lock:
+            for table_name in subscription.table_names:
+                if subscription in self.subscribers[table_name]:
+                    self.subscribers[table_name].remove(subscription)
+
+    def publish(self, table_name, old_val, new_val):
+        """
+        Sends a change of a document to every subscriber of the table
+        :old_val: Document before the change, None if it is new
+        :new_val: Document after the change, None if it is deleted
+        """
+        with self.lock:
+            for subscription in self.subscribers.get(table_name, []):
+                subscription.changes.put({
+                    'table': table_name,
+                    'old_val': old_val,
+                    'new_val': new_val})
+
+    def stats(self):
+        """
+        Returns the number of subscribers of each table
+        """
+        with self.lock:
+            return {table_name: len(subscribers)
+                    for table_name, subscribers in self.subscribers.items()}
@@ -0,0 +1,426 @@
+"""
+Base of the storages embedded in the process
+"""
+import time
+import uuid
+from contextlib import contextmanager
+from threading import RLock
+
+from connectors.changefeed import ChangeFeed
+from exceptions.db_exceptions import ReadError
+
+
+class LocalStorage():
+    """
+    Storage embedded in the process with the same methods as
+    RethinkHandler. Changes are published to an in-process change feed
+    instead of a database changefeed. Subclasses keep the documents
+    implementing primary_key, scan, get_document, put_document,
+    remove_document, get_all and index_range, and the schema methods
+    """
+
+    def __init__(self):
+        self.lock = RLock()
+        self.feed = ChangeFeed()
+
+    def begin(self):
+        """
+        Starts a transaction. Must be called with the lock held
+        """
+
+    def commit(self):
+        """
+        Commits the transaction
+        """
+
+    def rollback(self):
+        """
+        Undoes the writes of the transaction
+        """
+
+    @contextmanager
+    def transaction(self):
+        """
+        Groups writes. Yields a list where writes add the tuples
+        (table_name, old_val, new_val) of the changes, that are
+        published when the transaction is committed
+        """
+        changes = []
+        with self.lock:
+            self.begin()
+            try:
+                yield changes
+            except BaseException:
+                self.rollback()
+                raise
+            self.commit()
+            for table_name, old_val, new_val in changes:
+                self.feed.publish(table_name, old_val, new_val)
+
+    def create_database(self):
+        """
+        Database creation. The storage is ready when it is opened
+        """
+
+    def wait_indexes(self, table_name):
+        """
+        Indexes are built when they are created, there is nothing to wait
+        """
+
+    def changes(self, table_name):
+        """
+        Returns an iterator over the changes of the table
+        """
+        return self.feed.subscribe(table_name)
+
+    def index_changes(self, table_name, index, value):
+        """
+        Returns an iterator over the changes of the documents whose
+        secondary index has the value, like a rethink changefeed of
+        get_all. Documents that stop matching are sent as deleted
+        """
+        changes = self.feed.subscribe(table_name)
+        return self.matching_changes(
+            changes, self.index_fields(table_name, index), value)
+
+    @staticmethod
+    def matching_changes(changes, fields, value):
+        """
+        Yields the changes of the documents whose fields have the value
+        """
+        values = value if isinstance(value, list) else [value]
+
+        def matches(document):
+            return document is not None and [
+                document.get(field) for field in fields] == values
+
+        try:
+            for change in changes:
+                old_val = (change['old_val']
+                           if matches(change['old_val']) else None)
+                new_val = (change['new_val']
+                           if matches(change['new_val']) else None)
+                if old_val or new_val:
+                    yield dict(change, old_val=old_val, new_val=new_val)
+        finally:
+            changes.close()
+
+    def changefeed(self, table_names, include_initial=False):
+        """
+        Returns a single iterator over the changes of several tables. Like
+        the rethink changefeeds with include_states, each table sends a
+        change with the ready state after his initial documents
+        :include_initial: Sends every document of the tables
+        as a change without old_val before the new changes
+        """
+        # Subscribe before reading the tables to not miss any change
+        changes = self.feed.subscribe(table_names)
+        return self.initial_changes(table_names, changes, include_initial)
+
+    def initial_changes(self, table_names, changes, include_initial):
+        """
+        Yields the initial documents and states of the tables
+        and then the changes
+        """
+        try:
+            for table_name in table_names:
+                if include_initial:
+                    for document in self.scan(table_name):
+                        yield {'table': table_name, 'new_val': document}
+                yield {'table': table_name, 'state': 'ready'}
+            for change in changes:
+                yield change
+        finally:
+            changes.close()
+
+    def get_data(self, table_name, key):
+        """
+        Returns a document by his primary key or
+        every document of the table if key is not provided
+        """
+        if key:
+            return self.get_document(table_name, key)
+        return list(self.scan(table_name))
+
+    def get_page(self, table_name, limit=None, start_after=None, fields=None):
+        """
+        Returns an iterator over a page of documents of the table
+        ordered by primary key. Without limit it iterates the whole table
+        """
+        return self.page(self.scan(table_name, start_after), limit, fields)
+
+    @staticmethod
+    def page(documents, limit=None, fields=None):
+        """
+        Yields up to limit documents with only the fields requested
+        """
+        for count, document in enumerate(documents):
+            if limit and count >= limit:
+                return
+            if fields:
+                document = {field: document[field]
+                            for field in fields if field in document}
+            yield document
+
+    def insert_data(self, table_name, data):
+        """
+        Insert data into table. Documents without primary key get
+        a generated one. Documents with a primary key that
+        already exists are not inserted and counted as errors
+        """
+        documents = data if isinstance(data, list) else [data]
+        result = {'inserted': 0, 'errors': 0}
+        generated_keys = []
+        with self.transaction() as changes:
+            primary_key = self.primary_key(table_name)
+            for document in documents:
+                document = dict(document)
+                if document.get(primary_key) is None:
+                    document[primary_key] = str(uuid.uuid4())
+                    generated_keys.append(document[primary_key])
+                elif self.get_document(
+                        table_name, document[primary_key]) is not None:
+                    result['errors'] += 1
+                    continue
+                self.put_document(table_name, document)
+                changes.append((table_name, None, document))
+                result['inserted'] += 1
+        if generated_keys:
+            result['generated_keys'] = generated_keys
+        return result
+
+    def edit_data(self, table_name, primary_key, new_data):
+        """
+        Edit document from database with a primary key. Like rethink
+        update, nested objects are merged
+        """
+        with self.transaction() as changes:
+            old_val = self.get_document(table_name, primary_key)
+            if old_val is None:
+                return {'replaced': 0, 'skipped': 1}
+            new_val = self.merge(old_val, new_data)
+            self.put_document(table_name, new_val)
+            changes.append((table_name, old_val, new_val))
+        return {'replaced': 1, 'skipped': 0}
+
+    def fill_missing(self, table_name, field, value):
+        """
+        Sets the field to the value in the documents where
+        it is missing or null, in a transaction
+        """
+        with self.transaction() as changes:
+            documents = [document for document in self.scan(table_name)
+                         if document.get(field) is None]
+            for old_val in documents:
+                new_val = dict(old_val, **{field: value})
+                self.put_document(table_name, new_val)
+                changes.append((table_name, old_val, new_val))
+        return {'replaced': len(documents)}
+
+    def replace_data(self, table_name, new_data, primary_key):
+        """
+        Replace the document with the primary key
+        """
+        with self.transaction() as changes:
+            old_val = self.get_document(table_name, primary_key)
+            new_val = dict(new_data)
+            new_val[self.primary_key(table_name)] = primary_key
+            self.put_document(table_name, new_val)
+            changes.append((table_name, old_val, new_val))
+        return {'replaced': int(old_val is not None),
+                'inserted': int(old_val is None)}
+
+    def find(self, table_name, index, values):
+        """
+        Returns the documents whose index matches any of the values.
+        As in rethink the index can be the primary key
+        """
+        if index == self.primary_key(table_name):
+            documents = [self.get_document(table_name, value)
+                         for value in values]
+            return [document for document in documents if document]
+        return self.get_all(table_name, index, values)
+
+    def update_by_index(self, table_name, new_data, index, values):
+        """
+        Updates every document whose secondary index
+        matches any of the values in a transaction
+        :new_data: Fields to update
+        :index: Name of the secondary index
+        :values: List of values to search
+        """
+        with self.transaction() as changes:
+            documents = self.find(table_name, index, values)
+            for old_val in documents:
+                new_val = self.merge(old_val, new_data)
+                self.put_document(table_name, new_val)
+                changes.append((table_name, old_val, new_val))
+        return {'replaced': len(documents)}
+
+    def delete_by_index(self, table_name, index, values):
+        """
+        Deletes every document whose secondary index
+        matches any of the values in a transaction
+        :index: Name of the secondary index
+        :values: List of values to search
+        """
+        with self.transaction() as changes:
+            primary_key = self.primary_key(table_name)
+            documents = self.find(table_name, index, values)
+            for old_val in documents:
+                self.remove_document(table_name, old_val[primary_key])
+                changes.append((table_name, old_val, None))
+        return {'deleted': len(documents)}
+
+    def replace_many(self, table_name, documents):
+        """
+        Replaces the documents with the same primary key, or
+        inserts them if they don't exist, in a transaction
+        """
+        with self.transaction() as changes:
+            primary_key = self.primary_key(table_name)
+            for document in documents:
+                old_val = self.get_document(table_name, document[primary_key])
+                new_val = dict(document)
+                self.put_document(table_name, new_val)
+                changes.append((table_name, old_val, new_val))
+        return {'replaced': len(documents)}
+
+    def acquire_lease(self, table_name, name, owner, duration):
+        """
+        Takes or renews a lease if it is free, expired or already
+        owned by the owner, in a transaction
+        :name: Primary key of the lease
+        :owner: Id of the process that wants the lease
+        :duration: Seconds the lease lasts
+        :return: True if the owner holds the lease
+        """
+        with self.transaction() as changes:
+            now = time.time()
+            old_val = self.get_document(table_name, name)
+            if (old_val is not None and old_val['expires'] >= now and
+                    old_val['owner'] != owner):
+                return False
+            new_val = {'id': name, 'owner': owner, 'expires': now + duration}
+            self.put_document(table_name, new_val)
+            changes.append((table_name, old_val, new_val))
+        return True
+
+    def release_lease(self, table_name, name, owner):
+        """
+        Deletes the lease if it is owned by the owner
+        """
+        with self.transaction() as changes:
+            old_val = self.get_document(table_name, name)
+            if old_val is None or old_val['owner'] != owner:
+                return {'deleted': 0, 'skipped': 1}
+            self.remove_document(table_name, name)
+            changes.append((table_name, old_val, None))
+        return {'deleted': 1, 'skipped': 0}
+
+    def delete_data(self, table_name, data_to_delete):
+        """
+        Delete the document with the primary key
+        """
+        with self.transaction() as changes:
+            old_val = self.get_document(table_name, data_to_delete)
+            if old_val is None:
+                return {'deleted': 0, 'skipped': 1}
+            self.remove_document(table_name, data_to_delete)
+            changes.append((table_name, old_val, None))
+        return {'deleted': 1, 'skipped': 0}
+
+    def delete_between(self, table_name, index, lower, upper):
+        """
+        Delete documents with the index value between lower (included)
+        and upper (excluded)
+        :lower: Lower bound. If it is None there is no lower bound
+        :upper: Upper bound
+        """
+        primary_key = self.primary_key(table_name)
+        with self.transaction() as changes:
+            documents = list(self.index_range(table_name, index, lower, upper))
+            for document in documents:
+                self.remove_document(table_name, document[primary_key])
+                changes.append((table_name, document, None))
+        return {'deleted': len(documents)}
+
+    def filter_data(self, table_name, filter_data):
+        """
+        Returns the documents with the same values as filter_data
+        :filter_data: Object with a key and his value
+        """
+        return [document for document in self.scan(table_name)
+                if all(document.get(key) == value
+                       for key, value in filter_data.items())]
+
+    def join_tables(self, table1, table2, table3, key1, key2,
+                    limit=None, start_after=None, fields=None):
+        """
+        Merge two tables. Returns an iterator over the merged documents,
+        paginated by the primary key of table1
+        :table1: Table in which the other tables are to be combined
+        :table2: First table to merge (left table)
+        :table3: Second table to merge (right table)
+        :key1: Key to search in the left table
+        :key2: KEy to search in the right table
+        """
+        return self.page(
+            self.join(table1, table2, table3, key1, key2, start_after),
+            limit, fields)
+
+    def join(self, table1, table2, table3, key1, key2, start_after=None):
+        """
+        Yields the documents of table1 merged with the documents of table2
+        and table3 they point to. Documents without both are skipped
+        """
+        for document in self.scan(table1, start_after):
+            merged = self.zip(
+                document, self.get_document(table2, document.get(key1)))
+            if merged:
+                merged = self.zip(
+                    merged, self.get_document(table3, merged.get(key2)))
+            if merged:
+                yield merged
+
+    @staticmethod
+    def zip(left, right):
+        """
+        Merges the right document without his id into the left one
+        """
+        if right is None:
+            return None
+        merged = dict(left)
+        merged.update(
+            (key, value) for key, value in right.items() if key != 'id')
+        return merged
+
+    @classmethod
+    def merge(cls, document, new_data):
+        """
+        Returns the document updated with new_data merging nested objects
+        """
+        merged = dict(document)
+        for key, value in new_data.items():
+            if isinstance(value, dict) and isinstance(merged.get(key), dict):
+                value = cls.merge(merged[key], value)
+            merged[key] = value
+        return merged
+
+    @staticmethod
+    def index_value(document, fields):
+        """
+        Returns the value of an index for the document, a tuple for compound
+        indexes, or None if the document has not the indexed fields
+        """
+        values = tuple(document.get(field) for field in fields)
+        if None in values:
+            return None
+        return values[0] if len(values) == 1 else values
+
+    @staticmethod
+    def missing_table(table_name):
+        """
+        Returns the error for a table that doesn't exist
+        """
+        return ReadError('Table {} does not exist'.format(table_name))
@@ -0,0 +1,202 @@
+"""
+In-memory storage
+"""
+import copy
+
+from connectors.local_storage import LocalStorage
+
+
+class MemoryHandler(LocalStorage):
+    """
+    Storage that keeps the tables in memory. Secondary indexes are dicts
+    from the index value to the primary keys. Data is lost when the
+    process ends and writes are not undone if a transaction fails, use
+    it for tests, benchmarks and deployments that don't need to persist
+    """
+
+    def __init__(self):
+        super(MemoryHandler, self).__init__()
+        self.tables = {}
+        self.primary_keys = {}
+        self.indexes = {}
+
+    def reset_database(self):
+        """
+        Removes every table
+        """
+        with self.lock:
+            self.tables.clear()
+            self.primary_keys.clear()
+            self.indexes.clear()
+
+    def table_exists(self, table_name):
+        """
+        True if the table exists
+        """
+        return table_name in self.tables
+
+    def create_table(self, table_name, key='id'):
+        """
+        Table creation. If the table exists it does nothing
+        """
+        with self.lock:
+            if table_name not in self.tables:
+                self.tables[table_name] = {}
+                self.primary_keys[table_name] = key
+                self.indexes[table_name] = {}
+
+    def create_index(self, table_name, index_name, fields=None):
+        """
+        Secondary index creation. If the index exists it does nothing,
+        otherwise indexes the documents of the table
+        :fields: Fields of a compound index. If not provided
+        the index is the field with the same name
+        """
+        with self.lock:
+            indexes = self.table_indexes(table_name)
+            if index_name not in indexes:
+                indexes[index_name] = (fields or [index_name], {})
+                for key, document in self.tables[table_name].items():
+                    self.index(table_name, key, document)
+
+    def primary_key(self, table_name):
+        """
+        Returns the name of the primary key of the table
+        """
+        try:
+            return self.primary_keys[table_name]
+        except KeyError:
+            raise self.missing_table(table_name)
+
+    def table(self, table_name):
+        """
+        Returns the documents of the table by primary key
+        """
+        try:
+            return self.tables[table_name]
+        except KeyError:
+            raise self.missing_table(table_name)
+
+    def table_indexes(self, table_name):
+        """
+        Returns the indexes of the table
+        """
+        try:
+            return self.indexes[table_name]
+        except KeyError:
+            raise self.missing_table(table_name)
+
+    def scan(self, table_name, start_after=None):
+        """
+        Yields the documents of the table ordered by primary key
+        :start_after: Primary key to start after
+        """
+        with self.lock:
+            table = self.table(table_name)
+            keys = sorted(key for key in table
+                          if start_after is None or key > start_after)
+        for key in keys:
+            with self.lock:
+                document = table.get(key)
+            if document is not None:
+                yield copy.deepcopy(document)
+
+    def get_document(self, table_name, key):
+        """
+        Returns the document with the primary key or None
+        """
+        with self.lock:
+            document = self.table(table_name).get(key)
+            return copy.deepcopy(document)
+
+    def put_document(self, table_name, document):
+        """
+        Inserts or replaces a document
+        """
+        key = document[self.primary_key(table_name)]
+        document = copy.deepcopy(document)
+        with self.lock:
+            self.remove_document(table_name, key)
+            self.table(table_name)[key] = document
+            self.index(table_name, key, document)
+
+    def remove_document(self, table_name, key):
+        """
+        Removes the document with the primary key if it exists
+        """
+        with self.lock:
+            document = self.table(table_name).pop(key, None)
+            if document is None:
+                return
+            for fields, values in self.table_indexes(table_name).values():
+                value = self.index_value(document, fields)
+                keys = values.get(value) if value is not None else None
+                if keys:
+                    keys.discard(key)
+                    if not keys:
+                        del values[value]
+
+    def index(self, table_name, key, document):
+        """
+        Adds the document to the indexes of the table
+        """
+        for fields, values in self.table_indexes(table_name).values():
+            value = self.index_value(document, fields)
+            try:
+                if value is not None:
+                    values.setdefault(value, set()).add(key)
+            except TypeError:
+                # Lists and objects are not indexed
+                pass
+
+    def index_fields(self, table_name, index):
+        """
+        Returns the fields of a secondary index
+        """
+        with self.lock:
+            try:
+                return self.table_indexes(table_name)[index][0]
+            except KeyError:
+                raise self.missing_table(table_name + '.' + index)
+
+    def get_all(self, table_name, index, values):
+        """
+        Returns documents whose secondary index matches any of the values
+        :index: Name of the secondary index
+        :values: List of values to search. Values of compound
+        indexes are lists with a value for each field
+        """
+        with self.lock:
+            table = self.table(table_name)
+            indexed = self.table_indexes(table_name)[index][1]
+            documents = []
+            for value in values:
+                if isinstance(value, list):
+                    value = tuple(value)
+                for key in indexed.get(value, ()):
+                    documents.append(copy.deepcopy(table[key]))
+            return documents
+
+    def index_range(self, table_name, index, lower, upper):
+        """
+        Returns the documents with the index value between lower
+        (included, None for no lower bound) and upper (excluded)
+        """
+        with self.lock:
+            table = self.table(table_name)
+            indexed = self.table_indexes(table_name)[index][1]
+            return [copy.deepcopy(table[key])
+                    for value, keys in indexed.items()
+                    if (lower is None or value >= lower) and value < upper
+                    for key in keys]
+
+    def stats(self):
+        """
+        Returns the number of documents of each table
+        """
+        with self.lock:
+            return {
+                'backend': 'memory',
+                'tables': {table_name: len(table)
+                           for table_name, table in self.tables.items()},
+                'subscribers': self.feed.stats()}
@@ -0,0 +1,308 @@
+"""
+Durable outbox of emails
+"""
+import json
+import os
+import sqlite3
+import time
+from threading import Condition, Lock
+
+
+class Outbox():
+    """
+    Queue of rendered emails kept in an SQLite file in WAL mode. Emails
+    are appended when they are rendered and deleted when they are sent,
+    so a slow or unavailable relay doesn't stop the bus consumer and the
+    emails pending survive restarts of the process without rendering
+    them again.
+
+    Senders claim the emails due for a while. If a sender dies before
+    sending them his claims expire and the emails are claimed again, so
+    several processes of the same machine can share the file. Emails
+    that failed stay claimed until their retry, that is scheduled by
+    the process, and a while after it.
+
+    The messages waiting in a digest are buffered in the same file, so
+    they survive restarts too, and they are deleted in the transaction
+    that appends the digest. They belong to the process that buffered
+    them, and are taken by other process only when it is not running
+    """
+
+    def __init__(self, path, claim_timeout=300):
+        """
+        :path: Path of the outbox file, :memory: to keep it in memory
+        :claim_timeout: Seconds an email claimed is not given to other sender
+        """
+        self.path = path
+        self.claim_timeout = claim_timeout
+        self.lock = Lock()
+        self.available = Condition(self.lock)
+        self.room = Condition(self.lock)
+        self.conn = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS outbox ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+            'delivery TEXT NOT NULL, '
+            'created REAL NOT NULL, '
+            'attempts INTEGER NOT NULL DEFAULT 0, '
+            'next_attempt REAL NOT NULL, '
+            'claimed_until REAL, '
+            'last_error TEXT)')
+        self.conn.execute(
+            'CREATE INDEX IF NOT EXISTS outbox_next_attempt '
+            'ON outbox (next_attempt)')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS digests ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+            'key TEXT NOT NULL, '
+            'digest TEXT NOT NULL, '
+            'message TEXT NOT NULL, '
+            'pid INTEGER NOT NULL)')
+        # Emails in the file, counted again when it reaches the maximum
+        # because other processes sharing the file also add and send them
+        self.depth = self.count()
+        self.appended = 0
+        self.wakeups = 0
+        self.sent = 0
+        self.retried = 0
+        self.dead = 0
+        self.full_waits = 0
+
+    def append(self, delivery, delay=0):
+        """
+        Writes an email to the outbox. When it returns the email
+        is in the file and can't be lost
+        :delivery: Email rendered, a dict that can be serialized to json
+        :delay: Seconds to wait before sending it
+        """
+        self.extend([delivery], delay)
+
+    def extend(self, deliveries, delay=0, buffered=()):
+        """
+        Writes several emails to the outbox in a single transaction
+        :deliveries: List of emails rendered
+        :delay: Seconds to wait before sending them
+        :buffered: Ids of the messages buffered to delete, the
+        ones of the digest appended
+        """
+        now = time.time()
+        with self.available:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                self.conn.executemany(
+                    'INSERT INTO outbox (delivery, created, next_attempt) '
+                    'VALUES (?, ?, ?)',
+                    [(json.dumps(delivery), now, now + delay)
+                     for delivery in deliveries])
+                self.conn.executemany(
+                    'DELETE FROM digests WHERE id = ?',
+                    [(message_id,) for message_id in buffered])
+                self.conn.execute('COMMIT')
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.appended += len(deliveries)
+            self.depth += len(deliveries)
+            self.wakeups += 1
+            self.available.notify(len(deliveries))
+
+    def buffer(self, key, digest, message):
+        """
+        Writes a message of a digest. When it returns the message
+        is in the file and can't be lost
+        :key: Key of the digest, serializable to json
+        :digest: Dict with the fields of the digest
+        :message: Message added to the digest
+        :return: Id of the message buffered
+        """
+        with self.lock:
+            cursor = self.conn.execute(
+                'INSERT INTO digests (key, digest, message, pid) '
+                'VALUES (?, ?, ?, ?)',
+                (json.dumps(key), json.dumps(digest), json.dumps(message),
+                 os.getpid()))
+            return cursor.lastrowid
+
+    def buffered(self):
+        """
+        Takes the messages buffered by the processes that are not running
+        and returns the ones of this process in the order they were written
+        :return: List of tuples (id, key, digest, message)
+        """
+        pid = os.getpid()
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                owners = [row[0] for row in self.conn.execute(
+                    'SELECT DISTINCT pid FROM digests WHERE pid != ?',
+                    (pid,))]
+                self.conn.executemany(
+                    'UPDATE digests SET pid = ? WHERE pid = ?',
+                    [(pid, owner) for owner in owners
+                     if not self.is_running(owner)])
+                rows = self.conn.execute(
+                    'SELECT id, key, digest, message FROM digests '
+                    'WHERE pid = ? ORDER BY id', (pid,)).fetchall()
+                self.conn.execute('COMMIT')
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+        return [(message_id, json.loads(key), json.loads(digest),
+                 json.loads(message))
+                for message_id, key, digest, message in rows]
+
+    @staticmethod
+    def is_running(pid):
+        """
+        True if a process of the machine has the pid
+        """
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def wait_room(self, max_depth, timeout=1):
+        """
+        Blocks while the outbox holds max_depth emails or more
+        :max_depth: Maximum number of emails. With 0 it never blocks
+        :timeout: Seconds between counts of the emails, to see the
+        ones sent by other processes. The ones they append are seen
+        when the emails are counted, so they can exceed the maximum
+        """
+        with self.room:
+            while max_depth and self.depth >= max_depth:
+                self.depth = self.count()
+                if self.depth < max_depth:
+                    return
+                self.full_waits += 1
+                self.room.wait(timeout)
+
+    def count(self):
+        """
+        Returns the number of emails in the file
+        """
+        return self.conn.execute('SELECT COUNT(*) FROM outbox').fetchone()[0]
+
+    def claim(self, limit=1):
+        """
+        Claims the emails due that are not claimed by other sender
+        :limit: Maximum number of emails
+        :return: List of tuples (id, delivery, attempts)
+        """
+        now = time.time()
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self.conn.execute(
+                    'SELECT id, delivery, attempts FROM outbox '
+                    'WHERE next_attempt <= ? AND '
+                    '(claimed_until IS NULL OR claimed_until < ?) '
+                    'ORDER BY next_attempt LIMIT ?',
+                    (now, now, limit)).fetchall()
+                self.conn.executemany(
+                    'UPDATE outbox SET claimed_until = ? WHERE id = ?',
+                    [(now + self.claim_timeout, row[0]) for row in rows])
+                self.conn.execute('COMMIT')
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+        return [(email_id, json.loads(delivery), attempts)
+                for email_id, delivery, attempts in rows]
+
+    def get(self, email_id):
+        """
+        Returns a tuple (delivery, attempts) of an email
+        or None if it is not in the outbox
+        """
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT delivery, attempts FROM outbox WHERE id = ?',
+                (email_id,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def wait(self, wakeups, timeout):
+        """
+        Waits until an email is appended by this process, wake
+        is called or the timeout
+        :wakeups: Value of wakeups before claiming, so an email
+        appended meanwhile doesn't wait
+        :timeout: Seconds to wait for emails of other processes
+        """
+        with self.available:
+            if self.wakeups == wakeups:
+                self.available.wait(timeout)
+
+    def wake(self, count=1):
+        """
+        Wakes up the senders waiting
+        :count: Number of senders to wake up
+        """
+        with self.available:
+            self.wakeups += 1
+            self.available.notify(count)
+
+    def done(self, email_id):
+        """
+        Deletes an email sent
+        """
+        with self.lock:
+            self.conn.execute('DELETE FROM outbox WHERE id = ?', (email_id,))
+            self.sent += 1
+            self.depth -= 1
+            self.room.notify()
+
+    def retry(self, email_id, error, delay):
+        """
+        Records a failed attempt of an email that is sent again after a
+        delay. The email stays claimed until claim_timeout after the
+        retry, so it is only claimed by others if the process dies
+        :error: Description of the error
+        :delay: Seconds to wait before sending it again
+        """
+        next_attempt = time.time() + delay
+        with self.lock:
+            self.conn.execute(
+                'UPDATE outbox SET attempts = attempts + 1, '
+                'next_attempt = ?, claimed_until = ?, last_error = ? '
+                'WHERE id = ?',
+                (next_attempt, next_attempt + self.claim_timeout, error,
+                 email_id))
+            self.retried += 1
+
+    def discard(self, email_id):
+        """
+        Deletes an email that won't be sent
+        """
+        with self.lock:
+            self.conn.execute('DELETE FROM outbox WHERE id = ?', (email_id,))
+            self.dead += 1
+            self.depth -= 1
+            self.room.notify()
+
+    def stats(self):
+        """
+        Returns the number of emails pending and the age of the oldest
+        """
+        with self.lock:
+            depth, oldest, retrying = self.conn.execute(
+                'SELECT COUNT(*), MIN(created), '
+                'COUNT(CASE WHEN attempts > 0 THEN 1 END) '
+                'FROM outbox').fetchone()
+            self.depth = depth
+            return {
+                'depth': depth,
+                'oldest_age_seconds': time.time() - oldest if oldest else 0,
+                'retrying': retrying,
+                'appended': self.appended,
+                'sent': self.sent,
+                'retried': self.retried,
+                'dead': self.dead,
+                'full_waits': self.full_waits}
@@ -0,0 +1,406 @@
+"""
+RabbitMQ consumer
+"""
+import json
+import queue
+import time
+from collections import deque
+from threading import Thread, Event, Lock
+
+import pika
+
+import errors
+import settings as st
+
+# Headers of the messages published again after a failure
+FAILURES_HEADER = 'x-notifyme-failures'
+EXCHANGE_HEADER = 'x-notifyme-exchange'
+ROUTING_KEY_HEADER = 'x-notifyme-routing-key'
+
+
+class RabbitMQConsumer(Thread):
+    """
+    Consumer of the notifyme queue with the same methods as the raccoon
+    Consumer. Messages are passed to on_message as dicts with the exchange
+    and routing key in his metadata, and with a tag to complete them.
+
+    Messages are acknowledged when they are completed, from any thread,
+    so a message that fails is delivered again. Acknowledgements are
+    sent in batches: the tags completed in order are acknowledged at once
+    with a single multiple ack, every ack_interval or when half of the
+    prefetch is completed. A message that fails is published again at
+    the end of the queue with his failures counted in a header, keeping
+    his exchange and routing key, and acknowledged. After max_attempts
+    failures it is rejected. Redeliveries after a connection is lost
+    are not counted as failures.
+
+    The broker sends up to prefetch messages without acknowledgement to
+    each consumer, so several processes consuming the same queue share
+    its messages. Pika connections are not thread safe, so binds, unbinds
+    and acks requested from other threads are run by the consumer thread
+    between deliveries. If the connection is lost it is opened again
+    and the queue is bound again to the current bindings. Messages not
+    acknowledged before are delivered again by the broker.
+
+    The exchange of a binding is declared with the type and durability
+    of his bus filter if it doesn't exist. Bindings that can't be applied
+    are kept pending and retried every retry_wait
+    """
+
+    def __init__(self, on_message, server, user, password, subscriptions,
+                 queue_name, prefetch=1, ack_interval=100, max_attempts=2,
+                 retry_wait=5, poll_interval=0.1):
+        """
+        :on_message: Callable that receives every message and his tag
+        :subscriptions: Bus filters to bind the queue to when it starts
+        :queue_name: Queue shared by every consumer
+        :prefetch: Messages sent by the broker without acknowledgement
+        :ack_interval: Maximum milliseconds a completed
+        message waits to be acknowledged
+        :max_attempts: Times a message is processed before rejecting it
+        :retry_wait: Seconds to wait before connecting again
+        or binding again after an error
+        :poll_interval: Maximum seconds a bind waits to be run
+        """
+        super(RabbitMQConsumer, self).__init__(daemon=True)
+        self.on_message = on_message
+        self.server = server
+        self.user = user
+        self.password = password
+        self.queue_name = queue_name
+        self.prefetch = prefetch
+        self.ack_interval = ack_interval / 1000
+        self.ack_batch = max(1, prefetch // 2)
+        self.max_attempts = max_attempts
+        self.retry_wait = retry_wait
+        self.poll_interval = poll_interval
+        self.bindings = set()
+        # Type and durability to declare the exchange of each binding
+        self.exchanges = {}
+        for bus_filter in subscriptions:
+            self.bindings.add(
+                (bus_filter.get('exchange'), bus_filter.get('key') or ''))
+            self.exchanges[bus_filter.get('exchange')] = (
+                bus_filter.get('exchange_type'), bus_filter.get('durable'))
+        # Bindings that failed, retried every retry_wait
+        self.pending = set()
+        self.bindings_retried_at = time.monotonic()
+        self.operations = queue.Queue()
+        self.stopped = Event()
+        self.connection = None
+        self.channel = None
+        self.lock = Lock()
+        # Tags received in order and not acknowledged, with the
+        # message to publish it again if it fails
+        self.unacked = deque()
+        # Tags completed with his result, shared with other threads
+        self.completed = {}
+        self.generation = 0
+        self.flushed = time.monotonic()
+        self.received = 0
+        self.failed = 0
+        self.acked = 0
+        self.rejected = 0
+        self.republished = 0
+        self.ack_batches = 0
+        self.reconnections = 0
+
+    def run(self):
+        """
+        Thread running. Consumes until stopped, connecting again
+        when the connection is lost
+        """
+        while not self.stopped.is_set():
+            try:
+                self.connect()
+                while not self.stopped.is_set():
+                    self.run_operations()
+                    self.retry_bindings()
+                    self.flush_acks()
+                    self.connection.process_data_events(
+                        time_limit=self.poll_interval)
+                self.flush_acks(force=True)
+            except pika.exceptions.AMQPError as error:
+                st.logger.error('Bus connection lost: %r', error)
+                with self.lock:
+                    self.reconnections += 1
+                self.stopped.wait(self.retry_wait)
+            finally:
+                self.close()
+
+    def connect(self):
+        """
+        Opens the connection, declares and binds the queue
+        and starts consuming from it
+        """
+        self.connection = pika.BlockingConnection(pika.ConnectionParameters(
+            host=self.server,
+            credentials=pika.PlainCredentials(self.user, self.password)))
+        with self.lock:
+            # Tags belong to a channel, the new one starts again
+            self.generation += 1
+            self.unacked.clear()
+            self.completed.clear()
+        self.channel = self.connection.channel()
+        self.channel.basic_qos(prefetch_count=self.prefetch)
+        self.declare_queue()
+        self.pending = set(self.bindings)
+        self.retry_bindings(force=True)
+        self.channel.basic_consume(
+            self.receive, queue=self.queue_name, no_ack=False)
+
+    def close(self):
+        """
+        Closes the connection if it is open
+        """
+        connection = self.connection
+        self.connection = None
+        self.channel = None
+        if connection and connection.is_open:
+            try:
+                connection.close()
+            except pika.exceptions.AMQPError:
+                pass
+
+    def declare_queue(self):
+        """
+        Uses the queue if it exists, whatever his flags, or creates it
+        durable. Declaring an existing queue with other flags fails, so
+        it is checked first in a channel of its own
+        """
+        channel = self.connection.channel()
+        try:
+            channel.queue_declare(queue=self.queue_name, passive=True)
+            channel.close()
+        except pika.exceptions.ChannelClosed:
+            self.channel.queue_declare(queue=self.queue_name, durable=True)
+
+    def declare_exchange(self, exchange):
+        """
+        Declares the exchange of a binding if it doesn't exist, with
+        the type and durability of his bus filter. Existing exchanges
+        are used as they are, like the queue
+        :return: True if the exchange exists
+        """
+        channel = self.connection.channel()
+        try:
+            channel.exchange_declare(exchange=exchange, passive=True)
+            channel.close()
+            return True
+        except pika.exceptions.ChannelClosed:
+            pass
+        exchange_type, durable = self.exchanges.get(exchange, (None, None))
+        if not exchange_type:
+            return False
+        channel = self.connection.channel()
+        channel.exchange_declare(
+            exchange=exchange, exchange_type=exchange_type,
+            durable=bool(durable))
+        channel.close()
+        return True
+
+    def run_operations(self):
+        """
+        Runs the binds and unbinds requested
+        """
+        while True:
+            try:
+                exchange, key, bind, declaration = \
+                    self.operations.get_nowait()
+            except queue.Empty:
+                return
+            if bind:
+                if declaration[0]:
+                    self.exchanges[exchange] = declaration
+                self.bindings.add((exchange, key))
+                if not self.apply_binding(exchange, key, True):
+                    self.pending.add((exchange, key))
+            else:
+                self.bindings.discard((exchange, key))
+                self.pending.discard((exchange, key))
+                self.apply_binding(exchange, key, False)
+
+    def retry_bindings(self, force=False):
+        """
+        Applies the bindings pending every retry_wait
+        :force: Applies them without waiting
+        """
+        now = time.monotonic()
+        if not self.pending or (not force and (
+                now - self.bindings_retried_at < self.retry_wait)):
+            return
+        self.bindings_retried_at = now
+        for exchange, key in list(self.pending):
+            if self.apply_binding(exchange, key, True):
+                self.pending.discard((exchange, key))
+
+    def apply_binding(self, exchange, key, bind):
+        """
+        Binds or unbinds the queue in a channel of its own, because
+        the broker closes the channel when the exchange doesn't exist
+        :return: True if the binding was applied
+        """
+        try:
+            if bind and not self.declare_exchange(exchange):
+                st.logger.error(
+                    'Exchange %s doesn\'t exist, binding it later', exchange)
+                return False
+            channel = self.connection.channel()
+            if bind:
+                channel.queue_bind(
+                    queue=self.queue_name, exchange=exchange,
+                    routing_key=key)
+            else:
+                channel.queue_unbind(
+                    queue=self.queue_name, exchange=exchange,
+                    routing_key=key)
+        except pika.exceptions.ChannelClosed as error:
+            st.logger.error(
+                'Error binding the queue to %s %s: %r', exchange, key, error)
+            return False
+        channel.close()
+        return True
+
+    def receive(self, channel, method, properties, body):
+        """
+        Passes a delivery to on_message. It is acknowledged
+        when it is completed
+        """
+        properties = properties or pika.BasicProperties()
+        headers = properties.headers or {}
+        delivery = {
+            'body': body,
+            'properties': properties,
+            'exchange': headers.get(EXCHANGE_HEADER, method.exchange),
+            'routing_key': headers.get(
+                ROUTING_KEY_HEADER, method.routing_key),
+            'failures': headers.get(FAILURES_HEADER, 0)}
+        with self.lock:
+            self.received += 1
+            self.unacked.append((method.delivery_tag, delivery))
+            tag = (self.generation, method.delivery_tag)
+        try:
+            message = json.loads(body.decode(st.APP_CHARSET))
+            message.setdefault('metadata', {}).update({
+                'exchange': delivery['exchange'],
+                'routing_key': delivery['routing_key']})
+            self.on_message(message, tag)
+        except BaseException as error:
+            errors.process_exception(error, body=body)
+            self.complete(tag, False)
+
+    def complete(self, tag, success=True):
+        """
+        Marks a message as completed. It can be called from any thread
+        :tag: Tag received with the message
+        :success: False if the message failed and has to be delivered again
+        """
+        generation, delivery_tag = tag
+        with self.lock:
+            if generation != self.generation:
+                # The channel was closed and the message requeued
+                return
+            self.completed[delivery_tag] = success
+            if not success:
+                self.failed += 1
+
+    def flush_acks(self, force=False):
+        """
+        Acknowledges the messages completed in the order they were
+        received. Failures are published again before and acknowledged
+        with the successes. Consecutive acknowledgements are sent in a
+        single multiple ack and the messages that failed too many
+        times are rejected one by one
+        :force: Acknowledges without waiting for the batch to fill
+        """
+        now = time.monotonic()
+        operations = []
+        with self.lock:
+            if not self.completed or not (
+                    force or len(self.completed) >= self.ack_batch or
+                    now - self.flushed >= self.ack_interval):
+                return
+            self.flushed = now
+            last = None
+            while self.unacked and self.unacked[0][0] in self.completed:
+                delivery_tag, delivery = self.unacked.popleft()
+                success = self.completed.pop(delivery_tag)
+                if (not success and
+                        delivery['failures'] + 1 < self.max_attempts):
+                    operations.append(('publish', delivery))
+                    self.republished += 1
+                    success = True
+                if success:
+                    last = delivery_tag
+                    self.acked += 1
+                    continue
+                if last is not None:
+                    operations.append(('ack', last))
+                    last = None
+                operations.append(('reject', delivery_tag))
+                self.rejected += 1
+            if last is not None:
+                operations.append(('ack', last))
+            self.ack_batches += sum(
+                1 for operation in operations if operation[0] == 'ack')
+        for operation, value in operations:
+            if operation == 'publish':
+                self.publish_failed(value)
+            elif operation == 'ack':
+                self.channel.basic_ack(delivery_tag=value, multiple=True)
+            else:
+                self.channel.basic_nack(delivery_tag=value, requeue=False)
+
+    def publish_failed(self, delivery):
+        """
+        Publishes a message that failed at the end of the queue, through
+        the default exchange, with one more failure in his headers
+        :delivery: Message received and his failures
+        """
+        properties = delivery['properties']
+        properties.headers = dict(properties.headers or {}, **{
+            FAILURES_HEADER: delivery['failures'] + 1,
+            EXCHANGE_HEADER: delivery['exchange'],
+            ROUTING_KEY_HEADER: delivery['routing_key']})
+        self.channel.basic_publish(
+            exchange='', routing_key=self.queue_name,
+            body=delivery['body'], properties=properties)
+
+    def bind_queue(self, exchange, key, exchange_type=None, durable=False):
+        """
+        Binds the queue to the exchange and key
+        :exchange_type: Type to declare the exchange if it doesn't exist
+        :durable: If the exchange declared is durable
+        """
+        self.operations.put(
+            (exchange, key or '', True, (exchange_type, durable)))
+
+    def unbind_queue(self, exchange, key):
+        """
+        Unbinds the queue from the exchange and key
+        """
+        self.operations.put((exchange, key or '', False, None))
+
+    def stop(self):
+        """
+        Stops consuming. The connection is closed by the consumer thread
+        """
+        self.stopped.set()
+
+    def stats(self):
+        """
+        Returns the consumer counters
+        """
+        with self.lock:
+            return {
+                'prefetch': self.prefetch,
+                'bindings': len(self.bindings),
+                'pending_bindings': len(self.pending),
+                'received': self.received,
+                'unacked': len(self.unacked),
+                'acked': self.acked,
+                'ack_batches': self.ack_batches,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'republished': self.republished,
+                'reconnections': self.reconnections}
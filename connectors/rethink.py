@@ -3,8 +3,248 @@
 Rethink connector to a rethink database
 """
 import time
+import socket
+from collections import deque
+from contextlib import contextmanager
+from itertools import count
+from threading import Condition, Lock, Thread
+
 import rethinkdb as r
+from rethinkdb.net import Cursor
 from exceptions.db_exceptions import WriteError, ReadError, ConnectionLost
+from connectors.rethink_realtime import BDRealtime
+
+# Timeout of the queries that use the query_timeout of the handler
+DEFAULT_TIMEOUT = object()
+
+
+class RethinkPool():
+    """
+    Thread-safe pool of connections to a rethink database. Connections
+    are borrowed for a query and returned afterwards, so queries don't
+    pay the connection handshake. Pools are shared by every handler
+    connected to the same database.
+    """
+
+    pools = {}
+    pools_lock = Lock()
+
+    def __init__(self, server, port, db_name, user=None, password=None,
+                 min_size=1, max_size=10, wait_time=100, n_retries=2):
+        """
+        :min_size: Connections opened when the pool is created
+        :max_size: Maximum number of connections opened at the same time
+        :wait_time: Milliseconds to wait before the first reconnection
+        retry. It doubles on every retry
+        :n_retries: Number of retries when a connection can't be opened
+        """
+        self.server = server
+        self.port = port
+        self.db_name = db_name
+        self.user = user
+        self.password = password
+        self.max_size = max_size
+        self.wait_time = wait_time
+        self.n_retries = n_retries
+        self.condition = Condition()
+        self.idle = deque()
+        self.opened = 0
+        self.connections_created = 0
+        for i in range(min_size):
+            self.idle.append(self.open())
+            self.opened += 1
+
+    @classmethod
+    def shared(cls, server, port, db_name, user=None, password=None,
+               **options):
+        """
+        Returns the pool of the database, creating it the first time
+        """
+        key = (server, port, db_name, user)
+        with cls.pools_lock:
+            pool = cls.pools.get(key)
+            if not pool:
+                pool = cls(server, port, db_name, user, password, **options)
+                cls.pools[key] = pool
+            return pool
+
+    def open(self):
+        """
+        Opens a connection. Retries with exponential backoff
+        """
+        wait = self.wait_time / 1000
+        for attempt in range(self.n_retries + 1):
+            try:
+                conn = r.connect(
+                    host=self.server,
+                    port=self.port,
+                    db=self.db_name,
+                    user=self.user,
+                    password=self.password)
+                self.connections_created += 1
+                return conn
+            except BaseException:
+                if attempt == self.n_retries:
+                    raise ConnectionLost()
+                time.sleep(wait)
+                wait = wait * 2
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrows a connection from the pool
+        """
+        conn = self.borrow()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def borrow(self):
+        """
+        Returns an open connection. Blocks while every
+        connection is in use and the pool is full
+        """
+        with self.condition:
+            while not self.idle and self.opened >= self.max_size:
+                self.condition.wait()
+            if self.idle:
+                conn = self.idle.pop()
+            else:
+                conn = None
+                self.opened += 1
+
+        try:
+            if conn is None:
+                return self.open()
+            if not conn.is_open():
+                conn.reconnect(noreply_wait=False)
+            return conn
+        except BaseException:
+            with self.condition:
+                self.opened -= 1
+                self.condition.notify()
+            raise ConnectionLost()
+
+    def release(self, conn, discard=False):
+        """
+        Returns the connection to the pool. Closed connections
+        are dropped and reopened when needed
+        :discard: Closes the connection instead of returning it, for
+        connections that can't be used anymore even if they look open
+        """
+        if discard:
+            try:
+                conn.close(noreply_wait=False)
+            except BaseException:
+                pass
+        with self.condition:
+            if not discard and conn.is_open():
+                self.idle.append(conn)
+            else:
+                self.opened -= 1
+            self.condition.notify()
+
+    def stats(self):
+        """
+        Returns pool counters
+        """
+        with self.condition:
+            return {
+                'opened': self.opened,
+                'idle': len(self.idle),
+                'max_size': self.max_size,
+                'connections_created': self.connections_created}
+
+
+class QueryWatchdog(Thread):
+    """
+    Single thread that interrupts the queries running longer than their
+    timeout. The driver has no timeout for queries, so the socket of the
+    connection is shut down. That wakes up the thread reading it with an
+    error, and the driver closes the connection in that thread, so it is
+    never closed while another thread is using it
+    """
+
+    instance = None
+    instance_lock = Lock()
+
+    def __init__(self, interval=0.5):
+        """
+        :interval: Seconds between checks of the queries running
+        """
+        super(QueryWatchdog, self).__init__(name='query-watchdog', daemon=True)
+        self.interval = interval
+        self.lock = Lock()
+        self.keys = count()
+        self.watched = {}
+        # Keys of the queries interrupted and not unwatched yet
+        self.interrupted_keys = set()
+        self.interrupted = 0
+
+    @classmethod
+    def shared(cls):
+        """
+        Returns the watchdog of the process, starting it the first time
+        """
+        with cls.instance_lock:
+            if not cls.instance:
+                cls.instance = cls()
+                cls.instance.start()
+            return cls.instance
+
+    def watch(self, conn, timeout):
+        """
+        Starts watching a query
+        :conn: Connection running the query
+        :timeout: Seconds the query can run
+        :return: Key to stop watching it
+        """
+        key = next(self.keys)
+        with self.lock:
+            self.watched[key] = (time.monotonic() + timeout, conn)
+        return key
+
+    def unwatch(self, key):
+        """
+        Stops watching a query. Once it returns the connection
+        is not interrupted anymore
+        :return: True if the query was interrupted. His connection
+        can still look open, but it can't be used again
+        """
+        with self.lock:
+            self.watched.pop(key, None)
+            if key in self.interrupted_keys:
+                self.interrupted_keys.discard(key)
+                return True
+            return False
+
+    def run(self):
+        """
+        Thread running. Interrupts the queries expired
+        """
+        while True:
+            time.sleep(self.interval)
+            now = time.monotonic()
+            with self.lock:
+                expired = [key for key, (deadline, _) in self.watched.items()
+                           if deadline <= now]
+                for key in expired:
+                    self.interrupt(self.watched.pop(key)[1])
+                    self.interrupted_keys.add(key)
+                self.interrupted += len(expired)
+
+    @staticmethod
+    def interrupt(conn):
+        """
+        Shuts down the socket of a connection. The connection
+        is closed by the thread reading it
+        """
+        try:
+            conn._instance._socket._socket.shutdown(socket.SHUT_RDWR)
+        except (AttributeError, OSError):
+            # The connection was already closed
+            pass
 
 
 class RethinkHandler():
@@ -12,43 +252,140 @@ class RethinkHandler():
     Rethink handler to handle connection with database
     """
 
-    def __init__(self, server, port, db_name, user=None, password=None):
+    def __init__(self, server, port, db_name, user=None, password=None,
+                 query_timeout=None, **pool_options):
+        """
+        :query_timeout: Seconds a query can run before closing his connection
+        :pool_options: Options of the connection pool if it is created
+        """
         self.server = server
         self.port = port
         self.db_name = db_name
         self.user = user
         self.password = password
+        self.query_timeout = query_timeout
 
-        self.wait_time = 100
-        self.n_retries = 2
+        self.pool = RethinkPool.shared(
+            server, port, db_name, user, password, **pool_options)
 
-        self.con = self.connect()
-        self.create_database()
-    
-    def connect(self):
+    def run(self, query, timeout=DEFAULT_TIMEOUT, **options):
         """
-        Connect to the database
+        Runs a query in a connection of the pool. Cursors are read before
+        returning the connection so the result is always a list or a value.
+        If the query takes longer than the timeout it is interrupted and
+        his connection is closed
+        :timeout: Seconds the query can run, query_timeout if not
+        provided. None for the schema operations, that can take longer
         """
+        if timeout is DEFAULT_TIMEOUT:
+            timeout = self.query_timeout
+        conn = self.pool.borrow()
+        key = None
+        interrupted = False
         try:
-            return r.connect(
-                host=self.server,
-                port=self.port,
-                db=self.db_name,
-                user=self.user,
-                password=self.password).repl()
-        except ConnectionLost:
-            self.reconnect()
-            raise ConnectionLost()
-    
-    def reconnect(self):
-        self.con.reconnect(noreply_wait=False)
+            if timeout:
+                key = QueryWatchdog.shared().watch(conn, timeout)
+            result = query.run(conn, **options)
+            if isinstance(result, Cursor):
+                result = list(result)
+            return result
+        finally:
+            if key is not None:
+                interrupted = QueryWatchdog.shared().unwatch(key)
+            self.pool.release(conn, discard=interrupted)
+
+    def iterate(self, query, **options):
+        """
+        Runs a query and yields the documents as the cursor receives them
+        from the server, so the whole result is never in memory. The
+        connection is kept until the iteration ends or is closed
+        """
+        with self.pool.connection() as conn:
+            try:
+                result = query.run(conn, **options)
+            except Exception:
+                raise ReadError()
+            try:
+                for document in result:
+                    yield document
+            except Exception:
+                raise ReadError()
+            finally:
+                if isinstance(result, Cursor):
+                    result.close()
+
+    @staticmethod
+    def paginate(table, limit=None, start_after=None):
+        """
+        Orders a table by his primary key when a page is requested
+        :limit: Maximum number of documents of the page
+        :start_after: Primary key of the last document of the previous page
+        """
+        if start_after is not None:
+            table = table.between(start_after, r.maxval, left_bound='open')
+        if limit or start_after is not None:
+            table = table.order_by(index='id')
+        return table
+
+    @staticmethod
+    def page(query, limit=None, fields=None):
+        """
+        Applies the projection and the limit of a page
+        :fields: Fields to return of every document, all if not provided
+        """
+        if fields:
+            query = query.pluck(*fields)
+        if limit:
+            query = query.limit(limit)
+        return query
+
+    def get_page(self, table_name, limit=None, start_after=None, fields=None):
+        """
+        Returns an iterator over a page of documents of the table
+        ordered by primary key. Without limit it iterates the whole table
+        """
+        query = self.paginate(r.table(table_name), limit, start_after)
+        return self.iterate(
+            self.page(query, limit, fields), time_format="raw")
+
+    def changes(self, table_name):
+        """
+        Returns the changefeed of the table. It uses its own connection
+        because iterating the changes blocks it, closed with the changefeed
+        """
+        realtime = BDRealtime(self.server, self.port, self.db_name)
+        return realtime.get_data(table_name)
+
+    def index_changes(self, table_name, index, value):
+        """
+        Returns the changefeed of the documents whose secondary index
+        has the value. It uses its own connection like changes
+        """
+        realtime = BDRealtime(self.server, self.port, self.db_name)
+        return realtime.get_index_changes(table_name, index, value)
+
+    def changefeed(self, table_names, include_initial=False):
+        """
+        Returns a single changefeed with the changes of several tables
+        in one connection. See BDRealtime.get_changes
+        """
+        realtime = BDRealtime(self.server, self.port, self.db_name)
+        return realtime.get_changes(table_names, include_initial)
+
+    def stats(self):
+        """
+        Returns the counters of the connection pool
+        """
+        stats = self.pool.stats()
+        stats['backend'] = 'rethink'
+        return stats
 
     def create_database(self):
         """
         Database creation.
         """
         db_name = self.db_name
-        with self.connect() as conn:
+        with self.pool.connection() as conn:
             if db_name not in r.db_list().run(conn):
                 r.db_create(db_name).run(conn)
 
@@ -58,108 +395,250 @@ class RethinkHandler():
         If it doesn't exist, create it
         """
         db_name = self.db_name
-        with self.connect() as conn:
+        with self.pool.connection() as conn:
             if db_name in r.db_list().run(conn):
                 r.db_drop(db_name).run(conn)
-                r.db_create(db_name).run(conn)
+            r.db_create(db_name).run(conn)
+
+    def table_exists(self, table_name):
+        """
+        True if the database and the table exist
+        """
+        db_name = self.db_name
+        with self.pool.connection() as conn:
+            return (db_name in r.db_list().run(conn) and
+                    table_name in r.db(db_name).table_list().run(conn))
 
     def create_table(self, table_name, key='id'):
         """
         Table creation. If the Table exists drops it and recreates
         """
         db_name = self.db_name
-        with self.connect() as conn:
+        with self.pool.connection() as conn:
             if table_name not in r.db(db_name).table_list().run(conn):
                 r.db(db_name).table_create(table_name, primary_key=key).run(conn)
 
-    def insert_data(self, table_name, data):
+    def create_index(self, table_name, index_name, fields=None):
         """
-        Insert data into table. The connection will be automatically closed 
-        when execution reaches the end of the block 
+        Secondary index creation. If the index exists it does nothing.
+        The index is built in background, use wait_indexes to wait for it
+        :fields: Fields of a compound index. If not provided
+        the index is the field with the same name
         """
         db_name = self.db_name
-        with self.connect() as conn:
-            try:
-                if table_name in r.db(db_name).table_list().run(conn):
-                    return r.table(table_name).insert(data).run(conn)
-            except BaseException:
-                raise WriteError()
+        with self.pool.connection() as conn:
+            table = r.db(db_name).table(table_name)
+            if index_name not in table.index_list().run(conn):
+                if fields:
+                    table.index_create(
+                        index_name, [r.row[field] for field in fields]).run(conn)
+                else:
+                    table.index_create(index_name).run(conn)
+
+    def wait_indexes(self, table_name):
+        """
+        Waits until every secondary index of the table is ready. Building
+        an index of a big table takes longer than query_timeout, so it
+        is not interrupted
+        """
+        self.run(r.db(self.db_name).table(table_name).index_wait(),
+                 timeout=None)
+
+    def fill_missing(self, table_name, field, value):
+        """
+        Sets the field to the value in the documents where it is missing
+        or null, to migrate them. It runs over the whole table, so it
+        is not interrupted
+        """
+        try:
+            return self.run(r.db(self.db_name).table(table_name).filter(
+                lambda document: document[field].default(None).eq(None)
+            ).update({field: value}), timeout=None)
+        except BaseException:
+            raise WriteError()
+
+    def insert_data(self, table_name, data):
+        """
+        Insert data into table. The table must exist, it is created
+        by the schema bootstrap
+        """
+        try:
+            return self.run(r.table(table_name).insert(data))
+        except BaseException:
+            raise WriteError()
 
     def get_data(self, table_name, key):
         """"
-        Returns data from table. The connection will be automatically closed 
-        when execution reaches the end of the block 
+        Returns data from table. The connection is returned
+        to the pool when the query ends. Use get_page to iterate
+        big tables without reading them at once
         """
-        with self.connect() as conn:
-            try:
-                if key:
-                    return r.table(table_name).get(key).run(conn)
-                return r.table(table_name).run(conn, time_format="raw")
+        try:
+            if key:
+                return self.run(r.table(table_name).get(key))
+            return self.run(r.table(table_name), time_format="raw")
 
-            except BaseException:
-                raise ReadError()
+        except BaseException:
+            raise ReadError()
 
     def edit_data(self, table_name, primary_key, new_data):
         """
         Edit document from database with a primary key
         """
-        with self.connect() as conn:
-            try:
-                return r.table(table_name).get(
-                    primary_key).update(new_data).run(conn)
+        try:
+            return self.run(r.table(table_name).get(
+                primary_key).update(new_data))
 
-            except BaseException:
-                raise WriteError()
+        except BaseException:
+            raise WriteError()
 
     def replace_data(self, table_name, new_data, primary_key):
         """
         Edit document from database with a primary key
         """
-        with self.connect() as conn:
-            try:
-                return (r.table(table_name).get(
-                    primary_key).replace(new_data).run(conn))
+        try:
+            return self.run(r.table(table_name).get(
+                primary_key).replace(new_data))
 
-            except BaseException:
-                raise WriteError()
+        except BaseException:
+            raise WriteError()
 
     def filter_data(self, table_name, filter_data):
         """
         Returns filtered documents from database.
         :filter_data: Object with a key and his value
         """
-        with self.connect() as conn:
-            try:
-                return r.table(table_name).filter(filter_data).run(conn)
-            except BaseException:
-                raise ReadError()
+        try:
+            return self.run(r.table(table_name).filter(filter_data))
+        except BaseException:
+            raise ReadError()
+
+    def get_all(self, table_name, index, values):
+        """
+        Returns documents whose secondary index matches any of the values
+        :index: Name of the secondary index
+        :values: List of values to search. Values of compound
+        indexes are lists with a value for each field
+        """
+        try:
+            return self.run(r.table(table_name).get_all(*values, index=index))
+        except BaseException:
+            raise ReadError()
+
+    def update_by_index(self, table_name, new_data, index, values):
+        """
+        Updates every document whose secondary index matches
+        any of the values in a single query
+        :new_data: Fields to update
+        :index: Name of the secondary index
+        :values: List of values to search
+        """
+        try:
+            return self.run(r.table(table_name).get_all(
+                *values, index=index).update(new_data))
+        except BaseException:
+            raise WriteError()
+
+    def delete_by_index(self, table_name, index, values):
+        """
+        Deletes every document whose secondary index matches
+        any of the values in a single query
+        :index: Name of the secondary index
+        :values: List of values to search
+        """
+        try:
+            return self.run(r.table(table_name).get_all(
+                *values, index=index).delete())
+        except BaseException:
+            raise WriteError()
+
+    def replace_many(self, table_name, documents):
+        """
+        Replaces the documents with the same primary key, or inserts
+        them if they don't exist, in a single query
+        """
+        try:
+            return self.run(r.table(table_name).insert(
+                documents, conflict='replace'))
+        except BaseException:
+            raise WriteError()
+
+    def acquire_lease(self, table_name, name, owner, duration):
+        """
+        Takes or renews a lease if it is free, expired or already owned by
+        the owner. The check and the write are a single atomic replace
+        and the expiration uses the clock of the database server
+        :name: Primary key of the lease
+        :owner: Id of the process that wants the lease
+        :duration: Seconds the lease lasts
+        :return: True if the owner holds the lease
+        """
+        now = r.now().to_epoch_time()
+        try:
+            result = self.run(r.table(table_name).get(name).replace(
+                lambda lease: r.branch(
+                    lease.eq(None).or_(lease['expires'].lt(now)).or_(
+                        lease['owner'].eq(owner)),
+                    {'id': name, 'owner': owner, 'expires': now + duration},
+                    lease),
+                return_changes='always'))
+        except BaseException:
+            raise WriteError()
+        new_val = result['changes'][0]['new_val']
+        return new_val is not None and new_val['owner'] == owner
+
+    def release_lease(self, table_name, name, owner):
+        """
+        Deletes the lease if it is owned by the owner
+        """
+        try:
+            return self.run(r.table(table_name).get(name).replace(
+                lambda lease: r.branch(
+                    lease.eq(None).or_(lease['owner'].eq(owner)),
+                    None, lease)))
+        except BaseException:
+            raise WriteError()
 
     def delete_data(self, table_name, data_to_delete):
         """
         Delete documents from database
         :filter_data: Object with a key and his value
         """
-        with self.connect() as conn:
-            try:
-                return r.table(table_name).get(data_to_delete).delete().run(conn)
-            except BaseException:
-                raise ReadError()
+        try:
+            return self.run(r.table(table_name).get(data_to_delete).delete())
+        except BaseException:
+            raise ReadError()
+
+    def delete_between(self, table_name, index, lower, upper):
+        """
+        Delete documents with the index value between lower (included)
+        and upper (excluded) in a single query
+        :lower: Lower bound. If it is None there is no lower bound
+        :upper: Upper bound
+        """
+        try:
+            if lower is None:
+                lower = r.minval
+            return self.run(r.table(table_name).between(
+                lower, upper, index=index).delete())
+        except BaseException:
+            raise WriteError()
 
-    def join_tables(self, table1, table2, table3, key1, key2):
+    def join_tables(self, table1, table2, table3, key1, key2,
+                    limit=None, start_after=None, fields=None):
         """
-        Merge two tables
+        Merge two tables. Returns an iterator over the merged documents,
+        paginated by the primary key of table1
         :table1: Table in which the other tables are to be combined
         :table2: First table to merge (left table)
         :table3: Second table to merge (right table)
         :key1: Key to search in the left table
         :key2: KEy to search in the right table
         """
-        with self.connect() as conn:
-            try:
-                return r.table(table1).eq_join(key1, r.table(table2)).without(
-                    {"right": {"id": True}}).zip().eq_join(
-                        key2, r.table(table3)).without(
-                            {"right": {"id": True}}).zip().run(conn)
-
-            except BaseException:
-                raise ReadError()
+        ordered = bool(limit or start_after is not None)
+        query = self.paginate(r.table(table1), limit, start_after).eq_join(
+            key1, r.table(table2), ordered=ordered).without(
+                {"right": {"id": True}}).zip().eq_join(
+                    key2, r.table(table3), ordered=ordered).without(
+                        {"right": {"id": True}}).zip()
+        return self.iterate(self.page(query, limit, fields))
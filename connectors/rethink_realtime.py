@@ -2,26 +2,93 @@
 """"
 Data streaming from the DB.
 """
+from threading import Lock
+
 from exceptions.db_exceptions import ReadError
 import rethinkdb as r
 
 
+class ChangesCursor():
+    """
+    Cursor of a changefeed that owns his connection. Closing
+    the cursor closes the connection too
+    """
+
+    def __init__(self, cursor, con):
+        self.cursor = cursor
+        self.con = con
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.cursor)
+
+    def close(self):
+        """
+        Closes the cursor and his connection
+        """
+        try:
+            self.cursor.close()
+        finally:
+            self.con.close(noreply_wait=False)
+
+
 class BDRealtime():
     """
-    Handles realtime conneciton with a table
+    Handles realtime conneciton with a table. Every data streaming
+    returned uses the connection, so one is opened for each of them
+    and closed when the streaming is closed
     """
 
+    # Number of realtime connections opened by the process
+    connections_created = 0
+    connections_lock = Lock()
+
     def __init__(self, server, port, db_name):
         self.db_name = db_name
         self.con = r.connect(host=server, port=port,
                              db=db_name)
+        with BDRealtime.connections_lock:
+            BDRealtime.connections_created += 1
 
-    def get_data(self, table_name):
-        """"
-        Returns a data streaming. To print the new changes iterate over it.
+    def run(self, query):
+        """
+        Runs a changefeed query and returns his cursor, that
+        closes the connection when it is closed
         """
-        con = self.con
         try:
-            return r.table(table_name).changes().run(con)
+            return ChangesCursor(query.run(self.con), self.con)
         except BaseException:
+            self.con.close(noreply_wait=False)
             raise ReadError()
+
+    def get_data(self, table_name):
+        """"
+        Returns a data streaming. To print the new changes iterate over it.
+        """
+        return self.run(r.table(table_name).changes())
+
+    def get_index_changes(self, table_name, index, value):
+        """
+        Returns a data streaming with the changes of the documents
+        whose secondary index has the value
+        """
+        return self.run(
+            r.table(table_name).get_all(value, index=index).changes())
+
+    def get_changes(self, table_names, include_initial=False):
+        """
+        Returns a single data streaming with the changes of several
+        tables. Every change has the name of his table in the table field.
+        Each table sends a change with the ready state when
+        his initial documents have been sent
+        :include_initial: Sends every document of the tables
+        as a change without old_val before the new changes
+        """
+        feeds = [
+            r.table(table_name).changes(
+                include_initial=include_initial,
+                include_states=True).merge({'table': table_name})
+            for table_name in table_names]
+        return self.run(feeds[0].union(*feeds[1:]))
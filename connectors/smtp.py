@@ -1,8 +1,15 @@
 """
 SMTP Handler
 """
+import re
+import time
+import hashlib
 import smtplib
-import email.message
+import email.utils
+
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from threading import Condition, Lock
 
 from email.header import Header
 from email.mime.text import MIMEText
@@ -17,12 +24,23 @@ from exceptions.smtp_exceptions import (
 
 class SMTPHandler():
     """
-    SMTPHandler class to send emails
+    SMTPHandler class to send emails. Recipients are sent in batches
+    of max_recipients, each one in a transaction of the same session.
+    When the server supports ESMTP PIPELINING the commands of a
+    transaction are sent at once instead of waiting for each reply.
+
+    Messages are serialized once and kept in a cache, so an email sent
+    to many recipients or many times is not built again. Only the
+    headers that change on every send are added to the cached bytes
     """
 
-    def __init__(self, username, password, host, port, from_name, ttls):
+    def __init__(self, username, password, host, port, from_name, ttls,
+                 pool_size=1, idle_timeout=60, max_messages=100,
+                 max_recipients=100, cache_size=128):
         """
         Initializes the connection with SMTP server and credentials provided
+        :max_recipients: Maximum number of recipients of a transaction
+        :cache_size: Number of messages serialized kept in the cache
         """
         self.username = username
         self.password = password
@@ -30,50 +48,424 @@ class SMTPHandler():
         self.port = port
         self.from_name = from_name
         self.ttls = ttls
+        if max_recipients < 1:
+            raise ValueError(
+                'max_recipients must be at least 1, not {}'.format(
+                    max_recipients))
+        self.max_recipients = max_recipients
+        self.pool = SMTPPool(
+            self.connect, pool_size, idle_timeout, max_messages)
+        self.messages = MessageCache(self.build, cache_size)
+        # Without it make_msgid resolves the hostname on every call
+        self.msgid_domain = (self.username or '').rpartition('@')[2] or None
+        self.lock = Lock()
+        self.transactions = 0
+        self.pipelined = 0
+        self.refused = 0
 
-    def login(self):
+    def connect(self):
+        """
+        Opens a new authenticated session with the smtp server
+        """
+        server = smtplib.SMTP(self.host, self.port)
+        # server.set_debuglevel(1)
+        server.ehlo()
+        if self.ttls:
+            server.starttls()
+            server.ehlo()
+        self.login(server)
+        return server
+
+    def login(self, server):
         """
         Login into smtp server
         """
         if (self.username and self.password):
             try:
-                self.server.login(self.username, self.password)
+                server.login(self.username, self.password)
             except BaseException:
                 raise SMTPAuthenticationError()
 
-    def is_connected(self):
-        try:
-            status = self.server.noop()[0]
-        except BaseException:  # smtplib.SMTPServerDisconnected
-            status = -1
-        return True if status == 250 else False
-
     def send(self, send_to, subject, body):
         """
         Send temail trough SMTP from account to a list of emails with a message
         :send_to: List of emails to send email
         :subject: The subject of the email
         :body: The body of the email. HTML supported
+        :return: Dict with the recipients refused by the server and his
+        reply. It has every recipient if the server accepted none
         """
-        self.server = smtplib.SMTP(self.host, self.port)
-        # self.server.set_debuglevel(1)
-        self.server.ehlo()
-        if self.ttls:
-            self.server.starttls()
+        try:
+            message = self.messages.get(subject, body)
+            refused = {}
+            with self.pool.session() as session:
+                for start in range(0, len(send_to), self.max_recipients):
+                    refused.update(self.transaction(
+                        session, message,
+                        send_to[start:start + self.max_recipients]))
+            return refused
+
+        except SMTPAuthenticationError:
+            raise
+        except BaseException:
+            raise SMTPSendEmailError()
+
+    def build(self, subject, body):
+        """
+        Builds and serializes a message
+        :return: EncodedMessage
+        """
+        msg = MIMEMultipart('alternative')
+        msg['Subject'] = subject
+        author = formataddr((str(Header(self.from_name, 'utf-8')), self.username))
+        msg['From'] = author
+        part = MIMEText(body, 'html')
+        msg.attach(part)
+        return EncodedMessage(msg['From'], msg.as_string().encode('utf-8'))
+
+    def headers(self):
+        """
+        Returns the headers that are different on every send
+        """
+        return 'Date: {}\r\nMessage-ID: {}\r\n'.format(
+            email.utils.formatdate(),
+            email.utils.make_msgid(domain=self.msgid_domain)).encode('ascii')
+
+    def transaction(self, session, message, recipients):
+        """
+        Sends a message to a batch of recipients. If the server supports
+        it the commands are pipelined, so the batch takes a round trip for
+        the envelope and one for the data instead of one per recipient.
+        Either way the cached bytes are sent after the headers without
+        copying the body, which sendmail would need
+        :session: SMTPSession borrowed from the pool
+        :return: Dict with the recipients refused by the server
+        """
+        server = session.server
+        # Counted before sending, a failed transaction also uses the session
+        session.sent += 1
+        if server.has_extn('pipelining'):
+            refused = self.pipelined_transaction(server, message, recipients)
+        else:
+            refused = self.plain_transaction(server, message, recipients)
+        with self.lock:
+            self.transactions += 1
+            self.refused += len(refused)
+        return refused
+
+    def plain_transaction(self, server, message, recipients):
+        """
+        Sends MAIL, every RCPT and DATA waiting for each reply, for the
+        servers without pipelining. Raises the same errors as sendmail,
+        except when every recipient is refused: the refusals are returned
+        like the rest, so the caller can tell the permanent ones
+        :return: Dict with the recipients refused by the server
+        """
+        from_addr = message.from_addr
+        code, resp = server.mail(from_addr)
+        if code != 250:
+            server.rset()
+            raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+        refused = {}
+        for recipient in recipients:
+            reply = server.rcpt(recipient)
+            if reply[0] not in (250, 251):
+                refused[recipient] = reply
+        if len(refused) == len(recipients):
+            server.rset()
+            return refused
+        server.putcmd('data')
+        code, resp = server.getreply()
+        if code != 354:
+            server.rset()
+            raise smtplib.SMTPDataError(code, resp)
+        self.send_data(server, message)
+        return refused
+
+    def pipelined_transaction(self, server, message, recipients):
+        """
+        Sends MAIL, every RCPT and DATA at once and then reads their
+        replies in order, as defined by RFC 2920. Raises the same
+        errors as plain_transaction
+        :return: Dict with the recipients refused by the server
+        """
+        from_addr = message.from_addr
+        commands = ['mail FROM:{}'.format(smtplib.quoteaddr(from_addr))]
+        commands.extend('rcpt TO:{}'.format(smtplib.quoteaddr(recipient))
+                        for recipient in recipients)
+        commands.append('data')
+        server.send(''.join(command + '\r\n' for command in commands))
+        replies = [server.getreply() for _ in commands]
+        with self.lock:
+            self.pipelined += 1
+
+        refused = {
+            recipient: reply
+            for recipient, reply in zip(recipients, replies[1:-1])
+            if reply[0] not in (250, 251)}
+        code, resp = replies[-1]
+        if code != 354:
+            server.rset()
+            if replies[0][0] != 250:
+                raise smtplib.SMTPSenderRefused(
+                    replies[0][0], replies[0][1], from_addr)
+            if len(refused) == len(recipients):
+                return refused
+            raise smtplib.SMTPDataError(code, resp)
+        if len(refused) == len(recipients):
+            # The data has to be ended before the server
+            # accepts new commands, an empty message is sent
+            server.send(b'.\r\n')
+            server.getreply()
+            return refused
+        self.send_data(server, message)
+        return refused
+
+    def send_data(self, server, message):
+        """
+        Sends the message once the server accepted DATA. The cached
+        bytes, already dot-stuffed, are sent as they are after the
+        headers
+        """
+        server.send(self.headers())
+        server.send(message.quoted)
+        code, resp = server.getreply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, resp)
+
+    def stats(self):
+        """
+        Returns the counters of the transactions and the message cache
+        """
+        with self.lock:
+            stats = {
+                'transactions': self.transactions,
+                'pipelined': self.pipelined,
+                'refused': self.refused}
+        stats.update(self.messages.stats())
+        return stats
+
+    def close(self):
+        """
+        Closes every session opened with the smtp server
+        """
+        self.pool.close()
+
+
+class EncodedMessage():
+    """
+    Message serialized with CRLF line endings, and also ready to be
+    sent after DATA: with lines starting with a dot escaped and ended
+    with a line with a single dot
+    """
+
+    def __init__(self, from_addr, data):
+        """
+        :from_addr: From header of the message
+        :data: Message serialized
+        """
+        self.from_addr = from_addr
+        self.data = re.sub(br'(?:\r\n|\n|\r(?!\n))', b'\r\n', data)
+        if not self.data.endswith(b'\r\n'):
+            self.data += b'\r\n'
+        self.quoted = re.sub(br'(?m)^\.', b'..', self.data) + b'.\r\n'
+
+
+class MessageCache():
+    """
+    Least recently used cache of messages serialized, keyed by a hash
+    of the subject and the body
+    """
+
+    def __init__(self, build, size):
+        """
+        :build: Callable that builds the message of a subject and a body
+        :size: Maximum number of messages kept
+        """
+        self.build = build
+        self.size = size
+        self.messages = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, subject, body):
+        """
+        Returns the message of a subject and a body, building it if
+        it is not in the cache
+        """
+        digest = hashlib.sha256()
+        digest.update(subject.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(body.encode('utf-8'))
+        key = digest.digest()
+        with self.lock:
+            message = self.messages.get(key)
+            if message:
+                self.messages.move_to_end(key)
+                self.hits += 1
+                return message
+            self.misses += 1
+        # Built outside the lock, two senders may build the same message
+        message = self.build(subject, body)
+        with self.lock:
+            self.messages[key] = message
+            self.messages.move_to_end(key)
+            while len(self.messages) > self.size:
+                self.messages.popitem(last=False)
+        return message
+
+    def stats(self):
+        """
+        Returns the cache counters
+        """
+        with self.lock:
+            return {
+                'cached_messages': len(self.messages),
+                'cache_hits': self.hits,
+                'cache_misses': self.misses}
+
+
+class SMTPSession():
+    """
+    Session opened with the smtp server and his usage. sent counts
+    the transactions, one per batch of recipients
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.last_used = time.monotonic()
+        self.sent = 0
+
+
+class SMTPPool():
+    """
+    Pool of long-lived smtp sessions. Sessions are borrowed to send
+    and returned afterwards, so the handshake and the login are done
+    once per session instead of once per email.
+    """
+
+    # Seconds idle after which a session is checked with NOOP
+    NOOP_AFTER = 5
+
+    def __init__(self, connect, size, idle_timeout, max_messages):
+        """
+        :connect: Callable that opens a new authenticated session
+        :size: Maximum number of sessions opened at the same time
+        :idle_timeout: Seconds a session can be unused before closing it
+        :max_messages: Transactions run in a session before renewing it
+        """
+        self.connect = connect
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.max_messages = max_messages
+        self.idle = deque()
+        self.opened = 0
+        self.condition = Condition()
+
+    @contextmanager
+    def session(self):
+        """
+        Borrows a session from the pool. If the block fails the
+        session is discarded instead of returned
+        """
+        session = self.borrow()
+        try:
+            yield session
+        except BaseException:
+            self.discard(session)
+            raise
+        session.last_used = time.monotonic()
+        self.release(session)
+
+    def borrow(self):
+        """
+        Returns a healthy idle session or opens a new one.
+        Blocks while every session is in use
+        """
+        while True:
+            session = None
+            with self.condition:
+                while not self.idle and self.opened >= self.size:
+                    self.condition.wait()
+                if self.idle:
+                    session = self.idle.pop()
+                else:
+                    self.opened += 1
 
-        if not self.is_connected():
-            self.login()
+            if not session:
+                break
+            if self.is_healthy(session):
+                return session
+            self.discard(session)
 
         try:
-            msg = MIMEMultipart('alternative')
-            msg['Subject'] = subject
-            author = formataddr((str(Header(self.from_name, 'utf-8')), self.username))
-            msg['From'] = author
-            part = MIMEText(body, 'html')
-            msg.attach(part)
-            self.server.sendmail(
-                msg['From'], send_to, msg.as_string().encode('utf-8'))
-            self.server.quit()
+            return SMTPSession(self.connect())
+        except BaseException:
+            with self.condition:
+                self.opened -= 1
+                self.condition.notify()
+            raise
 
+    def release(self, session):
+        """
+        Returns the session to the pool
+        """
+        if session.sent >= self.max_messages:
+            self.discard(session)
+            return
+        with self.condition:
+            self.idle.append(session)
+            self.condition.notify()
+
+    def discard(self, session):
+        """
+        Closes the session and frees his place in the pool
+        """
+        self.quit(session)
+        with self.condition:
+            self.opened -= 1
+            self.condition.notify()
+
+    def is_healthy(self, session):
+        """
+        Checks that an idle session can be reused
+        """
+        idle_time = time.monotonic() - session.last_used
+        if idle_time > self.idle_timeout:
+            return False
+        if idle_time > self.NOOP_AFTER:
+            try:
+                return session.server.noop()[0] == 250
+            except BaseException:  # smtplib.SMTPServerDisconnected
+                return False
+        return True
+
+    def close(self):
+        """
+        Closes the idle sessions
+        """
+        with self.condition:
+            while self.idle:
+                self.opened -= 1
+                self.quit(self.idle.pop())
+
+    @staticmethod
+    def quit(session):
+        """
+        Ends the session ignoring errors of dead connections
+        """
+        try:
+            session.server.quit()
         except BaseException:
-            raise SMTPSendEmailError()
+            pass
+
+    def stats(self):
+        """
+        Returns pool counters
+        """
+        with self.condition:
+            return {
+                'opened': self.opened,
+                'idle': len(self.idle),
+                'size': self.size}
@@ -0,0 +1,271 @@
+"""
+SQLite storage
+"""
+import json
+import sqlite3
+from collections import Counter
+
+from connectors.local_storage import LocalStorage
+
+
+class SQLiteHandler(LocalStorage):
+    """
+    Storage in an embedded SQLite database. Each table keeps the documents
+    as json by primary key and secondary indexes are SQLite indexes on
+    json_extract of the fields. The connection is shared by every thread
+    and used with the lock held
+    """
+
+    def __init__(self, path, batch_size=100):
+        """
+        :path: Path of the database file, :memory: to keep it in memory
+        :batch_size: Documents read at once when iterating a table
+        """
+        super(SQLiteHandler, self).__init__()
+        self.path = path
+        self.batch_size = batch_size
+        # Documents written and removed by this process, per table
+        self.written = Counter()
+        self.removed = Counter()
+        # Documents written and removed by the open transaction
+        self.pending_written = Counter()
+        self.pending_removed = Counter()
+        self.conn = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.create_database()
+
+    def begin(self):
+        """
+        Starts a transaction. Must be called with the lock held. The
+        database is locked for writing from the start, so transactions of
+        other processes sharing the file wait instead of failing midway
+        """
+        self.pending_written.clear()
+        self.pending_removed.clear()
+        self.conn.execute('BEGIN IMMEDIATE')
+
+    def commit(self):
+        """
+        Commits the transaction and counts his writes
+        """
+        self.conn.execute('COMMIT')
+        self.written.update(self.pending_written)
+        self.removed.update(self.pending_removed)
+        self.pending_written.clear()
+        self.pending_removed.clear()
+
+    def rollback(self):
+        """
+        Undoes the writes of the transaction, that are not counted
+        """
+        self.pending_written.clear()
+        self.pending_removed.clear()
+        self.conn.execute('ROLLBACK')
+
+    def execute(self, sql, params=()):
+        """
+        Runs a statement and returns his rows
+        """
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def create_database(self):
+        """
+        Creates the tables that describe the tables and indexes
+        """
+        self.execute(
+            'CREATE TABLE IF NOT EXISTS _tables '
+            '(name TEXT PRIMARY KEY, primary_key TEXT NOT NULL)')
+        self.execute(
+            'CREATE TABLE IF NOT EXISTS _indexes '
+            '(table_name TEXT, name TEXT, fields TEXT NOT NULL, '
+            'PRIMARY KEY (table_name, name))')
+
+    def reset_database(self):
+        """
+        Drops every table
+        """
+        with self.lock:
+            for (table_name,) in self.execute('SELECT name FROM _tables'):
+                self.execute('DROP TABLE IF EXISTS {}'.format(
+                    self.quote(table_name)))
+            self.execute('DELETE FROM _tables')
+            self.execute('DELETE FROM _indexes')
+
+    def table_exists(self, table_name):
+        """
+        True if the table exists
+        """
+        return bool(self.execute(
+            'SELECT 1 FROM _tables WHERE name = ?', (table_name,)))
+
+    def create_table(self, table_name, key='id'):
+        """
+        Table creation. If the table exists it does nothing
+        """
+        with self.lock:
+            self.execute(
+                'CREATE TABLE IF NOT EXISTS {} '
+                '(key PRIMARY KEY, document TEXT NOT NULL)'.format(
+                    self.quote(table_name)))
+            self.execute(
+                'INSERT OR IGNORE INTO _tables VALUES (?, ?)',
+                (table_name, key))
+
+    def create_index(self, table_name, index_name, fields=None):
+        """
+        Secondary index creation. If the index exists it does nothing
+        :fields: Fields of a compound index. If not provided
+        the index is the field with the same name
+        """
+        fields = fields or [index_name]
+        with self.lock:
+            self.execute('CREATE INDEX IF NOT EXISTS {} ON {} ({})'.format(
+                self.quote(table_name + '_' + index_name),
+                self.quote(table_name),
+                ', '.join(self.extract(field) for field in fields)))
+            self.execute(
+                'INSERT OR IGNORE INTO _indexes VALUES (?, ?, ?)',
+                (table_name, index_name, json.dumps(fields)))
+
+    def primary_key(self, table_name):
+        """
+        Returns the name of the primary key of the table
+        """
+        rows = self.execute(
+            'SELECT primary_key FROM _tables WHERE name = ?', (table_name,))
+        if not rows:
+            raise self.missing_table(table_name)
+        return rows[0][0]
+
+    def index_fields(self, table_name, index):
+        """
+        Returns the fields of a secondary index
+        """
+        rows = self.execute(
+            'SELECT fields FROM _indexes WHERE table_name = ? AND name = ?',
+            (table_name, index))
+        if not rows:
+            raise self.missing_table(table_name + '.' + index)
+        return json.loads(rows[0][0])
+
+    def scan(self, table_name, start_after=None):
+        """
+        Yields the documents of the table ordered by primary key. They are
+        read in batches, so the lock is not held while iterating
+        :start_after: Primary key to start after
+        """
+        table = self.quote(table_name)
+        while True:
+            if start_after is None:
+                rows = self.execute(
+                    'SELECT key, document FROM {} ORDER BY key LIMIT ?'.format(
+                        table), (self.batch_size,))
+            else:
+                rows = self.execute(
+                    'SELECT key, document FROM {} WHERE key > ? '
+                    'ORDER BY key LIMIT ?'.format(table),
+                    (start_after, self.batch_size))
+            for key, document in rows:
+                yield json.loads(document)
+            if len(rows) < self.batch_size:
+                return
+            start_after = rows[-1][0]
+
+    def get_document(self, table_name, key):
+        """
+        Returns the document with the primary key or None
+        """
+        rows = self.execute(
+            'SELECT document FROM {} WHERE key = ?'.format(
+                self.quote(table_name)), (key,))
+        return json.loads(rows[0][0]) if rows else None
+
+    def put_document(self, table_name, document):
+        """
+        Inserts or replaces a document. Must be called in a transaction,
+        that counts it when committed
+        """
+        self.execute(
+            'INSERT OR REPLACE INTO {} VALUES (?, ?)'.format(
+                self.quote(table_name)),
+            (document[self.primary_key(table_name)], json.dumps(document)))
+        self.pending_written[table_name] += 1
+
+    def remove_document(self, table_name, key):
+        """
+        Removes the document with the primary key if it exists. Must be
+        called in a transaction, that counts it when committed
+        """
+        self.execute(
+            'DELETE FROM {} WHERE key = ?'.format(self.quote(table_name)),
+            (key,))
+        self.pending_removed[table_name] += 1
+
+    def get_all(self, table_name, index, values):
+        """
+        Returns documents whose secondary index matches any of the values
+        :index: Name of the secondary index
+        :values: List of values to search. Values of compound
+        indexes are lists with a value for each field
+        """
+        fields = self.index_fields(table_name, index)
+        sql = 'SELECT document FROM {} WHERE {}'.format(
+            self.quote(table_name),
+            ' AND '.join(self.extract(field) + ' = ?' for field in fields))
+        documents = []
+        for value in values:
+            params = value if isinstance(value, list) else [value]
+            documents.extend(
+                json.loads(document)
+                for (document,) in self.execute(sql, params))
+        return documents
+
+    def index_range(self, table_name, index, lower, upper):
+        """
+        Returns the documents with the index value between lower
+        (included, None for no lower bound) and upper (excluded)
+        """
+        field = self.extract(self.index_fields(table_name, index)[0])
+        sql = 'SELECT document FROM {} WHERE {} < ?'.format(
+            self.quote(table_name), field)
+        params = [upper]
+        if lower is not None:
+            sql += ' AND {} >= ?'.format(field)
+            params.append(lower)
+        return [json.loads(document)
+                for (document,) in self.execute(sql, params)]
+
+    @staticmethod
+    def quote(name):
+        """
+        Quotes a table or index name
+        """
+        return '"{}"'.format(name.replace('"', '""'))
+
+    @staticmethod
+    def extract(field):
+        """
+        Expression of a field of the documents. Queries must use the same
+        expression as the index for SQLite to use it
+        """
+        return "json_extract(document, '$.{}')".format(field.replace("'", ""))
+
+    def stats(self):
+        """
+        Returns the documents written and removed in each table by this
+        process. Tables are not counted, it would read the whole table
+        """
+        with self.lock:
+            tables = {
+                table_name: {
+                    'written': self.written[table_name],
+                    'removed': self.removed[table_name]}
+                for table_name in set(self.written) | set(self.removed)}
+            return {
+                'backend': 'sqlite',
+                'path': self.path,
+                'tables': tables,
+                'subscribers': self.feed.stats()}
@@ -5,11 +5,20 @@ Main file program.
 # sudo docker run --memory=4G --memory-swap=0 rethinkdb
 
 import sys
+
+from utils import startup
+
 import errors
 import settings as st
 
+from bussiness import registry, schema
+from bussiness.coordinator import Coordinator
 from bussiness.realtime import Realtime
+from bussiness.messages import MessagesRetention
 from api.v1.api import ApiHandler
+from connectors.rethink import RethinkPool
+from connectors.rethink_realtime import BDRealtime
+from utils import metrics
 
 
 def main():
@@ -19,11 +28,29 @@ def main():
 
     st.logger.info('Starting notifyme...')
 
-    Realtime()
+    schema.bootstrap(reset=st.REFRESH_DATABASE)
+
+    if st.WORKERS_API_DISPATCH:
+        coordinator = Coordinator('bindings', st.WORKERS_LEASE_DURATION)
+        Realtime(coordinator)
+        coordinator.start()
+
+    MessagesRetention(
+        st.MESSAGES_RETENTION_DAYS,
+        st.MESSAGES_RETENTION_INTERVAL).start()
 
     api = ApiHandler()
     api.start()
 
+    metrics.register('registry', registry.stats)
+    st.logger.info(
+        'Started in %.2fs with %d handlers, %d pooled and %d realtime '
+        'database connections',
+        startup.elapsed(),
+        len(registry.stats()['handlers']),
+        sum(pool.connections_created for pool in RethinkPool.pools.values()),
+        BDRealtime.connections_created)
+
     # Captures not controlled exceptions
     sys.excepthook = errors.log_unhandled_exception
 
@@ -22,6 +22,12 @@ RABBITMQ_PASSWORD = config.load('RABBITMQ_PASSWORD', 'bus', 'password')
 RABBITMQ_QUEUE = config.load('RABBITMQ_QUEUE', 'bus', 'queue_name')
 RABBIRMQ_EXCHANGE_ERROR = config.load(
     'RABBIRMQ_EXCHANGE_ERROR', 'bus', 'error_exchange')
+RABBITMQ_PREFETCH = int(config.load(
+    'RABBITMQ_PREFETCH', 'bus', 'prefetch'))
+RABBITMQ_ACK_INTERVAL = int(config.load(
+    'RABBITMQ_ACK_INTERVAL', 'bus', 'ack_interval'))
+RABBITMQ_MAX_ATTEMPTS = int(config.load(
+    'RABBITMQ_MAX_ATTEMPTS', 'bus', 'max_attempts'))
 
 SMTP_EMAIL = config.load('SMTP_EMAIL', 'smtp', 'email')
 SMTP_HOST = config.load('SMTP_HOST', 'smtp', 'server')
@@ -30,16 +36,44 @@ SMTP_FROM_NAME = config.load('SMTP_FROM_NAME', 'smtp', 'name')
 SMTP_PASS = config.load('SMTP_PASS', 'smtp', 'password')
 SEND_EMAILS = config.load('SMTP_SEND', 'smtp', 'name')
 SMTP_TTLS = config.load('SMTP_TTLS', 'smtp', 'ttls')
+SMTP_POOL_SIZE = int(config.load('SMTP_POOL_SIZE', 'smtp', 'pool_size'))
+SMTP_IDLE_TIMEOUT = int(config.load(
+    'SMTP_IDLE_TIMEOUT', 'smtp', 'idle_timeout'))
+SMTP_MAX_MESSAGES = int(config.load(
+    'SMTP_MAX_MESSAGES', 'smtp', 'max_messages'))
+SMTP_MAX_RECIPIENTS = int(config.load(
+    'SMTP_MAX_RECIPIENTS', 'smtp', 'max_recipients'))
+SMTP_MESSAGE_CACHE = int(config.load(
+    'SMTP_MESSAGE_CACHE', 'smtp', 'message_cache'))
 
+RATE_LIMIT_GLOBAL = int(config.load(
+    'RATE_LIMIT_GLOBAL', 'rate_limit', 'global_per_minute'))
+RATE_LIMIT_GLOBAL_BURST = int(config.load(
+    'RATE_LIMIT_GLOBAL_BURST', 'rate_limit', 'global_burst'))
+RATE_LIMIT_DOMAIN = int(config.load(
+    'RATE_LIMIT_DOMAIN', 'rate_limit', 'domain_per_minute'))
+RATE_LIMIT_DOMAIN_BURST = int(config.load(
+    'RATE_LIMIT_DOMAIN_BURST', 'rate_limit', 'domain_burst'))
+
+DB_BACKEND = config.load('DB_BACKEND', 'db', 'backend')
+DB_PATH = config.load('DB_PATH', 'db', 'path')
 DB_SERVER = config.load('DB_SERVER', 'db', 'server')
 DB_PORT = config.load('DB_SERVER', 'db', 'port')
 DB_USER = config.load('DB_USER', 'db', 'user')
 DB_PASSWORD = config.load('DB_PASSWORD', 'db', 'password')
+DB_POOL_MIN = int(config.load('DB_POOL_MIN', 'db', 'pool_min'))
+DB_POOL_MAX = int(config.load('DB_POOL_MAX', 'db', 'pool_max'))
+DB_QUERY_TIMEOUT = int(config.load(
+    'DB_QUERY_TIMEOUT', 'db', 'query_timeout'))
+DB_RETRIES = int(config.load('DB_RETRIES', 'db', 'connect_retries'))
+DB_RETRY_WAIT = int(config.load('DB_RETRY_WAIT', 'db', 'retry_wait'))
 
 REFRESH_DATABASE = config.load('DB_REFRESH', 'db', 'refresh_database')
 
 API_SERVER = config.load('API_SERVER', 'api', 'server')
 API_PORT = config.load('API_PORT', 'api', 'port')
+API_MAX_PAGE_SIZE = int(config.load(
+    'API_MAX_PAGE_SIZE', 'api', 'max_page_size'))
 
 DEFAULT_TEMPLATE_TEXT = config.load(
     'DEFAULT_TEMPLATE_TEXT',
@@ -50,6 +84,60 @@ DEFAULT_TEMPLATE_SUBJECT = config.load(
     'default_template',
     'subject')
 
+MESSAGES_RETENTION_DAYS = int(config.load(
+    'MESSAGES_RETENTION_DAYS', 'messages', 'retention_days'))
+MESSAGES_RETENTION_INTERVAL = int(config.load(
+    'MESSAGES_RETENTION_INTERVAL', 'messages', 'retention_interval'))
+
+REALTIME_QUEUE_SIZE = int(config.load(
+    'REALTIME_QUEUE_SIZE', 'realtime', 'queue_size'))
+REALTIME_RETRY_WAIT = int(config.load(
+    'REALTIME_RETRY_WAIT', 'realtime', 'retry_wait'))
+REALTIME_MAX_RETRY_WAIT = int(config.load(
+    'REALTIME_MAX_RETRY_WAIT', 'realtime', 'max_retry_wait'))
+REALTIME_COALESCE_WINDOW = int(config.load(
+    'REALTIME_COALESCE_WINDOW', 'realtime', 'coalesce_window'))
+
+WORKERS_LEASE_DURATION = int(config.load(
+    'WORKERS_LEASE_DURATION', 'workers', 'lease_duration'))
+WORKERS_API_DISPATCH = str(config.load(
+    'WORKERS_API_DISPATCH', 'workers', 'api_dispatch')).lower() == 'true'
+
+OUTBOX_PATH = config.load('OUTBOX_PATH', 'outbox', 'path')
+OUTBOX_RETRY_WAIT = int(config.load(
+    'OUTBOX_RETRY_WAIT', 'outbox', 'retry_wait'))
+OUTBOX_MAX_RETRY_WAIT = int(config.load(
+    'OUTBOX_MAX_RETRY_WAIT', 'outbox', 'max_retry_wait'))
+OUTBOX_CLAIM_TIMEOUT = int(config.load(
+    'OUTBOX_CLAIM_TIMEOUT', 'outbox', 'claim_timeout'))
+OUTBOX_MAX_ATTEMPTS = int(config.load(
+    'OUTBOX_MAX_ATTEMPTS', 'outbox', 'max_attempts'))
+OUTBOX_MAX_DEPTH = int(config.load(
+    'OUTBOX_MAX_DEPTH', 'outbox', 'max_depth'))
+
+DISPATCH_QUEUE_SIZE = int(config.load(
+    'DISPATCH_QUEUE_SIZE', 'dispatch', 'queue_size'))
+DISPATCH_RENDER_WORKERS = int(config.load(
+    'DISPATCH_RENDER_WORKERS', 'dispatch', 'render_workers'))
+DISPATCH_SEND_WORKERS = int(config.load(
+    'DISPATCH_SEND_WORKERS', 'dispatch', 'send_workers'))
+DISPATCH_ARCHIVE_WORKERS = int(config.load(
+    'DISPATCH_ARCHIVE_WORKERS', 'dispatch', 'archive_workers'))
+
+TEMPLATE_CACHE_SIZE = int(config.load(
+    'TEMPLATE_CACHE_SIZE', 'cache', 'templates'))
+
+DEFAULT_DIGEST_TEXT = config.load(
+    'DEFAULT_DIGEST_TEXT',
+    'default_template',
+    'digest_text')
+DEFAULT_DIGEST_SUBJECT = config.load(
+    'DEFAULT_DIGEST_SUBJECT',
+    'default_template',
+    'digest_subject')
+DIGEST_MAX_PENDING = int(config.load(
+    'DIGEST_MAX_PENDING', 'dispatch', 'digest_max_pending'))
+
 DB_NAME = 'notify_me'
 
 LOGGING = {
@@ -0,0 +1,78 @@
+from bussiness.bindings import BusBindings
+
+
+def insert(document):
+    return {'old_val': None, 'new_val': document}
+
+
+def delete(document):
+    return {'old_val': document, 'new_val': None}
+
+
+def apply(bindings, change, table_name, document):
+    return bindings.apply(table_name, change(document))
+
+
+def test_binds_with_the_first_subscription():
+    bindings = BusBindings()
+    bus_filter = {'id': 'f1', 'exchange': 'ex', 'key': 'a.b'}
+    assert apply(bindings, insert, 'bus_filters', bus_filter) == ([], [])
+    assert apply(bindings, insert, 'subscriptions',
+                 {'id': 's1', 'filter_id': 'f1'}) == ([('ex', 'a.b')], [])
+    assert apply(bindings, insert, 'subscriptions',
+                 {'id': 's2', 'filter_id': 'f1'}) == ([], [])
+    assert bindings.stats() == {'ex:a.b': 2}
+
+
+def test_unbinds_with_the_last_subscription():
+    bindings = BusBindings()
+    apply(bindings, insert, 'bus_filters', {'id': 'f1', 'exchange': 'ex'})
+    for subscription_id in ('s1', 's2'):
+        apply(bindings, insert, 'subscriptions',
+              {'id': subscription_id, 'filter_id': 'f1'})
+    assert apply(bindings, delete, 'subscriptions',
+                 {'id': 's1', 'filter_id': 'f1'}) == ([], [])
+    assert apply(bindings, delete, 'subscriptions',
+                 {'id': 's2', 'filter_id': 'f1'}) == ([], [('ex', '')])
+    assert bindings.stats() == {}
+
+
+def test_subscription_before_its_filter():
+    bindings = BusBindings()
+    apply(bindings, insert, 'subscriptions', {'id': 's1', 'filter_id': 'f1'})
+    assert apply(bindings, insert, 'bus_filters',
+                 {'id': 'f1', 'exchange': 'ex'}) == ([('ex', '')], [])
+
+
+def test_filter_change_moves_its_subscriptions():
+    bindings = BusBindings()
+    apply(bindings, insert, 'bus_filters',
+          {'id': 'f1', 'exchange': 'ex', 'key': 'a'})
+    apply(bindings, insert, 'subscriptions', {'id': 's1', 'filter_id': 'f1'})
+    change = {'old_val': {'id': 'f1', 'exchange': 'ex', 'key': 'a'},
+              'new_val': {'id': 'f1', 'exchange': 'ex', 'key': 'b'}}
+    assert bindings.apply('bus_filters', change) == (
+        [('ex', 'b')], [('ex', 'a')])
+
+
+def test_filter_removed_unbinds():
+    bindings = BusBindings()
+    bus_filter = {'id': 'f1', 'exchange': 'ex'}
+    apply(bindings, insert, 'bus_filters', bus_filter)
+    apply(bindings, insert, 'subscriptions', {'id': 's1', 'filter_id': 'f1'})
+    assert apply(bindings, delete, 'bus_filters', bus_filter) == (
+        [], [('ex', '')])
+
+
+def test_missing_and_empty_key_share_the_binding():
+    bindings = BusBindings()
+    apply(bindings, insert, 'bus_filters',
+          {'id': 'f1', 'exchange': 'ex', 'key': None})
+    apply(bindings, insert, 'bus_filters',
+          {'id': 'f2', 'exchange': 'ex', 'key': ''})
+    apply(bindings, insert, 'subscriptions', {'id': 's1', 'filter_id': 'f1'})
+    apply(bindings, insert, 'subscriptions', {'id': 's2', 'filter_id': 'f2'})
+    assert apply(bindings, delete, 'subscriptions',
+                 {'id': 's1', 'filter_id': 'f1'}) == ([], [])
+    assert bindings.stats() == {'ex:': 1}
+    assert len(bindings.bus_filters()) == 1
@@ -0,0 +1,35 @@
+import pytest
+
+from bussiness import db_handler, schema
+from bussiness.bus_filters import BusFiltersHandler
+from connectors.memory import MemoryHandler
+
+
+@pytest.fixture
+def storage(monkeypatch):
+    storage = MemoryHandler()
+    monkeypatch.setattr(db_handler, '_storage', storage)
+    schema.bootstrap()
+    return storage
+
+
+def test_filters_without_key_are_found(storage):
+    filters = BusFiltersHandler()
+    filter_id = filters.insert({'exchange': 'ex', 'key': None})[0]
+    assert filters.get(filter_id)['key'] == ''
+    assert filters.get_by_exchange_key('ex', None)['id'] == filter_id
+    assert filters.insert({'exchange': 'ex'}) == filter_id
+
+
+def test_bootstrap_migrates_filters_without_key(storage):
+    storage.insert_data('bus_filters', [
+        {'id': 'f1', 'exchange': 'ex'},
+        {'id': 'f2', 'exchange': 'ex', 'key': None},
+        {'id': 'f3', 'exchange': 'ex', 'key': 'a'}])
+    storage.replace_data(
+        schema.SCHEMA_TABLE, {'version': schema.SCHEMA_VERSION - 1},
+        'version')
+    schema.bootstrap()
+    assert {bus_filter['id']: bus_filter['key']
+            for bus_filter in storage.get_data('bus_filters', None)} == {
+                'f1': '', 'f2': '', 'f3': 'a'}
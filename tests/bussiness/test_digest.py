@@ -0,0 +1,101 @@
+import time
+
+import errors
+from bussiness.digest import DigestBuffer
+from connectors.outbox import Outbox
+
+
+def wait_for(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_flushes_when_max_items_reached():
+    flushed = []
+    buffer = DigestBuffer(flushed.append, 100)
+    for i in range(3):
+        buffer.add('key', 'a@x.com', {'id': 'f'}, None, 60, 3, {'n': i})
+    assert len(flushed) == 1
+    assert flushed[0].recipient == 'a@x.com'
+    assert [m['n'] for m in flushed[0].messages] == [0, 1, 2]
+    assert buffer.stats()['pending'] == 0
+
+
+def test_flushes_oldest_bucket_when_full():
+    flushed = []
+    buffer = DigestBuffer(flushed.append, 2)
+    buffer.add('old', 'a@x.com', {'id': 'f'}, None, 10, None, {})
+    buffer.add('new', 'b@x.com', {'id': 'f'}, None, 60, None, {})
+    assert not flushed
+    buffer.add('new', 'b@x.com', {'id': 'f'}, None, 60, None, {})
+    assert [digest.key for digest in flushed] == ['old']
+    assert buffer.stats()['pending'] == 2
+
+
+def test_flushes_when_window_ends():
+    flushed = []
+    buffer = DigestBuffer(flushed.append, 100, resolution=0.05)
+    buffer.add('key', 'a@x.com', {'id': 'f'}, None, 0.1, None, {})
+    assert wait_for(lambda: flushed)
+    assert buffer.stats()['digests'] == 0
+
+
+def test_failed_flush_keeps_flusher_alive(monkeypatch):
+    logged = []
+    monkeypatch.setattr(
+        errors, 'process_exception',
+        lambda error, **kwargs: logged.append(error))
+    flushed = []
+
+    def on_flush(digest):
+        if digest.key == 'bad':
+            raise ValueError('broken template')
+        flushed.append(digest)
+
+    buffer = DigestBuffer(on_flush, 100, resolution=0.05)
+    buffer.add('bad', 'a@x.com', {'id': 'f'}, None, 0.1, None, {})
+    assert wait_for(lambda: logged)
+    # Raising from add would fail the message being rendered
+    buffer.add('bad', 'a@x.com', {'id': 'f'}, None, 60, 1, {})
+    assert len(logged) == 2
+    buffer.add('good', 'b@x.com', {'id': 'f'}, None, 0.1, None, {})
+    assert wait_for(lambda: flushed)
+
+
+def test_buffered_messages_survive_a_restart():
+    outbox = Outbox(':memory:')
+    DigestBuffer(lambda digest: None, 100, resolution=60, store=outbox).add(
+        ('f', 'a@x.com'), 'a@x.com', {'id': 'f'}, 't', 0.1, None, {'n': 1})
+    assert len(outbox.buffered()) == 1
+
+    flushed = []
+
+    def on_flush(digest):
+        flushed.append(digest)
+        outbox.extend([{'users': [digest.recipient]}],
+                      buffered=digest.buffered)
+
+    buffer = DigestBuffer(on_flush, 100, resolution=0.05, store=outbox)
+    assert wait_for(lambda: flushed)
+    assert flushed[0].key == ('f', 'a@x.com')
+    assert flushed[0].template_id == 't'
+    assert flushed[0].messages == [{'n': 1}]
+    assert buffer.stats()['restored'] == 1
+    assert outbox.buffered() == []
+    assert outbox.stats()['depth'] == 1
+
+
+def test_failed_flush_stays_buffered(monkeypatch):
+    monkeypatch.setattr(
+        errors, 'process_exception', lambda error, **kwargs: None)
+    outbox = Outbox(':memory:')
+
+    def on_flush(digest):
+        raise ValueError('broken template')
+
+    buffer = DigestBuffer(on_flush, 100, store=outbox)
+    buffer.add('key', 'a@x.com', {'id': 'f'}, None, 60, 1, {})
+    assert buffer.stats()['flushed'] == 1
+    assert len(outbox.buffered()) == 1
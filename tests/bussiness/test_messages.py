@@ -0,0 +1,55 @@
+import datetime
+
+import pytest
+
+from bussiness import db_handler, schema
+from bussiness.messages import MessagesHandler
+from connectors.memory import MemoryHandler
+from utils import dates
+
+
+@pytest.fixture
+def storage(monkeypatch):
+    storage = MemoryHandler()
+    monkeypatch.setattr(db_handler, '_storage', storage)
+    schema.bootstrap()
+    return storage
+
+
+def test_stored_dates_sort_in_time_order():
+    first = datetime.datetime(
+        2026, 1, 1, 10, 0, 0, tzinfo=datetime.timezone.utc)
+    second = datetime.datetime(
+        2026, 1, 1, 11, 0, 0, 1,
+        tzinfo=datetime.timezone(datetime.timedelta(hours=2)))
+    assert dates.to_utc(first) == '2026-01-01T10:00:00.000000+00:00'
+    assert dates.to_utc(second) == '2026-01-01T09:00:00.000001+00:00'
+    assert dates.to_utc(second) < dates.to_utc(first)
+
+
+def test_retention_deletes_by_time(storage):
+    messages = MessagesHandler()
+    messages.insert([
+        {'id': 'old', 'date': dates.to_utc(
+            datetime.datetime(2026, 1, 1, 9, 59, 59, 999999))},
+        {'id': 'new', 'date': dates.to_utc(
+            datetime.datetime(2026, 1, 1, 10))}])
+    messages.delete_older_than(datetime.datetime(
+        2026, 1, 1, 11, tzinfo=datetime.timezone(datetime.timedelta(hours=1))))
+    assert [message['id'] for message in messages.get()] == ['new']
+
+
+def test_bootstrap_normalizes_older_dates(storage):
+    storage.insert_data('messages', [
+        {'id': 'm1', 'date': '2026-01-01T10:00:00+00:00'},
+        {'id': 'm2', 'date': '2026-01-01T12:30:00.5+02:00'},
+        {'id': 'm3', 'date': '2026-01-01T10:00:00.000000+00:00'}])
+    storage.replace_data(
+        schema.SCHEMA_TABLE, {'version': schema.SCHEMA_VERSION - 1},
+        'version')
+    schema.bootstrap()
+    assert {message['id']: message['date']
+            for message in storage.get_data('messages', None)} == {
+                'm1': '2026-01-01T10:00:00.000000+00:00',
+                'm2': '2026-01-01T10:30:00.500000+00:00',
+                'm3': '2026-01-01T10:00:00.000000+00:00'}
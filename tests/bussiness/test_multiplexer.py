@@ -0,0 +1,67 @@
+from bussiness.multiplexer import ChangeMultiplexer
+from bussiness.routing import RoutingIndex
+
+
+def multiplexer(changes, ready=None):
+    routing = RoutingIndex()
+    changes_multiplexer = ChangeMultiplexer(
+        None, ['users'], routing.documents)
+    changes_multiplexer.listen(
+        'users', lambda change: routing.apply('users', change))
+    changes_multiplexer.listen('users', changes.append)
+    if ready is not None:
+        changes_multiplexer.on_ready(lambda: ready.append(True))
+    return changes_multiplexer, routing
+
+
+def initial(document):
+    return {'table': 'users', 'new_val': document}
+
+
+def state(name, table_name='users'):
+    return {'table': table_name, 'state': name}
+
+
+def test_resync_sends_only_the_changes_of_the_gap():
+    changes = []
+    changes_multiplexer, routing = multiplexer(changes)
+    for change in [initial({'id': 'a', 'v': 1}), initial({'id': 'b'}),
+                   initial({'id': 'c'}), state('ready')]:
+        changes_multiplexer.process(change)
+    changes.clear()
+
+    for change in [state('resync'), initial({'id': 'a', 'v': 2}),
+                   initial({'id': 'b'}), initial({'id': 'd'}),
+                   state('ready')]:
+        changes_multiplexer.process(change)
+    assert sorted(
+        (change['old_val'] or {}).get('id', '-') +
+        (change['new_val'] or {}).get('id', '-')
+        for change in changes) == ['-d', 'aa', 'c-']
+    assert not any(change['initial'] for change in changes)
+    assert sorted(routing.documents('users')) == ['a', 'b', 'd']
+    assert changes_multiplexer.stats()['last_resync_changes'] == 3
+
+
+def test_changes_received_while_resyncing_are_kept():
+    changes = []
+    changes_multiplexer, routing = multiplexer(changes)
+    for change in [initial({'id': 'a'}), state('ready'), state('resync'),
+                   {'table': 'users', 'old_val': None,
+                    'new_val': {'id': 'b'}},
+                   state('ready')]:
+        changes_multiplexer.process(change)
+    assert sorted(routing.documents('users')) == ['b']
+
+
+def test_lost_while_loading_ends_the_load():
+    changes = []
+    ready = []
+    changes_multiplexer, routing = multiplexer(changes, ready)
+    for change in [initial({'id': 'a'}), initial({'id': 'b'}),
+                   state('resync'), initial({'id': 'b'}),
+                   initial({'id': 'c'}), state('ready')]:
+        changes_multiplexer.process(change)
+    assert sorted(routing.documents('users')) == ['b', 'c']
+    assert all(change['initial'] for change in changes)
+    assert ready == [True]
@@ -0,0 +1,77 @@
+import pytest
+
+from bussiness import rate_limiter
+from bussiness.rate_limiter import RateLimiter, TokenBucket
+
+
+class Clock():
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = 0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept += seconds
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rate_limiter.time, 'monotonic', clock.monotonic)
+    monkeypatch.setattr(rate_limiter.time, 'sleep', clock.sleep)
+    return clock
+
+
+def recipients(count, domain='x.com'):
+    return ['user{}@{}'.format(i, domain) for i in range(count)]
+
+
+def test_bucket_refills_up_to_capacity(clock):
+    bucket = TokenBucket(1, 5)
+    bucket.take(5)
+    bucket.refill(clock.now + 3)
+    assert bucket.tokens == 3
+    bucket.refill(clock.now + 60)
+    assert bucket.tokens == 5
+
+
+def test_burst_is_not_limited(clock):
+    limiter = RateLimiter(60, 20, 0, 0)
+    limiter.acquire(recipients(20))
+    assert clock.slept == 0
+
+
+def test_waits_for_missing_tokens(clock):
+    limiter = RateLimiter(60, 20, 0, 0)
+    limiter.acquire(recipients(20))
+    limiter.acquire(recipients(5))
+    assert clock.slept == pytest.approx(5)
+
+
+def test_requests_larger_than_burst_keep_the_rate(clock):
+    limiter = RateLimiter(60, 20, 0, 0)
+    for _ in range(2):
+        limiter.acquire(recipients(50))
+    limiter.acquire(recipients(1))
+    # 101 recipients at one per second, 20 of them sent in the burst
+    assert clock.slept == pytest.approx(81)
+
+
+def test_domains_are_limited_separately(clock):
+    limiter = RateLimiter(0, 0, 60, 2)
+    limiter.acquire(recipients(2, 'a.com') + recipients(2, 'b.com'))
+    assert clock.slept == 0
+    limiter.acquire(recipients(1, 'a.com'))
+    assert clock.slept == pytest.approx(1)
+
+
+def test_full_domain_buckets_are_dropped(clock):
+    limiter = RateLimiter(0, 0, 60, 1, max_domains=2)
+    limiter.acquire(['a@a.com', 'b@b.com'])
+    clock.now += 60
+    limiter.acquire(['c@c.com'])
+    assert set(limiter.stats()['domain_tokens']) == {'c.com'}
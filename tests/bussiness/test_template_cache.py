@@ -0,0 +1,54 @@
+from bussiness.template_cache import TemplateCache
+
+
+def template(template_id, text, subject=None):
+    return {'id': template_id, 'text': text, 'subject': subject}
+
+
+def render(compiled, **values):
+    subject, text = compiled
+    return subject and subject.render(values), text.render(values)
+
+
+def test_hit_returns_the_compiled_template():
+    cache = TemplateCache(10)
+    first = cache.get(template('t1', 'Hi {{ name }}', 'To {{ name }}'))
+    assert cache.get(template('t1', 'Hi {{ name }}', 'To {{ name }}')) is first
+    assert render(first, name='Ann') == ('To Ann', 'Hi Ann')
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+
+def test_edited_template_is_compiled_again():
+    cache = TemplateCache(10)
+    cache.get(template('t1', 'old'))
+    compiled = cache.get(template('t1', 'new'))
+    assert render(compiled) == (None, 'new')
+    # The old revision is replaced, not kept until evicted
+    assert cache.stats()['size'] == 1
+
+
+def test_invalidate():
+    cache = TemplateCache(10)
+    cache.get(template('t1', 'text'))
+    cache.invalidate('t1')
+    cache.invalidate('missing')
+    assert cache.stats()['size'] == 0
+    cache.get(template('t1', 'text'))
+    assert cache.stats()['misses'] == 2
+
+
+def test_least_recently_used_is_evicted():
+    cache = TemplateCache(2)
+    cache.get(template('t1', 'one'))
+    cache.get(template('t2', 'two'))
+    cache.get(template('t1', 'one'))
+    cache.get(template('t3', 'three'))
+    assert cache.stats()['evictions'] == 1
+    assert set(cache.revisions) == {'t1', 't3'}
+
+
+def test_undefined_values_render_empty():
+    cache = TemplateCache(10)
+    compiled = cache.get(template('t1', 'Hi {{ user.name }}{{ missing }}'))
+    assert render(compiled) == (None, 'Hi ')
@@ -0,0 +1,66 @@
+import threading
+import time
+
+from bussiness.timer_wheel import TimerWheel
+
+
+def collector():
+    expired = []
+    done = threading.Event()
+
+    def on_expire(items):
+        expired.extend(items)
+        done.set()
+
+    return expired, done, on_expire
+
+
+def test_tick_at_rounds_up():
+    wheel = TimerWheel(None, tick=100)
+    assert wheel.tick_at(wheel.started) == 0
+    assert wheel.tick_at(wheel.started + 0.01) == 1
+    assert wheel.tick_at(wheel.started + 0.1) == 1
+    assert wheel.tick_at(wheel.started + 0.11) == 2
+
+
+def test_expires_in_order():
+    expired, _, on_expire = collector()
+    wheel = TimerWheel(on_expire, tick=10)
+    wheel.schedule(0.1, 'late')
+    wheel.schedule(0.02, 'early')
+    assert len(wheel) == 2
+    wheel.start()
+    try:
+        deadline = time.monotonic() + 2
+        while len(expired) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        wheel.stop()
+    assert expired == ['early', 'late']
+    assert len(wheel) == 0
+    assert wheel.expired == 2
+
+
+def test_delay_longer_than_a_turn():
+    expired, done, on_expire = collector()
+    # A turn of the wheel takes 40ms
+    wheel = TimerWheel(on_expire, tick=10, slots=4)
+    started = time.monotonic()
+    wheel.schedule(0.15, 'item')
+    wheel.start()
+    try:
+        assert done.wait(2)
+    finally:
+        wheel.stop()
+    assert expired == ['item']
+    assert time.monotonic() - started >= 0.15
+
+
+def test_stopped_wheel_never_expires():
+    expired, done, on_expire = collector()
+    wheel = TimerWheel(on_expire, tick=10)
+    wheel.schedule(0.02, 'item')
+    wheel.start()
+    wheel.stop()
+    assert not done.wait(0.1)
+    assert expired == []
@@ -0,0 +1,64 @@
+import pytest
+
+from bussiness.topic_trie import TopicTrie
+
+
+@pytest.mark.parametrize('pattern, key, matches', [
+    ('orders.created', 'orders.created', True),
+    ('orders.created', 'orders.deleted', False),
+    ('orders.*', 'orders.created', True),
+    ('orders.*', 'orders', False),
+    ('orders.*', 'orders.created.eu', False),
+    ('*.created', 'orders.created', True),
+    ('orders.#', 'orders', True),
+    ('orders.#', 'orders.created.eu', True),
+    ('#', 'orders.created', True),
+    ('#.failed', 'orders.eu.failed', True),
+    ('#.failed', 'failed', True),
+    ('orders.#.failed', 'orders.failed', True),
+    ('orders.#.failed', 'orders.eu.es.failed', True),
+    ('orders.#.failed', 'orders.eu.created', False),
+    ('*.#.*', 'orders', False),
+    ('*.#.*', 'orders.created', True),
+])
+def test_match(pattern, key, matches):
+    trie = TopicTrie()
+    trie.insert(pattern, 'value')
+    assert trie.match(key) == ({'value'} if matches else set())
+
+
+def test_match_returns_every_pattern():
+    trie = TopicTrie()
+    trie.insert('orders.created', 'exact')
+    trie.insert('orders.*', 'star')
+    trie.insert('#', 'hash')
+    trie.insert('users.*', 'other')
+    assert trie.match('orders.created') == {'exact', 'star', 'hash'}
+
+
+def test_insert_counts_each_value_once():
+    trie = TopicTrie()
+    trie.insert('a.b', 1)
+    trie.insert('a.b', 1)
+    trie.insert('a.b', 2)
+    assert len(trie) == 2
+
+
+def test_remove_prunes_empty_nodes():
+    trie = TopicTrie()
+    trie.insert('a.b.c', 1)
+    trie.insert('a', 2)
+    trie.remove('a.b.c', 1)
+    assert trie.match('a.b.c') == set()
+    assert trie.match('a') == {2}
+    assert trie.root.children['a'].children == {}
+    assert len(trie) == 1
+
+
+def test_remove_missing_is_ignored():
+    trie = TopicTrie()
+    trie.insert('a.b', 1)
+    trie.remove('a.c', 1)
+    trie.remove('a.b', 2)
+    assert trie.match('a.b') == {1}
+    assert len(trie) == 1
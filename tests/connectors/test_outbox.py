@@ -0,0 +1,108 @@
+import json
+import os
+import subprocess
+import threading
+import time
+
+import pytest
+
+from connectors.outbox import Outbox
+
+
+@pytest.fixture
+def outbox():
+    return Outbox(':memory:', claim_timeout=60)
+
+
+def test_claims_in_order_and_only_once(outbox):
+    outbox.extend([{'n': 1}, {'n': 2}])
+    outbox.append({'n': 3})
+    claimed = outbox.claim(2)
+    assert [delivery for _, delivery, _ in claimed] == [{'n': 1}, {'n': 2}]
+    assert [delivery for _, delivery, _ in outbox.claim(10)] == [{'n': 3}]
+    assert outbox.claim(10) == []
+
+
+def test_delayed_email_is_not_due(outbox):
+    outbox.append({'n': 1}, delay=60)
+    assert outbox.claim() == []
+    assert outbox.stats()['depth'] == 1
+
+
+def test_expired_claim_is_claimed_again():
+    outbox = Outbox(':memory:', claim_timeout=0)
+    outbox.append({'n': 1})
+    email_id, _, _ = outbox.claim()[0]
+    time.sleep(0.01)
+    assert outbox.claim()[0][0] == email_id
+
+
+def test_retry_counts_the_attempt(outbox):
+    outbox.append({'n': 1})
+    email_id, _, _ = outbox.claim()[0]
+    outbox.retry(email_id, 'error', 0)
+    assert outbox.get(email_id) == ({'n': 1}, 1)
+    # The email stays claimed after its retry
+    assert outbox.claim() == []
+    assert outbox.stats()['retrying'] == 1
+
+
+def test_done_and_discard_delete(outbox):
+    outbox.extend([{'n': 1}, {'n': 2}])
+    (sent, _, _), (dead, _, _) = outbox.claim(2)
+    outbox.done(sent)
+    outbox.discard(dead)
+    assert outbox.get(sent) is None
+    stats = outbox.stats()
+    assert (stats['depth'], stats['sent'], stats['dead']) == (0, 1, 1)
+
+
+def test_survives_reopening(tmp_path):
+    path = str(tmp_path / 'outbox.db')
+    Outbox(path).append({'n': 1})
+    assert [delivery for _, delivery, _ in Outbox(path).claim()] == [{'n': 1}]
+
+
+def test_wait_returns_when_appended(outbox):
+    wakeups = outbox.wakeups
+    outbox.append({'n': 1})
+    started = time.monotonic()
+    outbox.wait(wakeups, 5)
+    assert time.monotonic() - started < 1
+
+
+def test_buffered_of_running_processes_are_not_taken(outbox):
+    finished = subprocess.Popen(['true'])
+    finished.wait()
+    for pid in (os.getppid(), finished.pid):
+        outbox.conn.execute(
+            'INSERT INTO digests (key, digest, message, pid) '
+            'VALUES (?, ?, ?, ?)', ('"k"', '{}', json.dumps(pid), pid))
+    own = outbox.buffer('k', {}, 'own')
+    assert [(key, message) for _, key, _, message in outbox.buffered()] == [
+        ('k', finished.pid), ('k', 'own')]
+    outbox.extend([{'n': 1}], buffered=[own])
+    assert len(outbox.buffered()) == 1
+
+
+def test_wait_room_blocks_until_an_email_is_sent(outbox):
+    outbox.extend([{'n': 1}, {'n': 2}])
+    (email_id, _, _), _ = outbox.claim(2)
+    threading.Timer(0.1, outbox.done, (email_id,)).start()
+    started = time.monotonic()
+    outbox.wait_room(2, timeout=5)
+    assert 0.05 < time.monotonic() - started < 2
+    assert outbox.stats()['full_waits'] == 1
+    outbox.wait_room(0)
+
+
+def test_wait_room_counts_emails_sent_by_other_processes(tmp_path):
+    path = str(tmp_path / 'outbox.db')
+    outbox = Outbox(path)
+    other = Outbox(path)
+    outbox.append({'n': 1})
+    other.done(other.claim()[0][0])
+    started = time.monotonic()
+    outbox.wait_room(1, timeout=5)
+    assert time.monotonic() - started < 1
+    assert outbox.depth == 0
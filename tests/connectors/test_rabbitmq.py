@@ -0,0 +1,55 @@
+import json
+import time
+import types
+from unittest import mock
+
+import pytest
+
+from connectors.rabbitmq import RabbitMQConsumer, FAILURES_HEADER
+
+
+@pytest.fixture
+def consumer():
+    received = []
+    consumer = RabbitMQConsumer(
+        lambda message, tag: received.append(tag), 'host', 'user', 'pass',
+        [], 'notifyme', prefetch=10, max_attempts=2, retry_wait=5)
+    consumer.connection = mock.Mock()
+    consumer.channel = mock.Mock()
+    consumer.received_tags = received
+    return consumer
+
+
+def deliver(consumer, delivery_tag):
+    method = types.SimpleNamespace(
+        exchange='ex', routing_key='a.b', delivery_tag=delivery_tag)
+    consumer.receive(
+        consumer.channel, method, None, json.dumps({}).encode('utf-8'))
+    return consumer.received_tags[-1]
+
+
+def test_failed_message_is_republished_with_a_failure(consumer):
+    retried_at = consumer.bindings_retried_at
+    consumer.complete(deliver(consumer, 1), False)
+    consumer.complete(deliver(consumer, 2), True)
+    consumer.flush_acks(force=True)
+    headers = consumer.channel.basic_publish.call_args[1][
+        'properties'].headers
+    assert headers[FAILURES_HEADER] == 1
+    consumer.channel.basic_ack.assert_called_once_with(
+        delivery_tag=2, multiple=True)
+    stats = consumer.stats()
+    assert (stats['republished'], stats['acked'], stats['rejected']) == (
+        1, 2, 0)
+    # Republishing doesn't delay the bindings pending
+    assert consumer.bindings_retried_at == retried_at
+
+
+def test_bindings_pending_are_retried_after_the_wait(consumer):
+    consumer.pending = {('ex', 'a.b')}
+    consumer.retry_bindings()
+    assert consumer.pending
+    consumer.bindings_retried_at = time.monotonic() - 5
+    consumer.retry_bindings()
+    assert not consumer.pending
+    assert consumer.stats()['republished'] == 0
@@ -0,0 +1,117 @@
+import threading
+from unittest import mock
+
+import pytest
+
+from connectors.rethink import QueryWatchdog, RethinkHandler, RethinkPool
+from connectors.rethink_realtime import BDRealtime
+from exceptions.db_exceptions import ReadError
+
+
+class Connection():
+
+    def __init__(self):
+        self.closed = False
+        self.shut_down = threading.Event()
+        self._instance = mock.Mock()
+        self._instance._socket._socket.shutdown.side_effect = \
+            lambda how: self.shut_down.set()
+
+    def is_open(self):
+        # Shutting down the socket doesn't close the connection
+        return not self.closed
+
+    def close(self, noreply_wait=True):
+        self.closed = True
+
+
+class Query():
+
+    def __init__(self, conn=None):
+        self.conn = conn
+
+    def run(self, conn, **options):
+        if self.conn:
+            # Runs until the watchdog shuts down the socket
+            assert self.conn.shut_down.wait(2)
+        return 'result'
+
+
+@pytest.fixture
+def watchdog(monkeypatch):
+    watchdog = QueryWatchdog(interval=0.01)
+    watchdog.start()
+    monkeypatch.setattr(QueryWatchdog, 'instance', watchdog)
+    return watchdog
+
+
+@pytest.fixture
+def handler(monkeypatch):
+    pool = RethinkPool('host', 28015, 'db', min_size=0, max_size=1)
+    monkeypatch.setattr(pool, 'open', Connection)
+    monkeypatch.setitem(RethinkPool.pools, ('host', 28015, 'db', None), pool)
+    return RethinkHandler('host', 28015, 'db', query_timeout=0.05)
+
+
+def test_unwatch_reports_interrupted_queries(watchdog):
+    conn = Connection()
+    fast = watchdog.watch(conn, 60)
+    slow = watchdog.watch(conn, 0)
+    assert conn.shut_down.wait(2)
+    assert watchdog.unwatch(slow)
+    assert not watchdog.unwatch(fast)
+    assert watchdog.interrupted == 1
+
+
+def test_interrupted_connection_is_not_pooled(watchdog, handler):
+    conn = handler.pool.borrow()
+    handler.pool.release(conn)
+    assert handler.run(Query(conn)) == 'result'
+    assert conn.closed
+    stats = handler.pool.stats()
+    assert (stats['opened'], stats['idle']) == (0, 0)
+
+
+def test_connection_is_pooled_after_the_query(watchdog, handler):
+    assert handler.run(Query()) == 'result'
+    assert handler.pool.stats()['idle'] == 1
+
+
+def test_schema_operations_are_not_interrupted(watchdog, handler):
+    query = mock.Mock()
+    query.run.return_value = []
+    with mock.patch('connectors.rethink.r') as r:
+        r.db.return_value.table.return_value.index_wait.return_value = query
+        with mock.patch.object(watchdog, 'watch') as watch:
+            handler.wait_indexes('users')
+    watch.assert_not_called()
+    query.run.assert_called_once()
+
+
+@pytest.fixture
+def realtime():
+    with mock.patch('connectors.rethink_realtime.r') as r:
+        yield BDRealtime('host', 28015, 'db'), r.connect.return_value
+
+
+def test_closing_the_changefeed_closes_his_connection(realtime):
+    realtime, con = realtime
+    cursor = mock.MagicMock()
+    cursor.__next__.side_effect = [{'new_val': 1}, StopIteration]
+    query = mock.Mock()
+    query.run.return_value = cursor
+    changes = realtime.run(query)
+    assert list(changes) == [{'new_val': 1}]
+    con.close.assert_not_called()
+    changes.close()
+    cursor.close.assert_called_once_with()
+    con.close.assert_called_once_with(noreply_wait=False)
+
+
+def test_failed_changefeed_closes_his_connection(realtime):
+    realtime, con = realtime
+    query = mock.Mock()
+    query.run.side_effect = OSError()
+    with pytest.raises(ReadError):
+        realtime.run(query)
+    con.close.assert_called_once_with(noreply_wait=False)
@@ -0,0 +1,55 @@
+import smtplib
+from unittest import mock
+
+import pytest
+
+from connectors.smtp import SMTPHandler, EncodedMessage
+
+
+@pytest.fixture
+def handler():
+    return SMTPHandler(
+        'me@x.com', 'pass', 'host', 25, 'Me', False, 1, 60, 100, 10, 10)
+
+
+@pytest.fixture
+def message():
+    return EncodedMessage('me@x.com', b'Subject: s\n\n.dot\n')
+
+
+def test_plain_refusals_are_returned(handler, message):
+    server = mock.Mock()
+    server.mail.return_value = (250, b'ok')
+    server.rcpt.side_effect = [(550, b'no'), (450, b'busy')]
+    refused = handler.plain_transaction(server, message, ['a@x', 'b@x'])
+    assert refused == {'a@x': (550, b'no'), 'b@x': (450, b'busy')}
+    server.rset.assert_called_once_with()
+    server.putcmd.assert_not_called()
+
+
+def test_plain_sends_the_cached_bytes(handler, message):
+    server = mock.Mock()
+    server.mail.return_value = (250, b'ok')
+    server.rcpt.side_effect = [(250, b'ok'), (550, b'no')]
+    server.getreply.side_effect = [(354, b'go'), (250, b'queued')]
+    refused = handler.plain_transaction(server, message, ['a@x', 'b@x'])
+    assert refused == {'b@x': (550, b'no')}
+    assert server.send.call_args_list[-1] == mock.call(message.quoted)
+    assert message.quoted.endswith(b'\r\n..dot\r\n.\r\n')
+
+
+def test_pipelined_refusals_are_returned(handler, message):
+    server = mock.Mock()
+    server.getreply.side_effect = [
+        (250, b'ok'), (550, b'no'), (550, b'no'), (554, b'no recipients')]
+    refused = handler.pipelined_transaction(server, message, ['a@x', 'b@x'])
+    assert set(refused) == {'a@x', 'b@x'}
+    server.rset.assert_called_once_with()
+
+
+def test_pipelined_sender_refused_raises(handler, message):
+    server = mock.Mock()
+    server.getreply.side_effect = [
+        (553, b'no sender'), (503, b'no'), (503, b'no')]
+    with pytest.raises(smtplib.SMTPSenderRefused):
+        handler.pipelined_transaction(server, message, ['a@x'])
@@ -0,0 +1,29 @@
+import pytest
+
+from connectors.sqlite import SQLiteHandler
+
+
+@pytest.fixture
+def storage():
+    storage = SQLiteHandler(':memory:')
+    storage.create_table('users')
+    return storage
+
+
+def test_counts_committed_writes(storage):
+    storage.insert_data('users', [{'id': 'u1'}, {'id': 'u2'}])
+    storage.delete_data('users', 'u1')
+    assert storage.stats()['tables']['users'] == {
+        'written': 2, 'removed': 1}
+
+
+def test_does_not_count_rolled_back_writes(storage):
+    storage.insert_data('users', {'id': 'u1'})
+    with pytest.raises(RuntimeError):
+        with storage.transaction():
+            storage.put_document('users', {'id': 'u2'})
+            storage.remove_document('users', 'u1')
+            raise RuntimeError()
+    assert storage.get_data('users', None) == [{'id': 'u1'}]
+    assert storage.stats()['tables']['users'] == {
+        'written': 1, 'removed': 0}
@@ -0,0 +1,39 @@
+"""
+Dates stored in the database. Every stored date is written in one
+fixed UTC format with microseconds, so the dates sort as strings in
+the same order as in time and the date indexes can be queried by range
+"""
+import datetime
+
+from dateutil import parser
+
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f+00:00'
+
+
+def to_utc(date):
+    """
+    Returns the date in the stored format
+    :date: Datetime, the naive ones are taken as UTC
+    """
+    if date.tzinfo is not None:
+        date = date.astimezone(datetime.timezone.utc)
+    return date.strftime(DATE_FORMAT)
+
+
+def utc_now():
+    """
+    Returns the current date in the stored format
+    """
+    return to_utc(datetime.datetime.now(datetime.timezone.utc))
+
+
+def normalize(date):
+    """
+    Returns a stored date of any ISO-8601 format in the stored format,
+    or the value as it is if it is not a date
+    :date: Stored date
+    """
+    try:
+        return to_utc(parser.isoparse(date))
+    except (TypeError, ValueError):
+        return date
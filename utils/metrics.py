@@ -0,0 +1,35 @@
+"""
+Process metrics registry. Components register a callable returning
+a dictionary with their counters and the API exposes all of them
+"""
+from threading import Lock
+
+_lock = Lock()
+_sources = {}
+
+
+def register(name, source):
+    """
+    Registers a metrics source
+    :name: Name to group the metrics under
+    :source: Callable without params returning a dictionary
+    """
+    with _lock:
+        _sources[name] = source
+
+
+def unregister(name):
+    """
+    Removes a metrics source
+    """
+    with _lock:
+        _sources.pop(name, None)
+
+
+def collect():
+    """
+    Returns the metrics of every registered source
+    """
+    with _lock:
+        sources = dict(_sources)
+    return {name: source() for name, source in sources.items()}
@@ -0,0 +1,60 @@
+"""
+Pagination of the API list endpoints
+"""
+import ujson
+from flask import Response
+
+
+def page_params(args, max_limit):
+    """
+    Returns a tuple (limit, start_after, fields) from the query string.
+    Raises ValueError if the params are not valid
+    :args: Query string params
+    :max_limit: Maximum page size
+    """
+    limit = args.get('limit')
+    if limit is not None:
+        if not limit.isdigit() or not 0 < int(limit) <= max_limit:
+            raise ValueError(
+                'limit must be a number between 1 and {}'.format(max_limit))
+        limit = int(limit)
+
+    start_after = args.get('start_after') or None
+
+    fields = args.get('fields')
+    if fields:
+        fields = [field for field in fields.split(',') if field]
+        # The id is needed to request the next page
+        if 'id' not in fields:
+            fields.append('id')
+
+    return limit, start_after, fields
+
+
+def list_response(documents, limit=None):
+    """
+    Returns the response of a list endpoint. Pages are returned with the
+    X-Next-Start-After header if there can be more documents. Without
+    limit the list is streamed as it is read from the database
+    :documents: Iterator over the documents
+    :limit: Page size
+    """
+    if limit:
+        page = list(documents)
+        headers = {}
+        if len(page) == limit:
+            headers['X-Next-Start-After'] = page[-1]['id']
+        return page, 200, headers
+
+    return Response(stream_list(documents), mimetype='application/json')
+
+
+def stream_list(documents):
+    """
+    Yields a json list document by document
+    """
+    separator = '['
+    for document in documents:
+        yield separator + ujson.dumps(document)
+        separator = ','
+    yield '[]' if separator == '[' else ']'
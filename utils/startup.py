@@ -0,0 +1,15 @@
+"""
+Process start time
+"""
+import time
+
+# Taken when the module is imported, so it has to be imported
+# before the rest of the modules of the program
+STARTED = time.monotonic()
+
+
+def elapsed():
+    """
+    Seconds since the process started
+    """
+    return time.monotonic() - STARTED
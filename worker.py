@@ -0,0 +1,56 @@
+"""
+Worker program file. Consumes the notifyme queue and sends the
+emails without the API. Several workers can run at once, in the same
+or in other machines, sharing the queue and the database
+"""
+import sys
+from threading import Event
+
+from utils import startup
+
+import errors
+import settings as st
+
+from bussiness import registry, schema
+from bussiness.coordinator import Coordinator
+from bussiness.realtime import Realtime
+from utils import metrics
+
+
+def main():
+    """
+    Worker program file
+    """
+
+    st.logger.info('Starting notifyme worker...')
+
+    if st.DB_BACKEND != 'rethink':
+        # Changes of the local backends are only seen by the process
+        # that makes them, the worker would miss every change of the API
+        st.logger.error(
+            'Workers need the rethink backend, not %s', st.DB_BACKEND)
+        sys.exit(1)
+
+    schema.bootstrap()
+
+    coordinator = Coordinator('bindings', st.WORKERS_LEASE_DURATION)
+    Realtime(coordinator)
+    coordinator.start()
+
+    metrics.register('registry', registry.stats)
+    st.logger.info(
+        'Worker %s started in %.2fs',
+        coordinator.owner, startup.elapsed())
+
+    # Captures not controlled exceptions
+    sys.excepthook = errors.log_unhandled_exception
+
+    try:
+        Event().wait()
+    except KeyboardInterrupt:
+        # Frees the lease so another worker binds the queue without waiting
+        coordinator.stop()
+        coordinator.join()
+
+
+main()